@@ -0,0 +1,358 @@
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from cancellation import CANCELLED, TIMEOUT, CancelToken, TurnCancelled, TurnTimeout, submit
+from modelRouting import ANSWER, PLAN, SUMMARY, StageModels, StageStats, validate_tool_calls
+from tokenBudget import ContextGuard, ContextOverflow
+from toolResult import ToolResult
+
+_tool_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="tool")
+
+TIMEOUT_ANSWER = "抱歉，这次查询处理超时了，请稍后再试。"
+CANCELLED_ANSWER = "（已取消本次回答）"
+# 回答中途被取消或超时时，保留已生成的部分并加上标记
+INTERRUPTED_MARK = "……（回答已中断）"
+TOOL_CANCELLED = "工具调用已取消"
+
+SUMMARY_PROMPT = "请用简洁的中文概括以下对话的要点，保留地点、时间、用户偏好和已查询到的关键结果。"
+
+
+class PlannerAnswered(Exception):
+    """规划模型没有调用工具而是开始直接回答"""
+
+
+def _failure(error):
+    """模型调用失败的原因，用于指标"""
+    if isinstance(error, TurnCancelled):
+        return TIMEOUT if isinstance(error, TurnTimeout) else CANCELLED
+    return "error"
+
+
+def _drain(deltas):
+    for _ in deltas:
+        pass
+
+
+class AgentStep:
+    """一次模型调用的结果：流式文本与累积出的 tool_calls"""
+
+    def __init__(self):
+        self.content = ""
+        self.tool_calls = {}
+        self.usage = None
+        self.ttft = None
+
+    def add_tool_call_delta(self, delta):
+        call = self.tool_calls.setdefault(delta.index, {
+            "id": "",
+            "type": "function",
+            "function": {"name": "", "arguments": ""}
+        })
+        if delta.id:
+            call["id"] = delta.id
+        if delta.function:
+            if delta.function.name:
+                call["function"]["name"] += delta.function.name
+            if delta.function.arguments:
+                call["function"]["arguments"] += delta.function.arguments
+
+    def assistant_message(self):
+        """转换为可追加到对话历史中的 assistant 消息"""
+        message = {"role": "assistant", "content": self.content or None}
+        if self.tool_calls:
+            message["tool_calls"] = [self.tool_calls[i] for i in sorted(self.tool_calls)]
+        return message
+
+
+class AgentLoop:
+    """有界的多步工具调用循环，每一步都以流式方式调用模型
+
+    - max_steps: 单轮对话中最多进行几次模型调用
+    - step_timeout: 单次模型调用或单个工具调用的超时时间（秒）
+    - turn_timeout: 整轮对话的截止时间（秒）
+    - models: modelRouting.StageModels，配置了较小的规划模型时，每轮第一次调用用它选择工具，
+      它给出的工具调用不合法或开始直接回答时，立即改用 answer 模型重做这一步
+    - context_guard: tokenBudget.ContextGuard，每次调用模型前检查上下文预算，超出时用 summary 模型压缩历史
+    """
+
+    def __init__(self, client, model, function_registry,
+                 max_steps=4, step_timeout=30, turn_timeout=90,
+                 on_tool_call=None, on_stream=None, models=None, context_guard=None):
+        self.client = client
+        self.models = models or StageModels(model)
+        self.model = self.models.answer
+        self.stage_stats = StageStats()
+        self.context_guard = context_guard or ContextGuard()
+        self.function_registry = function_registry
+        self.max_steps = max_steps
+        self.step_timeout = step_timeout
+        self.turn_timeout = turn_timeout
+        self.on_tool_call = on_tool_call or (lambda name, arguments, cached: None)
+        # on_stream 接收文本增量的迭代器，负责展示；默认直接耗尽
+        self.on_stream = on_stream or (lambda deltas: [None for _ in deltas])
+        # 最近若干次模型调用的耗时，用于估算省掉一次往返节省的时间
+        self.step_latencies = deque(maxlen=50)
+        # 上一轮实际执行过的工具调用：(函数名, 参数, 结果)
+        self.last_tool_results = []
+        # 上一轮是否被中断：None、TIMEOUT 或 CANCELLED
+        self.interrupted = None
+        # 上一轮需要展示的说明（上下文压缩、截断、TOKEN_LOG 的 token 构成，工具异常），由调用方展示
+        self.notices = []
+
+    def run_turn(self, conversation, tools=None, local_calls=(), cancel_token=None):
+        """执行一轮对话，把 assistant / tool 消息追加到 conversation，返回最终回答
+
+        conversation 是 messageBuilder.MessageBuilder，历史只追加不修改。
+        tools 为本轮发送给模型的工具子集，默认使用 conversation.tools；
+        local_calls 中的 (函数名, 参数) 会在第一次调用模型前直接在本地执行。
+        cancel_token 取消时（如用户按下 Ctrl-C），正在进行的模型流式响应和工具请求会被关闭，
+        已生成的部分回答和已完成的工具结果照常写入历史。
+        """
+        token = CancelToken(self.turn_timeout, parent=cancel_token)
+        self.last_tool_results = []
+        self.interrupted = None
+        self.notices = []
+        try:
+            with token.bind():
+                return self._run_turn(conversation, tools, local_calls, token)
+        finally:
+            token.close()
+
+    def _run_turn(self, conversation, tools, local_calls, token):
+        tools = conversation.tools if tools is None else tools
+        memo = {}
+        force_answer = False
+        step = None
+        try:
+            if local_calls:
+                self._run_local_calls(local_calls, conversation, memo, token)
+
+            for step_index in range(self.max_steps):
+                last_step = force_answer or step_index == self.max_steps - 1
+                step = AgentStep()
+                if step_index == 0 and tools and not last_step and self.models.routes_planning:
+                    self._plan_step(conversation, tools, token, step)
+                else:
+                    self._run_step(conversation, tools, token, step, allow_tools=not last_step)
+
+                # 最后一步即使模型仍返回 tool_calls 也不再执行，保证历史消息合法
+                if last_step or not step.tool_calls:
+                    conversation.append({"role": "assistant", "content": step.content})
+                    return step.content
+
+                conversation.append(step.assistant_message())
+                # 文本已写入历史，之后被中断时不再作为部分回答
+                tool_step, step = step, None
+                all_cached = self._run_tools(tool_step, conversation, memo, token)
+                # 本步所有工具结果都来自本轮已有结果，说明模型在重复调用，直接要求作答
+                if all_cached:
+                    force_answer = True
+        except TurnCancelled as e:
+            return self._interrupt(conversation, step.content if step else "", e)
+        except ContextOverflow as e:
+            # 本轮的工具结果截断后仍然放不下：直接告知用户，下一轮开始时这一轮会被压缩
+            answer = str(e)
+            self.on_stream(iter([answer]))
+            conversation.append({"role": "assistant", "content": answer})
+            return answer
+
+    def _interrupt(self, conversation, partial, error):
+        self.interrupted = TIMEOUT if isinstance(error, TurnTimeout) else CANCELLED
+        if partial:
+            answer = partial + INTERRUPTED_MARK
+        else:
+            answer = TIMEOUT_ANSWER if self.interrupted == TIMEOUT else CANCELLED_ANSWER
+            self.on_stream(iter([answer]))
+        conversation.append({"role": "assistant", "content": answer})
+        return answer
+
+    @property
+    def average_step_latency(self):
+        if not self.step_latencies:
+            return 0.0
+        return sum(self.step_latencies) / len(self.step_latencies)
+
+    def _plan_step(self, conversation, tools, token, step):
+        """用规划模型选择工具，失败时用 answer 模型重做这一步（结果写入 step）"""
+        plan = AgentStep()
+        try:
+            self._run_step(conversation, tools, token, plan, stage=PLAN)
+        except PlannerAnswered:
+            # 不需要工具的问题交给 answer 模型回答，只多花了规划模型的首 token 时间
+            self.stage_stats.fallback("answered")
+        else:
+            calls = plan.assistant_message().get("tool_calls")
+            if calls and validate_tool_calls(calls, tools) is None:
+                step.tool_calls = plan.tool_calls
+                return step
+            # 工具调用不合法（或没有给出工具调用）时计入兜底统计，由 answer 模型重做
+            self.stage_stats.fallback("invalid")
+        return self._run_step(conversation, tools, token, step)
+
+    def _run_step(self, conversation, tools, token, step, allow_tools=True, stage=ANSWER):
+        timeout = token.timeout(self.step_timeout)
+        started = time.monotonic()
+        step_deadline = started + timeout
+        model = self.models.model_for(stage)
+        # 超出上下文窗口时先压缩历史，再构建请求
+        self.notices.extend(self.context_guard.enforce(conversation, tools, self.summarize))
+        request = {
+            "model": model,
+            "messages": conversation.build(),
+            "stream": True,
+            # 流式结束时返回 usage，用于统计前缀缓存命中
+            "stream_options": {"include_usage": True},
+            "timeout": timeout,
+        }
+        if tools:
+            request["tools"] = tools
+            if not allow_tools:
+                request["tool_choice"] = "none"
+
+        try:
+            stream = self.client.chat.completions.create(**request)
+        except Exception as e:
+            self.stage_stats.failed(stage, model, _failure(e))
+            raise
+        close = getattr(stream, "close", None) or (lambda: None)
+        # 取消时立即关闭流式响应，释放连接，服务端也会停止生成
+        unregister = token.on_cancel(close)
+        # 规划阶段的输出不展示给用户，出现文本时中止，改由 answer 模型回答
+        consume = self.on_stream if stage == ANSWER else _drain
+        try:
+            consume(self._iter_deltas(stream, step, started, step_deadline, token, stage == PLAN))
+        except PlannerAnswered:
+            self.stage_stats.record(stage, model, time.monotonic() - started, step.ttft, step.usage)
+            raise
+        except TurnCancelled as e:
+            self.stage_stats.failed(stage, model, _failure(e))
+            raise
+        except Exception as e:
+            # 流被取消回调关闭后，读取会以连接错误结束
+            if token.cancelled:
+                e = token.error()
+                self.stage_stats.failed(stage, model, _failure(e))
+                raise e
+            self.stage_stats.failed(stage, model, _failure(e))
+            raise
+        finally:
+            unregister()
+            close()
+        latency = time.monotonic() - started
+        conversation.cache_stats.record(step.usage, step.ttft)
+        if stage == ANSWER and step.usage is not None:
+            conversation.tokens.calibrate(getattr(step.usage, "prompt_tokens", 0))
+        self.stage_stats.record(stage, model, latency, step.ttft, step.usage)
+        self.step_latencies.append(latency)
+        return step
+
+    def summarize(self, messages, instruction=SUMMARY_PROMPT):
+        """用 summary 模型概括一段对话历史，返回摘要文本"""
+        started = time.monotonic()
+        response = self.client.chat.completions.create(
+            model=self.models.summary,
+            messages=[{"role": "system", "content": instruction}] + list(messages),
+            stream=False,
+            timeout=self.step_timeout,
+        )
+        self.stage_stats.record(SUMMARY, self.models.summary, time.monotonic() - started,
+                                usage=getattr(response, "usage", None))
+        return response.choices[0].message.content or ""
+
+    def _iter_deltas(self, stream, step, started, step_deadline, token, abort_on_content=False):
+        """产出文本增量，同时累积 tool_calls；被取消或超过单步时限时中止"""
+        for chunk in stream:
+            token.check()
+            if time.monotonic() > step_deadline:
+                raise TurnTimeout()
+            if step.ttft is None:
+                step.ttft = time.monotonic() - started
+            if getattr(chunk, "usage", None):
+                step.usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            for tool_call in delta.tool_calls or ():
+                step.add_tool_call_delta(tool_call)
+            if delta.content:
+                if abort_on_content and not step.tool_calls:
+                    raise PlannerAnswered()
+                step.content += delta.content
+                yield delta.content
+
+    def _run_local_calls(self, local_calls, conversation, memo, token):
+        """把本地预执行的工具调用以标准 tool_calls 的形式写入历史"""
+        step = AgentStep()
+        for index, (name, arguments) in enumerate(local_calls):
+            step.tool_calls[index] = {
+                "id": f"local_{len(conversation)}_{index}",
+                "type": "function",
+                "function": {"name": name, "arguments": json.dumps(arguments, ensure_ascii=False)}
+            }
+        conversation.append(step.assistant_message())
+        self._run_tools(step, conversation, memo, token)
+
+    def _run_tools(self, step, conversation, memo, token):
+        """并发执行本步的所有工具调用，返回是否全部命中本轮已有结果
+
+        被取消时，未完成的调用以“已取消”作为结果写入历史，保证每个 tool_call 都有对应的 tool 消息。
+        """
+        futures = []
+        all_cached = True
+        for call in step.assistant_message()["tool_calls"]:
+            name = call["function"]["name"]
+            raw_arguments = call["function"]["arguments"] or "{}"
+            key = (name, raw_arguments)
+            cached = key in memo
+            all_cached = all_cached and cached
+            try:
+                arguments = json.loads(raw_arguments)
+            except ValueError:
+                arguments = None
+            self.on_tool_call(name, arguments, cached)
+
+            if cached:
+                futures.append((call["id"], None, memo[key]))
+            elif name not in self.function_registry or arguments is None:
+                futures.append((call["id"], None, ToolResult.error(f"无法调用函数 {name}，请检查函数名和参数")))
+            else:
+                # 工具在线程池中执行，带上取消令牌，上游请求据此中止
+                future = submit(_tool_pool, self.function_registry[name], arguments)
+                memo[key] = future
+                futures.append((call["id"], (name, arguments), future))
+
+        contents = {}
+        try:
+            for tool_call_id, executed, result in futures:
+                content = self._tool_result(result, token, executed[0] if executed else "tool")
+                contents[tool_call_id] = content
+                if executed is not None and result.done() and not result.cancelled() and result.exception() is None:
+                    self.last_tool_results.append((executed[0], executed[1], content))
+        finally:
+            for tool_call_id, _, result in futures:
+                if tool_call_id not in contents and hasattr(result, "cancel"):
+                    result.cancel()
+                content = contents.get(tool_call_id) or ToolResult.error(TOOL_CANCELLED)
+                conversation.append({"role": "tool", "tool_call_id": tool_call_id, "content": content})
+        token.check()
+        return all_cached
+
+    def _tool_result(self, result, token, name):
+        if not hasattr(result, "result"):
+            return result
+        try:
+            done = token.wait([result], timeout=token.timeout(self.step_timeout))
+        except TurnCancelled:
+            # 还没开始执行的调用直接取消，执行中的调用由取消令牌关闭其上游请求
+            result.cancel()
+            return ToolResult.error(TOOL_CANCELLED)
+        if not done:
+            return ToolResult.error("工具调用超时，请根据已有信息回答")
+        try:
+            return result.result()
+        except Exception as e:
+            # 工具抛出的异常作为本轮的说明交给调用方展示（次数已由 metrics.instrument_tools 记为 exception）
+            self.notices.append(f"{name} failed: {type(e).__name__}: {e}")
+            return ToolResult.error("函数执行失败，请根据已有信息回答")
@@ -0,0 +1,189 @@
+import hashlib
+import json
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from routePipeline import ROUTE_TOOLS
+from toolCache import TOOL_FRESHNESS
+
+_PUNCTUATION = re.compile(r"[\s\W_]+", re.UNICODE)
+
+
+def normalize_question(question):
+    """全角转半角、小写、去掉空白和标点"""
+    text = unicodedata.normalize("NFKC", question).lower()
+    return _PUNCTUATION.sub("", text)
+
+
+def fingerprint(content):
+    return hashlib.blake2b(str(content).encode("utf-8"), digest_size=8).hexdigest()
+
+
+def bigrams(text):
+    if len(text) < 2:
+        return {text}
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def contains_in_order(text, values):
+    """values 依次出现在 text 中（互不重叠）"""
+    position = 0
+    for value in values:
+        position = text.find(value, position)
+        if position < 0:
+            return False
+        position += len(value)
+    return True
+
+
+class AnswerEntry:
+    __slots__ = ("key", "question", "answer", "tool_fingerprints", "expires_at", "size", "grams", "anchors")
+
+    def __init__(self, key, question, answer, tool_fingerprints, expires_at, anchors=()):
+        self.key = key
+        self.question = question
+        self.answer = answer
+        self.tool_fingerprints = tool_fingerprints
+        self.expires_at = expires_at
+        self.grams = bigrams(question)
+        # 工具参数（地点、起终点）在归一化问题中的取值，相似匹配时新问题必须同样包含
+        self.anchors = anchors
+        self.size = (len(answer.encode("utf-8")) + len(question.encode("utf-8"))
+                     + 64 * (len(tool_fingerprints) + 1))
+
+
+class AnswerCache:
+    """重复问题的答案缓存，命中时整轮对话不再调用模型
+
+    - key 为 (归一化问题, 本轮可用的工具子集)，同一句追问在不同上下文中不会串用
+    - 只缓存用过工具、且工具参数都能在问题原文中找到的答案（问题是自包含的）
+    - TTL 取决于用到的工具的新鲜期；之后任何一次工具调用返回了不同的结果，
+      依赖旧结果的答案立即失效
+    - 可选基于字符 bigram 的相似度匹配，但新问题必须包含原答案用到的全部工具参数
+      （路线的起点、终点顺序也要相同），“南京天气”不会命中“北京天气”；按内存预算做 LRU 淘汰
+    """
+
+    def __init__(self, memory_budget=2 * 1024 * 1024, similarity=0.0):
+        self.memory_budget = memory_budget
+        self.similarity = similarity
+        self._entries = OrderedDict()
+        self._by_tool_call = {}
+        self._lock = threading.Lock()
+        self.memory_used = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _tool_call_key(name, arguments):
+        return name + ":" + json.dumps(arguments, ensure_ascii=False, sort_keys=True)
+
+    def lookup(self, question, tool_names):
+        normalized = normalize_question(question)
+        scope = tuple(sorted(tool_names))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get((normalized, scope))
+            if entry is None and self.similarity > 0:
+                entry = self._most_similar(normalized, scope)
+            if entry is not None and entry.expires_at < now:
+                self._remove(entry.key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(entry.key)
+            self.hits += 1
+            return entry.answer
+
+    def _most_similar(self, normalized, scope):
+        grams = bigrams(normalized)
+        best, best_score = None, self.similarity
+        for entry in self._entries.values():
+            if entry.key[1] != scope or not all(contains_in_order(normalized, group) for group in entry.anchors):
+                continue
+            score = len(grams & entry.grams) / len(grams | entry.grams)
+            if score >= best_score:
+                best, best_score = entry, score
+        return best
+
+    def store(self, question, tool_names, tool_results, answer):
+        """tool_results 为本轮执行过的 (函数名, 参数, 结果) 列表"""
+        if not answer or not tool_results:
+            return False
+        normalized = normalize_question(question)
+        ttl = min(TOOL_FRESHNESS.get(name, 0) for name, _, _ in tool_results)
+        if ttl <= 0 or not self._self_contained(normalized, tool_results):
+            return False
+
+        key = (normalized, tuple(sorted(tool_names)))
+        fingerprints = {self._tool_call_key(name, arguments): fingerprint(result)
+                        for name, arguments, result in tool_results}
+        entry = AnswerEntry(key, normalized, answer, fingerprints, time.monotonic() + ttl,
+                            self._anchors(tool_results))
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self.memory_used += entry.size
+            for call_key in fingerprints:
+                self._by_tool_call.setdefault(call_key, set()).add(key)
+            while self.memory_used > self.memory_budget and self._entries:
+                self._remove(next(iter(self._entries)))
+        return True
+
+    def observe_tool_result(self, name, arguments, result):
+        """工具结果发生变化时，让依赖旧结果的答案失效"""
+        call_key = self._tool_call_key(name, arguments)
+        current = fingerprint(result)
+        with self._lock:
+            for key in list(self._by_tool_call.get(call_key, ())):
+                entry = self._entries.get(key)
+                if entry is not None and entry.tool_fingerprints.get(call_key) != current:
+                    self._remove(key)
+
+    @staticmethod
+    def _self_contained(normalized, tool_results):
+        for name, arguments, _ in tool_results:
+            if name in ROUTE_TOOLS and not (arguments.get("source_address") and arguments.get("destination_address")):
+                return False
+            for field, value in arguments.items():
+                # 城市参数通常由模型补全，不要求出现在问题中
+                if field == "city" or not isinstance(value, str):
+                    continue
+                if field in ("source", "destination") and (arguments.get(field + "_address")):
+                    continue
+                if normalize_question(value) not in normalized:
+                    return False
+        return True
+
+    @staticmethod
+    def _anchors(tool_results):
+        """相似匹配时必须出现在新问题中的参数，每组按顺序出现：路线为 (起点, 终点)，其他参数各自一组"""
+        anchors = set()
+        for name, arguments, _ in tool_results:
+            if name in ROUTE_TOOLS:
+                anchors.add((normalize_question(arguments["source_address"]),
+                             normalize_question(arguments["destination_address"])))
+                continue
+            for field, value in arguments.items():
+                if field != "city" and isinstance(value, str):
+                    anchors.add((normalize_question(value),))
+        return tuple(anchors)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.memory_used -= entry.size
+        for call_key in entry.tool_fingerprints:
+            keys = self._by_tool_call.get(call_key)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_tool_call[call_key]
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,127 @@
+import hashlib
+import os
+import threading
+import zlib
+
+# 达到该长度（字符）的工具结果在历史中只保存引用；HISTORY_BLOBS=false 时历史保存原文
+HISTORY_BLOBS = os.getenv("HISTORY_BLOBS", "true").lower() == "true"
+BLOB_MIN_CHARS = int(os.getenv("BLOB_MIN_CHARS", "128"))
+# 持久化历史时存放内容块的目录
+BLOB_DIR = os.getenv("BLOB_DIR", "data/blobs")
+
+
+def content_digest(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class BlobRef:
+    """历史消息中对内容块的引用，size 为原文的 UTF-8 字节数"""
+
+    __slots__ = ("digest", "size")
+
+    def __init__(self, digest, size):
+        self.digest = digest
+        self.size = size
+
+    def to_json(self):
+        return {"$blob": self.digest}
+
+    def __repr__(self):
+        return f"BlobRef({self.digest[:8]}, {self.size}B)"
+
+
+class BlobStore:
+    """按内容哈希存放工具结果，相同的结果（重复的天气、地理编码）在内存和磁盘上都只存一份
+
+    所有会话共享一个实例，按引用计数回收：会话关闭后没有被引用的内容块从内存中删除，
+    已经持久化到 directory 的文件保留，供之后加载历史时使用。
+    """
+
+    def __init__(self, directory=BLOB_DIR):
+        self.directory = directory
+        self._blobs = {}
+        self._refs = {}
+        self._lock = threading.Lock()
+
+    def put(self, text):
+        encoded = text.encode("utf-8")
+        digest = hashlib.blake2b(encoded, digest_size=16).hexdigest()
+        with self._lock:
+            if digest not in self._blobs:
+                self._blobs[digest] = text
+            self._refs[digest] = self._refs.get(digest, 0) + 1
+        return BlobRef(digest, len(encoded))
+
+    def get(self, digest):
+        with self._lock:
+            text = self._blobs.get(digest)
+        if text is None:
+            raise KeyError(f"blob {digest} not found")
+        return text
+
+    def acquire(self, digest):
+        """为已持久化的内容块增加一个引用（加载历史时使用），不在内存中时从磁盘读取"""
+        with self._lock:
+            text = self._blobs.get(digest)
+        if text is None:
+            with open(self._path(digest), "rb") as f:
+                text = zlib.decompress(f.read()).decode("utf-8")
+            if content_digest(text) != digest:
+                raise ValueError(f"blob {digest} is corrupted")
+        return self.put(text)
+
+    def release(self, ref):
+        with self._lock:
+            count = self._refs.get(ref.digest, 0) - 1
+            if count > 0:
+                self._refs[ref.digest] = count
+            else:
+                self._refs.pop(ref.digest, None)
+                self._blobs.pop(ref.digest, None)
+
+    def persist(self, digest):
+        """把内容块写入磁盘（压缩），文件名即哈希，已存在时跳过"""
+        path = self._path(digest)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{threading.get_ident()}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(zlib.compress(self.get(digest).encode("utf-8"), 6))
+        os.replace(temporary, path)
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def summary(self):
+        with self._lock:
+            size = sum(len(text.encode("utf-8")) for text in self._blobs.values())
+            return f"blob store: {len(self._blobs)} blobs, {size / 1024:.1f}KB"
+
+
+class HistoryMemory:
+    """单个会话历史的内存占用
+
+    - inline：直接保存在消息里的内容（用户问题、回答、工具调用参数、较短的工具结果）
+    - referenced：历史中所有引用的原文总大小，即不做去重时需要的内存
+    - unique：本会话引用的不同内容块的大小，实际占用的内存
+    """
+
+    def __init__(self, messages, inline, refs, referenced, unique_blobs, unique):
+        self.messages = messages
+        self.inline = inline
+        self.refs = refs
+        self.referenced = referenced
+        self.unique_blobs = unique_blobs
+        self.unique = unique
+
+    @property
+    def total(self):
+        return self.inline + self.unique
+
+    def summary(self):
+        text = f"history {self.messages} msgs, {self.total / 1024:.1f}KB (inline {self.inline / 1024:.1f}KB"
+        if self.refs:
+            text += (f", {self.refs} tool payloads {self.referenced / 1024:.1f}KB "
+                     f"stored as {self.unique_blobs} blobs {self.unique / 1024:.1f}KB")
+        return text + ")"
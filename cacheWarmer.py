@@ -0,0 +1,186 @@
+import math
+import os
+import threading
+import time
+
+from routePipeline import ROUTE_TOOLS
+from toolCache import TOOL_FRESHNESS, query_key, tool_result_cache
+
+# 结果缓存并由后台预热的工具
+WARMED_TOOLS = ("get_weather",) + ROUTE_TOOLS
+
+CACHE_WARMER = os.getenv("CACHE_WARMER", "true").lower() == "true"
+WARM_TOP_K = int(os.getenv("WARM_TOP_K", "30"))
+WARM_INTERVAL = float(os.getenv("WARM_INTERVAL", "60"))
+# 预热占用的上游请求预算（次/分钟）
+WARM_RATE_PER_MINUTE = float(os.getenv("WARM_RATE_PER_MINUTE", "30"))
+
+# 冷启动时的热门查询，与 MockData.get_coordinates_data 中的常见地点一致
+DEFAULT_SEEDS = [
+    ("get_weather", {"location": city}) for city in ("上海", "北京", "杭州", "广州", "深圳")
+] + [
+    (name, {"source_address": "复旦大学江湾校区", "destination_address": "五角场"})
+    for name in ("get_walking_route_planning", "get_bicycling_route_planning", "get_drive_route_planning")
+] + [
+    ("get_public_transportation_route_planning",
+     {"source_address": "复旦大学江湾校区", "destination_address": "五角场", "city": "上海"}),
+]
+
+
+class QueryTracker:
+    """按指数衰减统计查询频率，越近的查询权重越高"""
+
+    def __init__(self, half_life=3600):
+        self.half_life = half_life
+        self._started = time.monotonic()
+        self._scores = {}
+        self._queries = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, arguments, weight=1.0):
+        key = query_key(name, arguments)
+        # 以 2^(t/half_life) 作为本次的权重，等价于对历史分数做衰减，且不用遍历更新
+        boost = weight * math.pow(2, (time.monotonic() - self._started) / self.half_life)
+        with self._lock:
+            self._scores[key] = self._scores.get(key, 0.0) + boost
+            self._queries[key] = (name, arguments)
+            if boost > 1e100:
+                self._rescale()
+
+    def _rescale(self):
+        factor = math.pow(2, (time.monotonic() - self._started) / self.half_life)
+        self._started = time.monotonic()
+        for key in self._scores:
+            self._scores[key] /= factor
+
+    def top(self, k):
+        with self._lock:
+            keys = sorted(self._scores, key=self._scores.get, reverse=True)[:k]
+            return [(key, self._queries[key]) for key in keys]
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute, burst=None):
+        self.rate = rate_per_minute / 60
+        self.capacity = burst or max(1.0, rate_per_minute / 6)
+        self._tokens = self.capacity
+        self._refilled_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._refilled_at) * self.rate)
+            self._refilled_at = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+def _cacheable(result):
+    data = result.data
+    # 高德接口出错时 HTTP 状态仍为 200，通过 status 区分
+    return result.ok and data is not None and not (isinstance(data, dict) and data.get("status") == "0")
+
+
+def cached_tool(name, fn, tracker, cache=tool_result_cache):
+    """为工具加上结果缓存，并把每次查询计入频率统计"""
+    ttl = TOOL_FRESHNESS[name]
+
+    def tool(parameters):
+        tracker.record(name, parameters)
+        key = query_key(name, parameters)
+        result = cache.get(key)
+        if result is not None:
+            return result
+        result = fn(parameters)
+        if _cacheable(result):
+            cache.set(key, result, ttl=ttl)
+        return result
+
+    tool.__name__ = getattr(fn, "__name__", name)
+    tool.__doc__ = fn.__doc__
+    return tool
+
+
+def tracked_bulk_weather(fn, tracker):
+    def get_weather_bulk(parameters):
+        locations = parameters.get("locations")
+        if isinstance(locations, list):
+            for location in locations:
+                tracker.record("get_weather", {"location": str(location).strip()})
+        return fn(parameters)
+
+    get_weather_bulk.__doc__ = fn.__doc__
+    return get_weather_bulk
+
+
+class CacheWarmer:
+    """后台预热热门的天气与路线查询
+
+    每隔 interval 秒取频率最高的 top_k 个查询，对缓存中缺失或剩余有效期不足
+    refresh_margin（占新鲜期的比例）的条目重新请求，请求速率受 rate_per_minute 限制。
+    """
+
+    def __init__(self, tools, tracker, cache=tool_result_cache, top_k=WARM_TOP_K,
+                 interval=WARM_INTERVAL, rate_per_minute=WARM_RATE_PER_MINUTE, refresh_margin=0.3):
+        self.tools = tools
+        self.tracker = tracker
+        self.cache = cache
+        self.top_k = top_k
+        self.interval = interval
+        self.refresh_margin = refresh_margin
+        self.bucket = TokenBucket(rate_per_minute)
+        self.refreshed = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="cache-warmer", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.warm_once()
+            except Exception as e:
+                print(e)
+            self._stop.wait(self.interval)
+
+    def warm_once(self):
+        """刷新一轮，返回本轮实际请求的条目数"""
+        refreshed = 0
+        for key, (name, arguments) in self.tracker.top(self.top_k):
+            remaining = self.cache.remaining_ttl(key)
+            if remaining is not None and remaining > TOOL_FRESHNESS[name] * self.refresh_margin:
+                continue
+            if not self.bucket.take():
+                break
+            result = self.tools[name](arguments)
+            if _cacheable(result):
+                self.cache.set(key, result, ttl=TOOL_FRESHNESS[name])
+                refreshed += 1
+        self.refreshed += refreshed
+        return refreshed
+
+
+def install_result_cache(registry, seeds=DEFAULT_SEEDS):
+    """给 registry 中的天气与路线工具加上结果缓存，返回 (新的 registry, CacheWarmer)"""
+    tracker = QueryTracker()
+    for name, arguments in seeds:
+        tracker.record(name, arguments, weight=0.5)
+    cached = dict(registry)
+    for name in WARMED_TOOLS:
+        cached[name] = cached_tool(name, registry[name], tracker)
+    if "get_weather_bulk" in registry:
+        # 多城市天气按城市逐条缓存，与 get_weather 共用缓存条目，这里只把每个城市计入查询频率
+        cached["get_weather_bulk"] = tracked_bulk_weather(registry["get_weather_bulk"], tracker)
+    # 预热直接调用原始工具，不计入查询频率
+    warmer = CacheWarmer({name: registry[name] for name in WARMED_TOOLS}, tracker)
+    return cached, warmer
@@ -0,0 +1,167 @@
+import contextvars
+import signal
+import threading
+import time
+from concurrent.futures import Future, FIRST_COMPLETED, wait
+from contextlib import contextmanager
+
+CANCELLED, TIMEOUT = "cancelled", "timeout"
+
+_current_token = contextvars.ContextVar("cancel_token", default=None)
+
+
+class TurnCancelled(Exception):
+    """本轮对话被用户取消"""
+
+
+class TurnTimeout(TurnCancelled):
+    """单轮对话超过了整体截止时间"""
+
+
+class CancelToken:
+    """一轮对话的取消令牌与截止时间
+
+    - cancel() 后令牌进入取消状态，依次执行 on_cancel 注册的回调（关闭流式响应、HTTP 连接等）
+    - 设置了 timeout 时，到达截止时间由后台定时器自动以 TIMEOUT 取消
+    - 设置了 parent 时，父令牌取消会连带取消本令牌
+    - bind() 把令牌放入当前上下文，工具函数和上游请求通过 current_token() 取得
+    """
+
+    def __init__(self, timeout=None, parent=None):
+        self.deadline = time.monotonic() + timeout if timeout is not None else None
+        if parent is not None and parent.deadline is not None:
+            self.deadline = parent.deadline if self.deadline is None else min(self.deadline, parent.deadline)
+        self.reason = None
+        # 取消时完成的 Future，可以和其他 Future 一起等待
+        self.future = Future()
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._timer = None
+        self._unlink = None
+        if self.deadline is not None:
+            self._timer = threading.Timer(max(self.deadline - time.monotonic(), 0), self.cancel, (TIMEOUT,))
+            self._timer.daemon = True
+            self._timer.start()
+        if parent is not None:
+            self._unlink = parent.on_cancel(lambda: self.cancel(parent.reason))
+
+    @property
+    def cancelled(self):
+        return self.reason is not None
+
+    def cancel(self, reason=CANCELLED):
+        with self._lock:
+            if self.reason is not None:
+                return
+            self.reason = reason
+            callbacks, self._callbacks = self._callbacks, []
+        self.future.set_result(reason)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+
+    def on_cancel(self, callback):
+        """注册取消回调，返回用于注销的函数；已取消时立即执行"""
+        with self._lock:
+            if self.reason is None:
+                self._callbacks.append(callback)
+                return lambda: self._discard(callback)
+        callback()
+        return lambda: None
+
+    def _discard(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def error(self):
+        return TurnTimeout() if self.reason == TIMEOUT else TurnCancelled()
+
+    def check(self):
+        """已取消或已过截止时间时抛出 TurnCancelled / TurnTimeout"""
+        if self.reason is None and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel(TIMEOUT)
+        if self.reason is not None:
+            raise self.error()
+
+    def timeout(self, limit):
+        """不超过截止时间的超时秒数，已取消时抛出异常"""
+        self.check()
+        if self.deadline is None:
+            return limit
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            self.cancel(TIMEOUT)
+            raise self.error()
+        return min(limit, remaining)
+
+    def wait(self, futures, timeout=None):
+        """等待任一 Future 完成，返回已完成的集合；等待期间被取消时抛出异常"""
+        done, _ = wait(list(futures) + [self.future], timeout=timeout, return_when=FIRST_COMPLETED)
+        self.check()
+        return done
+
+    def close(self):
+        """本轮结束后停止定时器并与父令牌解除关联"""
+        if self._timer is not None:
+            self._timer.cancel()
+        if self._unlink is not None:
+            self._unlink()
+
+    @contextmanager
+    def bind(self):
+        reset = _current_token.set(self)
+        try:
+            yield self
+        finally:
+            _current_token.reset(reset)
+
+
+def current_token():
+    """当前上下文中的取消令牌，没有时返回 None"""
+    return _current_token.get()
+
+
+def submit(pool, fn, *args):
+    """在线程池中执行 fn，并带上当前上下文（包括取消令牌）"""
+    return pool.submit(contextvars.copy_context().run, fn, *args)
+
+
+@contextmanager
+def sigint_cancels(token, poll_interval=0.05):
+    """在此范围内第一次 Ctrl-C 只取消本轮对话，第二次才退出程序
+
+    信号处理函数只记录这次请求，不加锁也不抛出异常（异步抛出的异常可能落在任何位置，
+    例如追加工具结果的 finally 中，留下不完整的历史）；由监视线程调用 token.cancel()，
+    关闭流式响应和连接，正在等待的 check() / wait() 随后抛出 TurnCancelled
+    """
+    if threading.current_thread() is not threading.main_thread():
+        yield token
+        return
+
+    requested = []
+    stop = threading.Event()
+
+    def handler(signum, frame):
+        if requested:
+            raise KeyboardInterrupt()
+        requested.append(signum)
+
+    def watch():
+        while not stop.wait(poll_interval):
+            if requested:
+                token.cancel(CANCELLED)
+                return
+
+    previous = signal.signal(signal.SIGINT, handler)
+    watcher = threading.Thread(target=watch, name="sigint-cancel", daemon=True)
+    watcher.start()
+    try:
+        yield token
+    finally:
+        signal.signal(signal.SIGINT, previous)
+        stop.set()
+        if requested:
+            token.cancel(CANCELLED)
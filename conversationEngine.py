@@ -0,0 +1,146 @@
+import itertools
+
+from agentLoop import AgentLoop
+from answerCache import AnswerCache
+from intentRouter import IntentRouter
+from llmClient import LimitedClient, ScheduledClient
+from llmScheduler import INTERACTIVE
+from messageBuilder import MessageBuilder, stabilize_tools
+from metrics import sessions_active, sessions_total, turns_total
+from modelRouting import StageModels
+from tokenBudget import ContextGuard
+
+
+class TurnResult:
+    """一轮对话的结果"""
+
+    def __init__(self, answer, from_cache=False, local_calls=(), interrupted=None, notices=()):
+        self.answer = answer
+        self.from_cache = from_cache
+        self.local_calls = local_calls
+        # 本轮被中断时为 agentLoop 中的 TIMEOUT / CANCELLED，answer 为已生成的部分
+        self.interrupted = interrupted
+        # 本轮的说明（上下文压缩、截断、token 构成，工具异常），由 run.py 展示
+        self.notices = notices
+
+
+class ConversationEngine:
+    """run.py 背后的对话引擎
+
+    多个会话共享模型客户端、工具注册表和答案缓存，每个会话有自己的消息历史和意图路由状态。
+    """
+
+    def __init__(self, client, model, function_registry, function_desc, system_prompt,
+                 tool_routing=True, answer_cache=None,
+                 max_steps=4, step_timeout=30, turn_timeout=90,
+                 plan_model=None, summary_model=None, session_concurrency=0, blob_store=None,
+                 scheduler=None, context_guard=None):
+        self.client = client
+        self.model = model
+        # 每轮第一次调用（选择工具）可以用更小的模型，最终回答用 model
+        self.models = StageModels(model, plan=plan_model, summary=summary_model)
+        # 单个会话同时进行的模型请求数上限，0 表示不限制
+        self.session_concurrency = session_concurrency
+        # 所有会话共享的模型请求调度器（llmScheduler.LLMScheduler），None 时不限制总并发
+        self.scheduler = scheduler
+        self._session_ids = itertools.count(1)
+        self.function_registry = function_registry
+        self.tools = stabilize_tools(function_desc)
+        self.system_prompt = system_prompt
+        self.tool_routing = tool_routing
+        self.answer_cache = answer_cache
+        self.max_steps = max_steps
+        self.step_timeout = step_timeout
+        self.turn_timeout = turn_timeout
+        # 所有会话共享的工具结果存储，历史中只保存引用，None 时历史保存原文
+        self.blob_store = blob_store
+        # 上下文窗口预算（tokenBudget.ContextGuard），默认按 CONTEXT_WINDOW / CONTEXT_RESERVE
+        self.context_guard = context_guard or ContextGuard()
+
+    def new_session(self, on_tool_call=None, on_stream=None, priority=INTERACTIVE):
+        """priority 为调度器中的优先级类别，如 interactive（交互）和 batch（批量）"""
+        return ConversationSession(self, on_tool_call, on_stream, priority)
+
+
+class ConversationSession:
+    """单个用户的多轮对话"""
+
+    def __init__(self, engine, on_tool_call=None, on_stream=None, priority=INTERACTIVE):
+        self.engine = engine
+        self.session_id = next(engine._session_ids)
+        sessions_total.inc()
+        sessions_active.inc()
+        self._closed = False
+        self.priority = priority
+        # system 提示与工具描述构成固定前缀，历史只追加不修改，以便命中服务端前缀缓存
+        self.conversation = MessageBuilder(engine.system_prompt, engine.tools, blob_store=engine.blob_store)
+        self.router = IntentRouter(self.conversation.tools)
+        self.on_stream = on_stream
+        client = engine.client
+        if engine.scheduler is not None:
+            client = ScheduledClient(client, engine.scheduler, self.session_id, priority)
+        if engine.session_concurrency:
+            client = LimitedClient(client, engine.session_concurrency)
+        self.agent = AgentLoop(
+            client,
+            engine.model,
+            engine.function_registry,
+            max_steps=engine.max_steps,
+            step_timeout=engine.step_timeout,
+            turn_timeout=engine.turn_timeout,
+            on_tool_call=on_tool_call,
+            on_stream=on_stream,
+            models=engine.models,
+            context_guard=engine.context_guard
+        )
+
+    def ask(self, user_input, cancel_token=None):
+        """处理一轮用户输入，返回 TurnResult；cancel_token 取消时本轮提前结束，会话保持可用"""
+        engine = self.engine
+        self.conversation.append({"role": "user", "content": user_input})
+
+        if engine.tool_routing:
+            decision = self.router.route(user_input)
+            tools, local_calls = decision.tools, decision.local_calls
+        else:
+            tools, local_calls = self.conversation.tools, ()
+        tool_names = [tool["function"]["name"] for tool in tools]
+
+        # 重复的问题直接使用缓存的答案，不再调用模型
+        answer_cache = engine.answer_cache
+        answer = answer_cache.lookup(user_input, tool_names) if answer_cache else None
+        if answer is not None:
+            self.conversation.append({"role": "assistant", "content": answer})
+            if self.on_stream:
+                self.on_stream(iter([answer]))
+            turns_total.inc("cached")
+            return TurnResult(answer, from_cache=True)
+
+        # 多步工具调用：模型可以连续调用工具，直到给出最终回答
+        answer = self.agent.run_turn(self.conversation, tools=tools, local_calls=local_calls,
+                                     cancel_token=cancel_token)
+        interrupted = self.agent.interrupted
+
+        if answer_cache:
+            # 被中断的轮次中已完成的工具结果仍然有效，可用于让旧答案失效
+            for name, arguments, result in self.agent.last_tool_results:
+                answer_cache.observe_tool_result(name, arguments, result)
+            if interrupted is None:
+                answer_cache.store(user_input, tool_names, self.agent.last_tool_results, answer)
+        if engine.tool_routing and local_calls:
+            self.router.record_local_round(self.agent.average_step_latency)
+        turns_total.inc(interrupted or "ok")
+        return TurnResult(answer, local_calls=local_calls, interrupted=interrupted, notices=self.agent.notices)
+
+    def close(self):
+        """结束会话，释放历史占用的共享存储"""
+        self.conversation.close()
+        if not self._closed:
+            self._closed = True
+            sessions_active.dec()
+
+
+def make_answer_cache(enabled, budget_mb, similarity):
+    if not enabled:
+        return None
+    return AnswerCache(memory_budget=int(budget_mb * 1024 * 1024), similarity=similarity)
@@ -0,0 +1,180 @@
+"""LangGraph 引擎与 AgentExecutor 的对比测试
+
+用脚本化的聊天模型（固定的调用延迟）和带延迟的模拟工具，对同一组需要多个独立工具调用的问题
+分别运行 langchainEngines 中的两个引擎，输出每轮耗时的 p50/p95、模型调用次数和工具的最大并行数。
+
+用法：
+    python engineBenchmark.py --turns 20 --tool-latency-ms 300 --llm-latency-ms 200
+    python engineBenchmark.py --checkpoint sqlite --db /tmp/bench.sqlite
+"""
+import argparse
+import json
+import threading
+import time
+import uuid
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.tools import tool
+
+from langchainEngines import ExecutorEngine, GraphEngine, make_checkpointer
+from loadTest import percentile
+
+# 问题与期望模型发起的工具调用，调用之间互不依赖
+QUESTIONS = [
+    ("北京、上海、广州今天天气怎么样", [
+        ("check_weather", {"location": "北京"}),
+        ("check_weather", {"location": "上海"}),
+        ("check_weather", {"location": "广州"}),
+    ]),
+    ("从复旦大学江湾校区到五角场，坐公交和开车分别怎么走", [
+        ("public_transit_route", {"source_address": "复旦大学江湾校区", "destination_address": "五角场"}),
+        ("driving_route", {"source_address": "复旦大学江湾校区", "destination_address": "五角场"}),
+    ]),
+    ("现在几点了，杭州天气如何", [
+        ("current_time", {}),
+        ("check_weather", {"location": "杭州"}),
+    ]),
+]
+SCRIPT = dict(QUESTIONS)
+
+
+class ToolLoad:
+    """模拟工具的延迟，并记录同时执行的工具数"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def run(self, result):
+        with self._lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.latency)
+            return result
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+def make_tools(load):
+    @tool
+    def current_time() -> str:
+        """获取当前时间"""
+        return load.run(time.strftime("%Y-%m-%d %H:%M:%S"))
+
+    @tool
+    def check_weather(location: str) -> str:
+        """获取指定地点的天气信息"""
+        return load.run(json.dumps({"location": location, "condition": "晴", "temp_c": 22}, ensure_ascii=False))
+
+    @tool
+    def public_transit_route(source_address: str, destination_address: str) -> str:
+        """获取公共交通路线规划"""
+        return load.run(f"公交从{source_address}到{destination_address}：约35分钟")
+
+    @tool
+    def driving_route(source_address: str, destination_address: str) -> str:
+        """获取驾车路线规划"""
+        return load.run(f"驾车从{source_address}到{destination_address}：约15分钟")
+
+    return [current_time, check_weather, public_transit_route, driving_route]
+
+
+class ScriptedChatModel(BaseChatModel):
+    """按 SCRIPT 发起工具调用的聊天模型：本轮还没有工具结果时发起调用，有了结果后给出回答"""
+
+    latency: float = 0.2
+    calls: int = 0
+
+    @property
+    def _llm_type(self):
+        return "scripted"
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.latency)
+        self.calls += 1
+        last_human = max(i for i, message in enumerate(messages) if isinstance(message, HumanMessage))
+        question = messages[last_human].content
+        answered = any(isinstance(message, ToolMessage) for message in messages[last_human + 1:])
+        if answered or question not in SCRIPT:
+            message = AIMessage(content=f"根据查询结果回答：{question}")
+        else:
+            calls = [{"name": name, "args": arguments, "id": f"call_{uuid.uuid4().hex[:12]}"}
+                     for name, arguments in SCRIPT[question]]
+            message = AIMessage(content="", tool_calls=calls, additional_kwargs={"tool_calls": [
+                {"id": call["id"], "type": "function",
+                 "function": {"name": call["name"], "arguments": json.dumps(call["args"], ensure_ascii=False)}}
+                for call in calls]})
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+class NullView:
+    def append(self, text):
+        pass
+
+    def replace(self, text):
+        pass
+
+
+def run_engine(engine, model, load, turns):
+    latencies = []
+    for turn in range(turns):
+        question = QUESTIONS[turn % len(QUESTIONS)][0]
+        started = time.perf_counter()
+        engine.stream(question, NullView())
+        latencies.append((time.perf_counter() - started) * 1000)
+    return {
+        "engine": engine.name,
+        "turns": turns,
+        "p50": percentile(latencies, 0.5),
+        "p95": percentile(latencies, 0.95),
+        "mean": sum(latencies) / len(latencies),
+        "llm_calls": model.calls,
+        "tool_calls": load.calls,
+        "max_parallel": load.max_in_flight,
+        "history": engine.history_length(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LangGraph 引擎与 AgentExecutor 对比")
+    parser.add_argument("--turns", type=int, default=12)
+    parser.add_argument("--llm-latency-ms", type=float, default=200)
+    parser.add_argument("--tool-latency-ms", type=float, default=300)
+    parser.add_argument("--checkpoint", choices=["memory", "sqlite"], default="memory")
+    parser.add_argument("--db", default="data/benchmark-checkpoints.sqlite")
+    args = parser.parse_args()
+
+    system_prompt = "你是一个用于对话场景的智能助手"
+    reports = []
+    for kind in ("executor", "graph"):
+        load = ToolLoad(args.tool_latency_ms / 1000)
+        tools = make_tools(load)
+        model = ScriptedChatModel(latency=args.llm_latency_ms / 1000)
+        if kind == "executor":
+            engine = ExecutorEngine(model, tools, system_prompt)
+        else:
+            engine = GraphEngine(model, tools, system_prompt, checkpointer=make_checkpointer(args.checkpoint, args.db),
+                                 thread_id=f"benchmark-{uuid.uuid4().hex[:8]}")
+        reports.append(run_engine(engine, model, load, args.turns))
+
+    print(f"{'engine':>9} {'turns':>6} {'p50 ms':>8} {'p95 ms':>8} {'mean ms':>8} "
+          f"{'llm':>5} {'tools':>6} {'parallel':>9} {'history':>8}")
+    for report in reports:
+        print(f"{report['engine']:>9} {report['turns']:>6} {report['p50']:>8.0f} {report['p95']:>8.0f} "
+              f"{report['mean']:>8.0f} {report['llm_calls']:>5} {report['tool_calls']:>6} "
+              f"{report['max_parallel']:>9} {report['history']:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,11 @@
-import requests
-import json
 import os
 from datetime import datetime
 from dotenv import load_dotenv
 
+from metrics import tool_errors
+from toolResult import ToolResult
+from upstream import upstream, UpstreamError
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -13,123 +15,143 @@ WEATHER_API_KEY = os.getenv("WEATHER_API_KEY", "")
 # 请在.env文件中设置你在高德开放平台上申请的 Web服务 API key
 AMAP_API_KEY = os.getenv("AMAP_API_KEY", "")
 
+# 接口地址，可指向本地替身服务（standinServers.py）做离线压测
+WEATHER_BASE_URL = os.getenv("WEATHER_BASE_URL", "http://api.weatherapi.com").rstrip("/")
+AMAP_BASE_URL = os.getenv("AMAP_BASE_URL", "https://restapi.amap.com").rstrip("/")
+# 是否使用 weatherapi 的批量查询接口（需要付费套餐），否则多城市查询改为并发请求
+WEATHER_BULK = os.getenv("WEATHER_BULK", "false").lower() == "true"
+
 
 def get_time(parameters):
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return ToolResult(text=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
 
 
 def get_weather(parameters):
     try:
-        url = f"http://api.weatherapi.com/v1/current.json"
+        url = f"{WEATHER_BASE_URL}/v1/current.json"
         req_params = {
             "key": WEATHER_API_KEY,
             "q": parameters["location"],
             "aqi": "no"
         }
-        response = requests.get(url=url, params=req_params)
-        if response.status_code == 200:
-            data = response.json()
-            # print("weather", data)
-            return json.dumps(data)
-        else:
-            raise Exception("weatherapi 请求失败")
+        return ToolResult(upstream.get_json(url, req_params))
     except KeyError:
-        return "缺失函数参数，请提供所有要求参数后重试"
+        return ToolResult.error("缺失函数参数，请提供所有要求参数后重试")
+    except UpstreamError as e:
+        # 上游不可用时重试也没有意义，提示模型直接告知用户
+        tool_errors.inc("get_weather", type(e).__name__)
+        return ToolResult.error("天气服务暂时不可用，无法获取天气信息，请直接告知用户稍后再试")
+    except Exception as e:
+        tool_errors.inc("get_weather", type(e).__name__)
+        return ToolResult.error("获取天气信息失败，请重试")
+
+
+def get_weather_batch(locations):
+    """用 weatherapi 的批量接口一次查询多个城市，返回 {城市: ToolResult}
+
+    批量接口需要付费套餐，未开启 WEATHER_BULK 或请求失败时返回 None，由调用方改为逐个并发请求
+    """
+    if not WEATHER_BULK:
+        return None
+    try:
+        url = f"{WEATHER_BASE_URL}/v1/current.json"
+        body = {"locations": [{"q": location, "custom_id": str(index)} for index, location in enumerate(locations)]}
+        data = upstream.post_json(url, {"key": WEATHER_API_KEY, "q": "bulk"}, body)
+        results = {}
+        for item in data.get("bulk", ()):
+            query = item.get("query", {})
+            location = locations[int(query["custom_id"])]
+            if "current" in query:
+                results[location] = ToolResult({"location": query.get("location"), "current": query["current"]})
+            else:
+                results[location] = ToolResult.error(query.get("error", {}).get("message", "无数据"))
+        return results
     except Exception as e:
-        print(e)
-        return "获取天气信息失败，请重试"
+        # 批量接口失败时由调用方改为逐个请求，这里只计数
+        tool_errors.inc("get_weather_batch", type(e).__name__)
+        return None
 
 
 def get_coordinates_from_address(parameters):
     try:
-        url = f"https://restapi.amap.com/v3/geocode/geo"
+        url = f"{AMAP_BASE_URL}/v3/geocode/geo"
         req_params = {
             "key": AMAP_API_KEY,
             "address": parameters["address"],
         }
-        response = requests.get(url=url, params=req_params)
-        if response.status_code == 200:
-            data = response.json()
-            return json.dumps(data)
-        else:
-            raise Exception("amap 请求地址经纬度失败")
+        return ToolResult(upstream.get_json(url, req_params))
+    except UpstreamError as e:
+        tool_errors.inc("get_coordinates_from_address", type(e).__name__)
+        return ToolResult.error("地址解析服务暂时不可用，无法获取对应地址的位置经纬度，请直接告知用户稍后再试")
     except Exception as e:
-        print(e)
-        return "获取对应地址的位置经纬度失败，请重试"
+        tool_errors.inc("get_coordinates_from_address", type(e).__name__)
+        return ToolResult.error("获取对应地址的位置经纬度失败，请重试")
 
 
 def get_walking_route_planning(parameters):
     try:
-        url = f"https://restapi.amap.com/v3/direction/walking"
+        url = f"{AMAP_BASE_URL}/v3/direction/walking"
         req_params = {
             "key": AMAP_API_KEY,
             "origin": parameters["source"],
             "destination": parameters["destination"]
         }
-        response = requests.get(url=url, params=req_params)
-        if response.status_code == 200:
-            data = response.json()
-            return json.dumps(data)
-        else:
-            raise Exception("amap 请求步行路径规划失败")
+        return ToolResult(upstream.get_json(url, req_params))
+    except UpstreamError as e:
+        tool_errors.inc("get_walking_route_planning", type(e).__name__)
+        return ToolResult.error("路径规划服务暂时不可用，无法获取步行路径规划，请直接告知用户稍后再试")
     except Exception as e:
-        print(e)
-        return "获取步行路径规划失败，请重试"
+        tool_errors.inc("get_walking_route_planning", type(e).__name__)
+        return ToolResult.error("获取步行路径规划失败，请重试")
 
 
 def get_public_transportation_route_planning(parameters):
     try:
-        url = f"https://restapi.amap.com/v3/direction/transit/integrated"
+        url = f"{AMAP_BASE_URL}/v3/direction/transit/integrated"
         req_params = {
             "key": AMAP_API_KEY,
             "origin": parameters["source"],
             "destination": parameters["destination"],
             "city": parameters["city"]
         }
-        response = requests.get(url=url, params=req_params)
-        if response.status_code == 200:
-            data = response.json()
-            return json.dumps(data)
-        else:
-            raise Exception("amap 请求公共交通路径规划失败")
+        return ToolResult(upstream.get_json(url, req_params))
+    except UpstreamError as e:
+        tool_errors.inc("get_public_transportation_route_planning", type(e).__name__)
+        return ToolResult.error("路径规划服务暂时不可用，无法获取公共交通路径规划，请直接告知用户稍后再试")
     except Exception as e:
-        print(e)
-        return "获取公共交通路径规划失败，请重试"
+        tool_errors.inc("get_public_transportation_route_planning", type(e).__name__)
+        return ToolResult.error("获取公共交通路径规划失败，请重试")
 
 
 def get_drive_route_planning(parameters):
     try:
-        url = f"https://restapi.amap.com/v3/direction/driving"
+        url = f"{AMAP_BASE_URL}/v3/direction/driving"
         req_params = {
             "key": AMAP_API_KEY,
             "origin": parameters["source"],
             "destination": parameters["destination"],
         }
-        response = requests.get(url=url, params=req_params)
-        if response.status_code == 200:
-            data = response.json()
-            return json.dumps(data)
-        else:
-            raise Exception("amap 请求驾车路径规划失败")
+        return ToolResult(upstream.get_json(url, req_params))
+    except UpstreamError as e:
+        tool_errors.inc("get_drive_route_planning", type(e).__name__)
+        return ToolResult.error("路径规划服务暂时不可用，无法获取驾车路径规划，请直接告知用户稍后再试")
     except Exception as e:
-        print(e)
-        return "获取驾车路径规划失败，请重试"
+        tool_errors.inc("get_drive_route_planning", type(e).__name__)
+        return ToolResult.error("获取驾车路径规划失败，请重试")
 
 
 def get_bicycling_route_planning(parameters):
     try:
-        url = f"https://restapi.amap.com/v4/direction/bicycling"
+        url = f"{AMAP_BASE_URL}/v4/direction/bicycling"
         req_params = {
             "key": AMAP_API_KEY,
             "origin": parameters["source"],
             "destination": parameters["destination"],
         }
-        response = requests.get(url=url, params=req_params)
-        if response.status_code == 200:
-            data = response.json()
-            return json.dumps(data)
-        else:
-            raise Exception("amap 请求骑行路径规划失败")
+        return ToolResult(upstream.get_json(url, req_params))
+    except UpstreamError as e:
+        tool_errors.inc("get_bicycling_route_planning", type(e).__name__)
+        return ToolResult.error("路径规划服务暂时不可用，无法获取骑行路径规划，请直接告知用户稍后再试")
     except Exception as e:
-        print(e)
-        return "获取骑行路径规划失败，请重试"
+        tool_errors.inc("get_bicycling_route_planning", type(e).__name__)
+        return ToolResult.error("获取骑行路径规划失败，请重试")
@@ -1,16 +1,73 @@
-import json
 import os
+import random
+import threading
+import time
 from datetime import datetime
 from dotenv import load_dotenv
 
+from cancellation import current_token
+from metrics import tool_errors
+import mockPayloads
+from mockPayloads import LatencyModel
+from toolResult import ToolResult
+
 # Load environment variables from .env file
 load_dotenv()
 
+# 模拟数据的配置：
+# - instant：立即返回最简的数据（原来的行为）
+# - realistic / slow：按延迟分布等待，返回与真实接口结构和大小相近的数据（多方案、多分段的路线，按地点变化的天气）
+# MOCK_LATENCY_<类别>（GEOCODE / WEATHER / ROUTE / TRANSIT）可以单独覆盖延迟分布，格式同 standinServers.py
+MOCK_PROFILE = os.getenv("MOCK_PROFILE", "instant")
+MOCK_SEED = int(os.getenv("MOCK_SEED", "0"))
+
+MOCK_PROFILES = {
+    "instant": {},
+    "realistic": {"geocode": "lognormal:60,0.4", "weather": "lognormal:180,0.5",
+                  "route": "lognormal:150,0.5", "transit": "lognormal:260,0.5"},
+    "slow": {"geocode": "lognormal:200,0.8", "weather": "lognormal:600,0.8",
+             "route": "lognormal:500,0.8", "transit": "lognormal:900,0.8"},
+}
+
+
+class MockProfile:
+    """模拟工具的延迟与数据规模，同一 seed 下延迟序列和数据都可以复现"""
+
+    def __init__(self, name=MOCK_PROFILE, seed=MOCK_SEED):
+        if name not in MOCK_PROFILES:
+            raise ValueError(f"unknown mock profile {name}, expected one of {', '.join(MOCK_PROFILES)}")
+        self.name = name
+        self.seed = seed
+        self.production_payloads = name != "instant"
+        self.latency = {kind: LatencyModel(os.getenv(f"MOCK_LATENCY_{kind.upper()}",
+                                                     MOCK_PROFILES[name].get(kind, "fixed:0")))
+                        for kind in ("geocode", "weather", "route", "transit")}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self, kind):
+        """模拟一次上游请求的耗时；本轮被取消时提前结束"""
+        with self._lock:
+            seconds = self.latency[kind].sample(self._rng)
+        if seconds <= 0:
+            return
+        token = current_token()
+        if token:
+            token.wait([], timeout=seconds)
+        else:
+            time.sleep(seconds)
+
+
+profile = MockProfile()
+
+
 # Mock data for testing without API keys
 class MockData:
     @staticmethod
     def get_weather_data(location):
         """返回模拟的天气数据"""
+        if profile.production_payloads:
+            return mockPayloads.weather_data(location, seed=profile.seed)
         weather_data = {
             "location": {
                 "name": location,
@@ -54,6 +111,11 @@ class MockData:
         }
         return weather_data
     
+    @staticmethod
+    def get_weather_batch(locations):
+        """一次生成多个城市的模拟天气数据"""
+        return {location: MockData.get_weather_data(location) for location in locations}
+
     @staticmethod
     def get_coordinates_data(address):
         """返回模拟的地址坐标数据"""
@@ -107,8 +169,12 @@ class MockData:
         }
     
     @staticmethod
-    def get_route_data(source, destination, route_type="walking"):
+    def get_route_data(source, destination, route_type="walking", city="上海"):
         """返回模拟的路线规划数据"""
+        if profile.production_payloads:
+            if route_type == "transit":
+                return mockPayloads.amap_transit_payload(source, destination, city)
+            return mockPayloads.amap_route_payload(route_type, source, destination)
         # 计算两点之间的直线距离（简化版）
         def calculate_distance(src, dst):
             # 提取经度和纬度
@@ -176,33 +242,42 @@ class MockData:
 
 def get_time(parameters):
     """获取当前时间"""
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return ToolResult(text=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
 
 
 def get_weather(parameters):
     """获取天气信息（模拟数据）"""
     try:
         location = parameters["location"]
+        profile.delay("weather")
         # 使用模拟数据
         data = MockData.get_weather_data(location)
-        return json.dumps(data)
+        return ToolResult(data)
     except KeyError:
-        return "缺失函数参数，请提供所有要求参数后重试"
+        return ToolResult.error("缺失函数参数，请提供所有要求参数后重试")
     except Exception as e:
-        print(e)
-        return "获取天气信息失败，请重试"
+        tool_errors.inc("get_weather", type(e).__name__)
+        return ToolResult.error("获取天气信息失败，请重试")
+
+
+def get_weather_batch(locations):
+    """批量获取多个城市的天气信息（模拟数据），返回 {城市: ToolResult}"""
+    # 批量接口一次请求返回所有城市
+    profile.delay("weather")
+    return {location: ToolResult(data) for location, data in MockData.get_weather_batch(locations).items()}
 
 
 def get_coordinates_from_address(parameters):
     """获取地址的坐标（模拟数据）"""
     try:
         address = parameters["address"]
+        profile.delay("geocode")
         # 使用模拟数据
         data = MockData.get_coordinates_data(address)
-        return json.dumps(data)
+        return ToolResult(data)
     except Exception as e:
-        print(e)
-        return "获取对应地址的位置经纬度失败，请重试"
+        tool_errors.inc("get_coordinates_from_address", type(e).__name__)
+        return ToolResult.error("获取对应地址的位置经纬度失败，请重试")
 
 
 def get_walking_route_planning(parameters):
@@ -210,12 +285,13 @@ def get_walking_route_planning(parameters):
     try:
         source = parameters["source"]
         destination = parameters["destination"]
+        profile.delay("route")
         # 使用模拟数据
         data = MockData.get_route_data(source, destination, "walking")
-        return json.dumps(data)
+        return ToolResult(data)
     except Exception as e:
-        print(e)
-        return "获取步行路径规划失败，请重试"
+        tool_errors.inc("get_walking_route_planning", type(e).__name__)
+        return ToolResult.error("获取步行路径规划失败，请重试")
 
 
 def get_public_transportation_route_planning(parameters):
@@ -223,13 +299,13 @@ def get_public_transportation_route_planning(parameters):
     try:
         source = parameters["source"]
         destination = parameters["destination"]
-        # 城市参数在模拟数据中不使用
+        profile.delay("transit")
         # 使用模拟数据
-        data = MockData.get_route_data(source, destination, "transit")
-        return json.dumps(data)
+        data = MockData.get_route_data(source, destination, "transit", parameters.get("city", "上海"))
+        return ToolResult(data)
     except Exception as e:
-        print(e)
-        return "获取公共交通路径规划失败，请重试"
+        tool_errors.inc("get_public_transportation_route_planning", type(e).__name__)
+        return ToolResult.error("获取公共交通路径规划失败，请重试")
 
 
 def get_drive_route_planning(parameters):
@@ -237,12 +313,13 @@ def get_drive_route_planning(parameters):
     try:
         source = parameters["source"]
         destination = parameters["destination"]
+        profile.delay("route")
         # 使用模拟数据
         data = MockData.get_route_data(source, destination, "driving")
-        return json.dumps(data)
+        return ToolResult(data)
     except Exception as e:
-        print(e)
-        return "获取驾车路径规划失败，请重试"
+        tool_errors.inc("get_drive_route_planning", type(e).__name__)
+        return ToolResult.error("获取驾车路径规划失败，请重试")
 
 
 def get_bicycling_route_planning(parameters):
@@ -250,9 +327,10 @@ def get_bicycling_route_planning(parameters):
     try:
         source = parameters["source"]
         destination = parameters["destination"]
+        profile.delay("route")
         # 使用模拟数据
         data = MockData.get_route_data(source, destination, "bicycling")
-        return json.dumps(data)
+        return ToolResult(data)
     except Exception as e:
-        print(e)
-        return "获取骑行路径规划失败，请重试" 
\ No newline at end of file
+        tool_errors.inc("get_bicycling_route_planning", type(e).__name__)
+        return ToolResult.error("获取骑行路径规划失败，请重试") 
\ No newline at end of file
@@ -1,15 +1,18 @@
 from functionCallList import *
+from routePipeline import build_function_registry
 
 
-function_registry = {
+# 路线规划工具会在服务端自动完成地址解析，get_coordinates_from_address 只作为内部步骤
+function_registry = build_function_registry({
     "get_time": get_time,
     "get_weather": get_weather,
+    "get_weather_batch": get_weather_batch,
     "get_coordinates_from_address": get_coordinates_from_address,
     "get_walking_route_planning": get_walking_route_planning,
     "get_public_transportation_route_planning": get_public_transportation_route_planning,
     "get_drive_route_planning": get_drive_route_planning,
     "get_bicycling_route_planning": get_bicycling_route_planning
-}
+})
 
 function_desc = [
     {
@@ -39,17 +42,19 @@ function_desc = [
     {
         "type": "function",
         "function": {
-            "name": "get_coordinates_from_address",
-            "description": "将地址转换为经纬度坐标",
+            "name": "get_weather_bulk",
+            "description": "一次获取多个地点的天气信息，用于比较或同时询问多个城市的天气，返回一张表格",
             "parameters": {
                 "type": "object",
                 "properties": {
-                    "address": {
-                        "type": "string",
-                        "description": "详细地址，如复旦大学江湾校区、北京天安门等"
+                    "locations": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "maxItems": 10,
+                        "description": "需要查询天气的地点列表，如[\"北京\", \"上海\", \"杭州\"]"
                     }
                 },
-                "required": ["address"]
+                "required": ["locations"]
             }
         }
     },
@@ -57,7 +62,7 @@ function_desc = [
         "type": "function",
         "function": {
             "name": "get_walking_route_planning",
-            "description": "获取步行路线规划",
+            "description": "获取步行路线规划，可直接传入起点和终点地址，无需先查询经纬度",
             "parameters": {
                 "type": "object",
                 "properties": {
@@ -86,7 +91,7 @@ function_desc = [
         "type": "function",
         "function": {
             "name": "get_public_transportation_route_planning",
-            "description": "获取公共交通路线规划",
+            "description": "获取公共交通路线规划，可直接传入起点和终点地址，无需先查询经纬度",
             "parameters": {
                 "type": "object",
                 "properties": {
@@ -119,7 +124,7 @@ function_desc = [
         "type": "function",
         "function": {
             "name": "get_drive_route_planning",
-            "description": "获取驾车路线规划",
+            "description": "获取驾车路线规划，可直接传入起点和终点地址，无需先查询经纬度",
             "parameters": {
                 "type": "object",
                 "properties": {
@@ -148,7 +153,7 @@ function_desc = [
         "type": "function",
         "function": {
             "name": "get_bicycling_route_planning",
-            "description": "获取骑行路线规划",
+            "description": "获取骑行路线规划，可直接传入起点和终点地址，无需先查询经纬度",
             "parameters": {
                 "type": "object",
                 "properties": {
@@ -172,5 +177,31 @@ function_desc = [
                 "required": []
             }
         }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_nearby_places",
+            "description": "查询某个地点附近的地标、商圈、景点和学校等，结果按距离由近到远排列",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "address": {
+                        "type": "string",
+                        "description": "中心地点，如五角场、外滩"
+                    },
+                    "radius": {
+                        "type": "integer",
+                        "description": "搜索半径（米），默认2000，范围100到20000"
+                    },
+                    "limit": {
+                        "type": "integer",
+                        "description": "最多返回的地点数，默认5，最多20"
+                    }
+                },
+                "required": ["address"]
+            }
+        }
     }
 ]
+
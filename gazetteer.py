@@ -0,0 +1,315 @@
+import csv
+import math
+import mmap
+import os
+import struct
+import threading
+
+from toolResult import ToolResult
+
+GAZETTEER_CSV = os.getenv("GAZETTEER_CSV", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "gazetteer.csv"))
+GAZETTEER_PATH = os.getenv("GAZETTEER_PATH", os.path.splitext(GAZETTEER_CSV)[0] + ".bin")
+
+# 文件格式：头部（魔数、条目数）+ 定长记录（按名称排序）+ 字符串区
+# 记录：经度*1e6、纬度*1e6、名称偏移、名称长度、属性偏移、属性长度
+_HEADER = struct.Struct("<4sI")
+_RECORD = struct.Struct("<iiIHIH")
+_MAGIC = b"GZT1"
+_META_FIELDS = ("province", "city", "citycode", "district", "adcode", "level")
+
+# 网格索引的格子大小（度），约 2 公里
+_CELL = 0.02
+# 附近地点查询的半径（米）与条数范围，扫描的格子数随半径平方增长，超出范围的参数被截断
+MIN_RADIUS_M = 100
+MAX_RADIUS_M = 20000
+MAX_NEARBY = 20
+
+
+def build(csv_path=GAZETTEER_CSV, bin_path=GAZETTEER_PATH):
+    """把 CSV 格式的地名表编译为紧凑的二进制文件"""
+    with open(csv_path, encoding="utf-8") as f:
+        rows = sorted(csv.DictReader(f), key=lambda row: row["name"].encode("utf-8"))
+
+    strings = bytearray()
+    records = []
+    for row in rows:
+        name = row["name"].encode("utf-8")
+        meta = "|".join(row[field] for field in _META_FIELDS).encode("utf-8")
+        name_offset = len(strings)
+        strings += name
+        meta_offset = len(strings)
+        strings += meta
+        records.append(_RECORD.pack(round(float(row["lon"]) * 1e6), round(float(row["lat"]) * 1e6),
+                                    name_offset, len(name), meta_offset, len(meta)))
+
+    tmp_path = bin_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, len(records)))
+        f.write(b"".join(records))
+        f.write(strings)
+    os.replace(tmp_path, bin_path)
+
+
+def distance_m(lon1, lat1, lon2, lat2):
+    """小范围内足够精确的等距矩形近似"""
+    dx = (lon2 - lon1) * 111320 * math.cos(math.radians((lat1 + lat2) / 2))
+    dy = (lat2 - lat1) * 110540
+    return math.hypot(dx, dy)
+
+
+class Gazetteer:
+    """内存映射的离线地名库
+
+    - 记录按名称（UTF-8 字节）排序，精确查找和“文本中包含的最长地名”查找都在文件上二分，
+      加载时不在内存中重建名称索引
+    - 网格索引支持最近地点查询和逆地理编码
+    """
+
+    def __init__(self, path=GAZETTEER_PATH):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = _HEADER.unpack_from(self._mm, 0)
+        if magic != _MAGIC:
+            raise ValueError(f"{path} 不是地名库文件")
+        self._strings_offset = _HEADER.size + self.count * _RECORD.size
+        self._grid = {}
+        self._cities = set()
+        for index in range(self.count):
+            if self.place(index)["level"] == "城市":
+                self._cities.add(index)
+            lon, lat = self.location(index)
+            self._grid.setdefault(self._cell(lon, lat), []).append(index)
+
+    def _record(self, index):
+        return _RECORD.unpack_from(self._mm, _HEADER.size + index * _RECORD.size)
+
+    def _string(self, offset, length):
+        start = self._strings_offset + offset
+        return self._mm[start:start + length].decode("utf-8")
+
+    def _name_bytes(self, index):
+        _, _, name_offset, name_length, _, _ = self._record(index)
+        start = self._strings_offset + name_offset
+        return self._mm[start:start + name_length]
+
+    def _lower_bound(self, key):
+        """第一个名称不小于 key（UTF-8 字节）的记录下标"""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._name_bytes(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _prefix_matches(self, text):
+        """依次产出 text 的前缀中是地名的 (记录下标, 前缀长度)，没有地名以该前缀开头时停止"""
+        for length in range(1, len(text) + 1):
+            key = text[:length].encode("utf-8")
+            index = self._lower_bound(key)
+            if index == self.count:
+                return
+            name = self._name_bytes(index)
+            if not name.startswith(key):
+                return
+            if name == key:
+                yield index, length
+
+    def name(self, index):
+        _, _, name_offset, name_length, _, _ = self._record(index)
+        return self._string(name_offset, name_length)
+
+    def location(self, index):
+        lon, lat, _, _, _, _ = self._record(index)
+        return lon / 1e6, lat / 1e6
+
+    def place(self, index):
+        lon, lat, name_offset, name_length, meta_offset, meta_length = self._record(index)
+        place = dict(zip(_META_FIELDS, self._string(meta_offset, meta_length).split("|")))
+        place["name"] = self._string(name_offset, name_length)
+        place["location"] = f"{lon / 1e6:.6f},{lat / 1e6:.6f}"
+        return place
+
+    def lookup(self, name):
+        if not name:
+            return None
+        key = name.encode("utf-8")
+        index = self._lower_bound(key)
+        if index < self.count and self._name_bytes(index) == key:
+            return index
+        return None
+
+    def longest_match(self, text):
+        """文本中包含的最长地名，返回 (记录下标, 名称长度)"""
+        best = (None, 0)
+        for start in range(len(text)):
+            for index, length in self._prefix_matches(text[start:]):
+                if length > best[1]:
+                    best = (index, length)
+        return best
+
+    def _strip_city(self, address):
+        """去掉开头的城市名（如“上海市外滩”中的“上海市”），只剩城市名时原样返回"""
+        for index, length in self._prefix_matches(address):
+            if index in self._cities:
+                rest = address[length:].lstrip("市")
+                if rest:
+                    return rest
+        return address
+
+    def geocode(self, address, min_coverage=0.6):
+        """地址能可靠地对应到地名库中的条目时返回记录下标
+
+        非精确匹配时，去掉城市名后地址中包含的最长地名需要覆盖大部分文字，
+        避免“五角场万达广场旁的咖啡店”被当成“五角场”。
+        """
+        address = address.strip()
+        index = self.lookup(address)
+        if index is not None:
+            return index
+        address = self._strip_city(address)
+        index = self.lookup(address)
+        if index is not None:
+            return index
+        index, length = self.longest_match(address)
+        if index is None:
+            return None
+        if length / len(address) >= min_coverage:
+            return index
+        return None
+
+    @staticmethod
+    def _cell(lon, lat):
+        return int(math.floor(lon / _CELL)), int(math.floor(lat / _CELL))
+
+    def nearest(self, lon, lat, limit=5, radius_m=3000, exclude=(), skip_cities=True):
+        """半径内最近的若干地点，返回 [(距离米, 记录下标)]，由近到远；默认不含城市本身"""
+        cx, cy = self._cell(lon, lat)
+        cell_m = _CELL * 110540 * min(1.0, math.cos(math.radians(lat)))
+        max_ring = int(radius_m / cell_m) + 1
+        found = []
+        for ring in range(max_ring + 1):
+            for x in range(cx - ring, cx + ring + 1):
+                for y in range(cy - ring, cy + ring + 1):
+                    if max(abs(x - cx), abs(y - cy)) != ring:
+                        continue
+                    for index in self._grid.get((x, y), ()):
+                        if index in exclude or (skip_cities and index in self._cities):
+                            continue
+                        distance = distance_m(lon, lat, *self.location(index))
+                        if distance <= radius_m:
+                            found.append((distance, index))
+            # 已找到足够的地点，且下一圈格子不可能更近时停止扩展
+            found.sort()
+            if len(found) >= limit and found[limit - 1][0] <= ring * cell_m:
+                break
+        return found[:limit]
+
+    def reverse(self, lon, lat, radius_m=1000):
+        """逆地理编码：最近的地点，没有时返回 None"""
+        nearest = self.nearest(lon, lat, limit=1, radius_m=radius_m, skip_cities=False)
+        return nearest[0][1] if nearest else None
+
+
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+
+
+def load_gazetteer():
+    """加载默认地名库，二进制文件缺失或比 CSV 旧时重新编译；没有数据时返回 None"""
+    global _gazetteer
+    with _gazetteer_lock:
+        if _gazetteer is None:
+            try:
+                if not os.path.exists(GAZETTEER_PATH) or (
+                        os.path.exists(GAZETTEER_CSV)
+                        and os.path.getmtime(GAZETTEER_CSV) > os.path.getmtime(GAZETTEER_PATH)):
+                    build()
+                _gazetteer = Gazetteer()
+            except (OSError, ValueError) as e:
+                print(e)
+                return None
+        return _gazetteer
+
+
+def geocode_payload(place, address):
+    """构造与高德地理编码接口一致的返回结构"""
+    return {
+        "status": "1",
+        "info": "OK",
+        "infocode": "10000",
+        "count": "1",
+        "geocodes": [{
+            "formatted_address": address,
+            "country": "中国",
+            "province": place["province"],
+            "citycode": place["citycode"],
+            "city": place["city"],
+            "district": place["district"] or [],
+            "adcode": place["adcode"],
+            "location": place["location"],
+            "level": place["level"],
+        }]
+    }
+
+
+def with_gazetteer(geocode_fn):
+    """地理编码先查离线地名库，查不到再走原来的接口"""
+    def get_coordinates_from_address(parameters):
+        gazetteer = load_gazetteer()
+        address = parameters.get("address", "")
+        if gazetteer is not None and address:
+            index = gazetteer.geocode(address)
+            if index is not None:
+                return ToolResult(geocode_payload(gazetteer.place(index), address))
+        return geocode_fn(parameters)
+
+    get_coordinates_from_address.__doc__ = geocode_fn.__doc__
+    return get_coordinates_from_address
+
+
+def _parse_location(text):
+    """'经度,纬度' 格式的坐标，其他文字返回 None"""
+    try:
+        lon, lat = (float(value) for value in text.split(","))
+    except ValueError:
+        return None
+    return lon, lat
+
+
+def make_nearby_tool(resolve_fn):
+    """查询某地附近的地点；resolve_fn 把地址解析为 '经度,纬度'"""
+    def get_nearby_places(parameters):
+        gazetteer = load_gazetteer()
+        if gazetteer is None:
+            return ToolResult.error("离线地名库不可用，无法查询附近地点")
+        try:
+            address = parameters["address"]
+            radius = min(max(float(parameters.get("radius") or 2000), MIN_RADIUS_M), MAX_RADIUS_M)
+            limit = min(max(int(parameters.get("limit") or 5), 1), MAX_NEARBY)
+        except (KeyError, ValueError):
+            return ToolResult.error("缺失函数参数，请提供所有要求参数后重试")
+
+        center = gazetteer.geocode(address)
+        location = gazetteer.location(center) if center is not None else _parse_location(address)
+        if location is None:
+            resolved = resolve_fn(address)
+            if resolved is None:
+                return ToolResult.error("无法获取地址坐标，请检查地址是否正确")
+            location = _parse_location(resolved)
+
+        exclude = (center,) if center is not None else ()
+        places = []
+        for distance, index in gazetteer.nearest(*location, limit=limit, radius_m=radius, exclude=exclude):
+            place = gazetteer.place(index)
+            places.append({
+                "name": place["name"],
+                "distance": int(distance),
+                "district": place["district"],
+                "level": place["level"],
+                "location": place["location"],
+            })
+        return ToolResult({"center": address, "radius": int(radius), "places": places})
+
+    return get_nearby_places
@@ -0,0 +1,136 @@
+import json
+import time
+
+from routePipeline import ROUTE_TOOLS
+
+# 关键词 -> 相关工具，命中任意关键词即把对应工具加入本次请求
+TOOL_KEYWORDS = {
+    "get_time": ["几点", "时间", "日期", "几号", "星期几", "礼拜几", "what time", "date"],
+    "get_weather": ["天气", "气温", "温度", "下雨", "下雪", "带伞", "冷不冷", "热不热", "湿度",
+                    "刮风", "空气", "weather", "rain", "temperature"],
+    "route": ["怎么走", "怎么去", "路线", "出行", "步行", "走路", "开车", "驾车", "骑行", "骑车",
+              "自行车", "公交", "地铁", "打车", "多远", "到达", "导航", "route", "get from", "drive"],
+    "get_nearby_places": ["附近", "周边", "旁边", "周围", "nearby", "near"],
+}
+
+# 闲聊关键词：没有命中任何工具关键词且命中这些时，本次请求不带工具
+CHITCHAT_KEYWORDS = ["你好", "您好", "谢谢", "多谢", "再见", "你是谁", "哈哈", "早上好", "晚上好",
+                     "hello", "thanks", "thank you"]
+
+
+class KeywordTrie:
+    """字符级前缀树，一次扫描找出文本中命中的所有关键词标签"""
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, keyword, label):
+        node = self.root
+        for char in keyword.lower():
+            node = node.setdefault(char, {})
+        node.setdefault(None, set()).add(label)
+
+    def match(self, text):
+        text = text.lower()
+        labels = set()
+        for start in range(len(text)):
+            node = self.root
+            for char in text[start:]:
+                node = node.get(char)
+                if node is None:
+                    break
+                labels.update(node.get(None, ()))
+        return labels
+
+
+def estimate_tokens(text):
+    """粗略估算 token 数：非 ASCII 字符约 1 token/字，ASCII 约 4 字符/token"""
+    non_ascii = sum(1 for char in text if ord(char) > 127)
+    return non_ascii + (len(text) - non_ascii + 3) // 4
+
+
+class RouteDecision:
+    """一次路由结果：本次请求携带的工具子集，以及可以在本地预先执行的工具调用"""
+
+    def __init__(self, tools, local_calls, saved_tokens):
+        self.tools = tools
+        self.local_calls = local_calls
+        self.saved_tokens = saved_tokens
+
+
+class RoutingStats:
+    def __init__(self):
+        self.requests = 0
+        self.saved_tokens = 0
+        self.local_answers = 0
+        self.saved_seconds = 0.0
+        self.classify_seconds = 0.0
+
+    def summary(self):
+        return (f"tool routing saved ~{self.saved_tokens} prompt tokens, "
+                f"{self.local_answers} local tool rounds (~{self.saved_seconds:.1f}s), "
+                f"classifier cost {self.classify_seconds * 1000:.1f}ms")
+
+
+class IntentRouter:
+    """本地意图预分类，只把相关的工具描述发送给模型
+
+    - 命中工具关键词：只发送相关工具；get_time 直接在本地执行，不再占用一次模型往返
+    - 只命中闲聊关键词：不发送任何工具
+    - 都没有命中：沿用上一轮的工具子集（追问场景），没有上一轮时发送全部工具
+    """
+
+    def __init__(self, tools):
+        self.tools = tools
+        self.full_tokens = estimate_tokens(json.dumps(tools, ensure_ascii=False))
+        self.tool_trie = KeywordTrie()
+        for label, keywords in TOOL_KEYWORDS.items():
+            for keyword in keywords:
+                self.tool_trie.add(keyword, label)
+        self.chitchat_trie = KeywordTrie()
+        for keyword in CHITCHAT_KEYWORDS:
+            self.chitchat_trie.add(keyword, "chitchat")
+        self.last_names = None
+        self.stats = RoutingStats()
+
+    def route(self, user_input):
+        started = time.perf_counter()
+        labels = self.tool_trie.match(user_input)
+        local_calls = []
+
+        if labels:
+            names = set()
+            if "get_time" in labels:
+                local_calls.append(("get_time", {}))
+            if "get_weather" in labels:
+                names.update(("get_weather", "get_weather_bulk"))
+            if "route" in labels:
+                names.update(ROUTE_TOOLS)
+            if "get_nearby_places" in labels:
+                names.add("get_nearby_places")
+            self.last_names = names
+        elif self.chitchat_trie.match(user_input):
+            names = set()
+        elif self.last_names is not None:
+            names = self.last_names
+        else:
+            names = None
+
+        if names is None:
+            tools = self.tools
+        else:
+            # 保持工具在完整列表中的顺序，同样的子集序列化结果完全一致
+            tools = [tool for tool in self.tools if tool["function"]["name"] in names]
+        saved_tokens = self.full_tokens
+        if tools:
+            saved_tokens -= estimate_tokens(json.dumps(tools, ensure_ascii=False))
+
+        self.stats.requests += 1
+        self.stats.saved_tokens += saved_tokens
+        self.stats.classify_seconds += time.perf_counter() - started
+        return RouteDecision(tools, local_calls, saved_tokens)
+
+    def record_local_round(self, round_seconds):
+        """记录一次在本地完成、省掉模型往返的工具调用"""
+        self.stats.local_answers += 1
+        self.stats.saved_seconds += round_seconds
@@ -0,0 +1,315 @@
+import json
+import os
+import sqlite3
+from typing import Annotated, TypedDict
+
+from langchain.agents import AgentExecutor, create_openai_tools_agent
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.graph import END, START, StateGraph
+from langgraph.graph.message import add_messages
+from langgraph.types import Send
+
+from cancellation import current_token
+from tokenBudget import REPLY_PRIMER, ContextGuard, get_tokenizer, message_tokens
+
+# run_langchain.py 使用的引擎：graph（LangGraph，工具并行执行，历史保存在检查点）或 executor（原来的 AgentExecutor）
+LANGCHAIN_ENGINE = os.getenv("LANGCHAIN_ENGINE", "graph")
+# 检查点：memory 只在进程内有效；sqlite 保存到 LANGGRAPH_DB，重启后用同一个 LANGGRAPH_THREAD 继续对话
+LANGGRAPH_CHECKPOINT = os.getenv("LANGGRAPH_CHECKPOINT", "memory")
+LANGGRAPH_DB = os.getenv("LANGGRAPH_DB", "data/checkpoints.sqlite")
+LANGGRAPH_THREAD = os.getenv("LANGGRAPH_THREAD", "default")
+# 一轮内最多的模型调用次数与同时执行的工具数
+LANGGRAPH_MAX_STEPS = int(os.getenv("LANGGRAPH_MAX_STEPS", os.getenv("AGENT_MAX_STEPS", "4")))
+LANGGRAPH_MAX_CONCURRENCY = int(os.getenv("LANGGRAPH_MAX_CONCURRENCY", "8"))
+
+INTERRUPTED_MARK = "……（回答已中断）"
+TOOL_CANCELLED = "（工具调用已取消）"
+
+
+def make_checkpointer(kind=LANGGRAPH_CHECKPOINT, path=LANGGRAPH_DB):
+    """memory：MemorySaver；sqlite：本地 SQLite 文件（需要 langgraph-checkpoint-sqlite）"""
+    if kind == "memory":
+        return MemorySaver()
+    if kind == "sqlite":
+        from langgraph.checkpoint.sqlite import SqliteSaver
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # 并行的工具节点在线程池中运行，检查点写入发生在不同线程
+        return SqliteSaver(sqlite3.connect(path, check_same_thread=False))
+    raise ValueError(f"unknown checkpointer {kind}")
+
+
+def _stream_text(chunk):
+    """从 AgentExecutor.stream 的输出中取出文本，返回 (文本, 是否为增量)"""
+    if isinstance(chunk, dict) and "output" in chunk:
+        return chunk["output"], False
+    if hasattr(chunk, "content") and chunk.content:
+        return chunk.content, False
+    if isinstance(chunk, str):
+        return chunk, True
+    return None, False
+
+
+class HistoryBudget:
+    """LangChain 消息历史的上下文预算
+
+    每条消息只计数一次（按消息 id 缓存），超出 ContextGuard.budget 时从最早的一轮开始整轮丢弃，
+    只影响发送给模型的消息，检查点和 chat_history 中保留完整历史。
+    TOKEN_LOG 开启时每次请求的 token 数记入 notices，由 run_langchain.py 在每轮结束后用 take_notices() 取出展示。
+    """
+
+    def __init__(self, system_prompt, tools, guard=None):
+        self.guard = guard or ContextGuard()
+        self.tokenizer = get_tokenizer()
+        tools_text = json.dumps([convert_to_openai_tool(tool) for tool in tools], ensure_ascii=False)
+        self.fixed_tokens = (message_tokens({"content": system_prompt}, self.tokenizer)
+                             + self.tokenizer.count(tools_text) + REPLY_PRIMER)
+        self._costs = {}
+        self.dropped = 0
+        self.notices = []
+
+    def _cost(self, message):
+        key = message.id or id(message)
+        if key not in self._costs:
+            content = message.content if isinstance(message.content, str) else json.dumps(message.content,
+                                                                                          ensure_ascii=False)
+            calls = [{"function": {"name": call["name"], "arguments": json.dumps(call["args"], ensure_ascii=False)}}
+                     for call in getattr(message, "tool_calls", None) or ()]
+            self._costs[key] = message_tokens({"content": content, "tool_calls": calls,
+                                               "tool_call_id": getattr(message, "tool_call_id", None)},
+                                              self.tokenizer)
+        return self._costs[key]
+
+    def fit(self, messages, pending=""):
+        """返回放得进预算的消息后缀；pending 为还没有加入 messages 的当前问题"""
+        costs = [self._cost(message) for message in messages]
+        tokens = self.fixed_tokens + sum(costs)
+        starts = [i for i, message in enumerate(messages) if isinstance(message, HumanMessage)]
+        if pending:
+            tokens += message_tokens({"content": pending}, self.tokenizer)
+            starts.append(len(messages))
+        start = 0
+        # 最后一轮（当前问题）始终保留，丢弃的部分以 HumanMessage 为界，不拆开工具调用与结果
+        for boundary in starts[1:]:
+            if tokens <= self.guard.budget:
+                break
+            tokens -= sum(costs[start:boundary])
+            start = boundary
+        if start:
+            self.dropped += start
+        if self.guard.log:
+            self.notices.append(f"context {tokens}/{self.guard.budget} tokens, {len(messages) - start} messages"
+                                + (f" ({start} dropped)" if start else ""))
+        return messages[start:]
+
+    def take_notices(self):
+        """取出上次调用之后记录的说明"""
+        notices, self.notices = self.notices, []
+        return notices
+
+
+class ExecutorEngine:
+    """原来的实现：每轮创建 AgentExecutor，工具按顺序执行，历史保存在列表中"""
+
+    name = "executor"
+
+    def __init__(self, model, tools, system_prompt):
+        self.tools = tools
+        self.prompt = ChatPromptTemplate.from_messages([
+            ("system", system_prompt),
+            MessagesPlaceholder(variable_name="chat_history"),
+            ("human", "{input}"),
+            MessagesPlaceholder(variable_name="agent_scratchpad")
+        ])
+        self.model = model
+        self.chat_history = []
+        self.budget = HistoryBudget(system_prompt, tools)
+
+    def stream(self, user_input, view):
+        """执行一轮，文本写入 view（streamRenderer.RenderSession），返回完整回答"""
+        agent = create_openai_tools_agent(self.model, self.tools, self.prompt)
+        agent_executor = AgentExecutor.from_agent_and_tools(
+            agent=agent,
+            tools=self.tools,
+            verbose=False,
+            return_intermediate_steps=True,
+            handle_parsing_errors=True
+        )
+        response_text = ""
+        token = current_token()
+        # 本轮内的工具结果在 agent_scratchpad 中，不在预算控制范围内
+        chat_history = self.budget.fit(self.chat_history, pending=user_input)
+        for chunk in agent_executor.stream({"input": user_input, "chat_history": chat_history}):
+            if token:
+                token.check()
+            text, incremental = _stream_text(chunk)
+            if not text:
+                continue
+            if incremental:
+                response_text += text
+                view.append(text)
+            elif text != response_text:
+                response_text = text
+                view.replace(response_text)
+        self.chat_history.append(HumanMessage(content=user_input))
+        self.chat_history.append(AIMessage(content=response_text))
+        return response_text
+
+    def interrupt(self, user_input, partial):
+        """保留已生成的部分回答，会话继续"""
+        if partial:
+            self.chat_history.append(HumanMessage(content=user_input))
+            self.chat_history.append(AIMessage(content=partial + INTERRUPTED_MARK))
+
+    def history_length(self):
+        return len(self.chat_history)
+
+
+# 汇总节点写入该值表示清空工具结果（不用 None，避免被当作“没有更新”跳过）
+CLEAR_RESULTS = "clear"
+
+
+def _merge_tool_results(current, update):
+    """并行的工具节点各自追加结果，汇总节点写入 CLEAR_RESULTS 清空"""
+    if update == CLEAR_RESULTS:
+        return []
+    return (current or []) + update
+
+
+class AgentState(TypedDict):
+    messages: Annotated[list, add_messages]
+    tool_results: Annotated[list, _merge_tool_results]
+
+
+class GraphEngine:
+    """基于 LangGraph 的引擎
+
+    agent ──有工具调用──▶ tool × N（Send 分发，同一步内并行执行）──▶ collect ──▶ agent
+      └──────没有工具调用──▶ END
+
+    - collect 按模型给出的工具调用顺序生成 ToolMessage，结果顺序与执行快慢无关
+    - 对话历史保存在检查点中（thread_id 区分会话），每轮只传入新的用户问题；
+      SQLite 检查点在重启后可以直接续上之前的对话
+    - 与 AgentLoop 相同，第 max_steps 次模型调用使用 tool_choice="none"，必须直接回答，
+      recursion_limit 只是兜底；中途出错时由 interrupt() 补齐历史
+    """
+
+    name = "graph"
+
+    def __init__(self, model, tools, system_prompt, checkpointer=None, thread_id=LANGGRAPH_THREAD,
+                 max_steps=LANGGRAPH_MAX_STEPS, max_concurrency=LANGGRAPH_MAX_CONCURRENCY):
+        self.model = model.bind_tools(tools)
+        self.answer_model = model.bind_tools(tools, tool_choice="none")
+        self.max_steps = max_steps
+        self.tools_by_name = {tool.name: tool for tool in tools}
+        self.system_message = SystemMessage(content=system_prompt)
+        self.budget = HistoryBudget(system_prompt, tools)
+        self.checkpointer = checkpointer if checkpointer is not None else MemorySaver()
+        self.config = {
+            "configurable": {"thread_id": thread_id},
+            # 每一步经过 agent、tool、collect 三个节点
+            "recursion_limit": max_steps * 3 + 1,
+            "max_concurrency": max_concurrency,
+        }
+        self.graph = self._build()
+
+    def _build(self):
+        graph = StateGraph(AgentState)
+        graph.add_node("agent", self._agent)
+        graph.add_node("tool", self._tool)
+        graph.add_node("collect", self._collect)
+        graph.add_edge(START, "agent")
+        graph.add_conditional_edges("agent", self._fan_out, ["tool", END])
+        graph.add_edge("tool", "collect")
+        graph.add_edge("collect", "agent")
+        return graph.compile(checkpointer=self.checkpointer)
+
+    def _agent(self, state, config):
+        messages = state["messages"]
+        last_human = max((i for i, message in enumerate(messages) if isinstance(message, HumanMessage)), default=-1)
+        steps = sum(1 for message in messages[last_human + 1:] if isinstance(message, AIMessage))
+        last_step = steps >= self.max_steps - 1
+        model = self.answer_model if last_step else self.model
+        response = model.invoke([self.system_message] + self.budget.fit(messages), config)
+        if last_step and response.tool_calls:
+            # 最后一步即使模型仍返回 tool_calls 也不再执行，保证历史消息合法
+            response = AIMessage(content=response.content, id=response.id)
+        return {"messages": [response]}
+
+    @staticmethod
+    def _fan_out(state):
+        calls = state["messages"][-1].tool_calls
+        if not calls:
+            return END
+        return [Send("tool", call) for call in calls]
+
+    def _tool(self, call):
+        token = current_token()
+        if token:
+            token.check()
+        tool = self.tools_by_name.get(call["name"])
+        if tool is None:
+            content = f"无法调用函数 {call['name']}，请检查函数名和参数"
+        else:
+            try:
+                content = tool.invoke(call["args"])
+            except Exception as e:
+                content = f"工具调用失败：{e}"
+        return {"tool_results": [{"id": call["id"], "content": str(content)}]}
+
+    @staticmethod
+    def _collect(state):
+        calls = state["messages"][-1].tool_calls
+        results = {result["id"]: result["content"] for result in state.get("tool_results") or ()}
+        messages = [ToolMessage(content=results.get(call["id"], TOOL_CANCELLED), tool_call_id=call["id"])
+                    for call in calls]
+        return {"messages": messages, "tool_results": CLEAR_RESULTS}
+
+    def stream(self, user_input, view):
+        response_text = ""
+        token = current_token()
+        for chunk, metadata in self.graph.stream({"messages": [HumanMessage(content=user_input)]},
+                                                 self.config, stream_mode="messages"):
+            if token:
+                token.check()
+            if metadata.get("langgraph_node") != "agent" or not isinstance(chunk.content, str):
+                continue
+            if chunk.content:
+                response_text += chunk.content
+                view.append(chunk.content)
+        # 工具调用前模型也可能输出文本，以最后一条回答为准
+        final = self.graph.get_state(self.config).values["messages"][-1]
+        if isinstance(final, AIMessage) and final.content != response_text:
+            view.replace(final.content)
+            response_text = final.content
+        return response_text
+
+    def interrupt(self, user_input, partial):
+        """被取消或出错的轮次：补齐未完成的工具结果，保留已生成的部分回答，保证下一轮的历史合法"""
+        messages = self.graph.get_state(self.config).values.get("messages") or []
+        if not messages:
+            return
+        repairs = []
+        last = messages[-1]
+        if isinstance(last, AIMessage) and last.tool_calls:
+            repairs = [ToolMessage(content=TOOL_CANCELLED, tool_call_id=call["id"]) for call in last.tool_calls]
+        if partial or repairs:
+            repairs.append(AIMessage(content=(partial or "") + INTERRUPTED_MARK))
+        if repairs:
+            # 以 agent 的身份写入：最后一条是没有工具调用的回答，图停在 END，没有待执行的节点
+            self.graph.update_state(self.config, {"messages": repairs, "tool_results": CLEAR_RESULTS}, as_node="agent")
+
+    def history_length(self):
+        return len(self.graph.get_state(self.config).values.get("messages") or [])
+
+
+def make_engine(kind, model, tools, system_prompt):
+    if kind == "executor":
+        return ExecutorEngine(model, tools, system_prompt)
+    if kind == "graph":
+        return GraphEngine(model, tools, system_prompt, checkpointer=make_checkpointer())
+    raise ValueError(f"unknown engine {kind}")
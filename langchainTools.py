@@ -0,0 +1,108 @@
+from typing import List
+
+from langchain_core.tools import tool
+
+
+def make_langchain_tools(tool_registry):
+    """run_langchain.py 使用的 LangChain 工具，调用 tool_registry（function_registry）中的函数
+
+    loadTest.py 用同一组工具驱动 LangChain 引擎。
+    """
+    @tool
+    def current_time() -> str:
+        """获取当前时间"""
+        result = tool_registry["get_time"]({})
+        return result.content
+
+    @tool
+    def check_weather(location: str) -> str:
+        """
+        获取指定地点的天气信息
+        Args:
+            location: 需要查询天气的地点，如杭州、上海、北京等
+        """
+        result = tool_registry["get_weather"]({"location": location})
+        return result.content
+
+    @tool
+    def compare_weather(locations: List[str]) -> str:
+        """
+        一次获取多个地点的天气信息，用于比较或同时询问多个城市的天气
+        Args:
+            locations: 需要查询天气的地点列表，如["北京", "上海", "杭州"]
+        """
+        result = tool_registry["get_weather_bulk"]({"locations": locations})
+        return result.content
+
+    def plan_route(tool_name, mode, source_address, destination_address, **extra):
+        """地址解析（走缓存）和路线规划在一次工具调用内完成"""
+        result = tool_registry[tool_name]({
+            "source_address": source_address,
+            "destination_address": destination_address,
+            **extra
+        })
+        return f"{mode}从{source_address}到{destination_address}的路线：\n{result}"
+
+    @tool
+    def walking_route(source_address: str, destination_address: str) -> str:
+        """
+        获取步行路线规划
+        Args:
+            source_address: 起点地址，如复旦大学江湾校区
+            destination_address: 终点地址，如五角场
+        """
+        return plan_route("get_walking_route_planning", "步行", source_address, destination_address)
+
+    @tool
+    def public_transit_route(source_address: str, destination_address: str, city: str = "上海") -> str:
+        """
+        获取公共交通路线规划
+        Args:
+            source_address: 起点地址，如复旦大学江湾校区
+            destination_address: 终点地址，如五角场
+            city: 城市名称，如上海、北京等，默认为上海
+        """
+        return plan_route("get_public_transportation_route_planning", "公共交通",
+                          source_address, destination_address, city=city)
+
+    @tool
+    def driving_route(source_address: str, destination_address: str) -> str:
+        """
+        获取驾车路线规划
+        Args:
+            source_address: 起点地址，如复旦大学江湾校区
+            destination_address: 终点地址，如五角场
+        """
+        return plan_route("get_drive_route_planning", "驾车", source_address, destination_address)
+
+    @tool
+    def bicycle_route(source_address: str, destination_address: str) -> str:
+        """
+        获取骑行路线规划
+        Args:
+            source_address: 起点地址，如复旦大学江湾校区
+            destination_address: 终点地址，如五角场
+        """
+        return plan_route("get_bicycling_route_planning", "骑行", source_address, destination_address)
+
+    @tool
+    def nearby_places(address: str, radius: int = 2000) -> str:
+        """
+        查询某个地点附近的地标、商圈、景点和学校等
+        Args:
+            address: 中心地点，如五角场、外滩
+            radius: 搜索半径（米），默认2000，范围100到20000
+        """
+        result = tool_registry["get_nearby_places"]({"address": address, "radius": radius})
+        return result.content
+
+    return [
+        current_time,
+        check_weather,
+        compare_weather,
+        walking_route,
+        public_transit_route,
+        driving_route,
+        bicycle_route,
+        nearby_places
+    ]
@@ -0,0 +1,276 @@
+import importlib.util
+import os
+import threading
+import time
+
+import httpx
+from openai import OpenAI
+
+from cancellation import TurnTimeout
+from metrics import llm_http_latency, llm_http_requests
+
+# 模型服务的 HTTP 连接池配置
+LLM_HTTP2 = os.getenv("LLM_HTTP2", "true").lower() == "true"
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "120"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "60"))
+# 启动时预热连接；LLM_KEEPALIVE_INTERVAL：连接空闲超过该秒数时重新预热，0 表示不做保活
+LLM_PREWARM = os.getenv("LLM_PREWARM", "true").lower() == "true"
+LLM_KEEPALIVE_INTERVAL = float(os.getenv("LLM_KEEPALIVE_INTERVAL", "45"))
+# 单个会话同时进行的模型请求数上限，0 表示不限制
+LLM_SESSION_CONCURRENCY = int(os.getenv("LLM_SESSION_CONCURRENCY", "2"))
+
+
+def http2_available():
+    """httpx 的 HTTP/2 支持依赖可选的 h2 包"""
+    return importlib.util.find_spec("h2") is not None
+
+
+class ConnectionStats:
+    def __init__(self):
+        self.requests = 0
+        self.in_flight = 0
+        self.errors = 0
+        self.http_versions = {}
+        self.warmups = 0
+        self.warmup_latency = None
+        self.last_used = time.monotonic()
+        self._lock = threading.Lock()
+
+    def started(self):
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.last_used = time.monotonic()
+
+    def finished(self, http_version=None, error=False):
+        with self._lock:
+            self.in_flight -= 1
+            self.last_used = time.monotonic()
+            if error:
+                self.errors += 1
+            if http_version:
+                self.http_versions[http_version] = self.http_versions.get(http_version, 0) + 1
+
+
+class _CountingTransport(httpx.BaseTransport):
+    """包装 httpx 的连接池传输层，统计请求数、在途请求数与 HTTP 版本"""
+
+    def __init__(self, transport, stats):
+        self._transport = transport
+        self._pool = getattr(transport, "_pool", None)
+        self.stats = stats
+
+    def handle_request(self, request):
+        self.stats.started()
+        started = time.perf_counter()
+        try:
+            response = self._transport.handle_request(request)
+        except Exception:
+            self.stats.finished(error=True)
+            llm_http_requests.inc("error")
+            raise
+        # 流式响应在收到响应头时即计为完成，在途数反映的是等待首字节的请求
+        llm_http_latency.observe(time.perf_counter() - started)
+        llm_http_requests.inc("ok" if response.status_code < 400 else f"http_{response.status_code}")
+        version = response.extensions.get("http_version", b"")
+        self.stats.finished(version.decode() if isinstance(version, bytes) else version or None,
+                            error=response.status_code >= 500)
+        return response
+
+    def close(self):
+        self._transport.close()
+
+
+class LLMClientManager:
+    """所有会话共享的模型客户端
+
+    - 一个 httpx.Client 连接池供 OpenAI 客户端和 LangChain 的 ChatOpenAI 共用，
+      服务端支持时使用 HTTP/2 多路复用，多个并发流式请求共享一条连接
+    - prewarm() 在启动时提前完成 DNS、TCP 和 TLS 握手；开启保活时，连接空闲过久会重新预热，
+      用户的第一个问题不必等待建连
+    - stats / summary() 提供请求数、在途请求数、HTTP 版本分布和连接池状态
+    - transport_wrapper(transport) 可以替换底层传输，traceReplay 用它录制和回放模型响应
+    """
+
+    def __init__(self, api_key, base_url, http2=LLM_HTTP2, max_connections=LLM_MAX_CONNECTIONS,
+                 keepalive_expiry=LLM_KEEPALIVE_EXPIRY, connect_timeout=LLM_CONNECT_TIMEOUT,
+                 read_timeout=LLM_READ_TIMEOUT, keepalive_interval=LLM_KEEPALIVE_INTERVAL,
+                 transport_wrapper=None):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.http2 = http2 and http2_available()
+        self.keepalive_interval = keepalive_interval
+        self.stats = ConnectionStats()
+        transport = httpx.HTTPTransport(
+            http2=self.http2,
+            limits=httpx.Limits(max_connections=max_connections,
+                                max_keepalive_connections=max_connections,
+                                keepalive_expiry=keepalive_expiry),
+        )
+        if transport_wrapper is not None:
+            transport = transport_wrapper(transport)
+        self.transport = _CountingTransport(transport, self.stats)
+        self.http_client = httpx.Client(
+            transport=self.transport,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        )
+        self._openai = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._keepalive_thread = None
+
+    def openai_client(self):
+        with self._lock:
+            if self._openai is None:
+                self._openai = OpenAI(api_key=self.api_key, base_url=self.base_url, http_client=self.http_client)
+            return self._openai
+
+    def chat_model(self, **kwargs):
+        """共用连接池的 LangChain ChatOpenAI"""
+        from langchain_openai import ChatOpenAI
+        return ChatOpenAI(api_key=self.api_key, base_url=self.base_url, http_client=self.http_client, **kwargs)
+
+    def prewarm(self):
+        """请求一次模型列表接口以建立连接，返回耗时（秒），失败时返回 None"""
+        started = time.monotonic()
+        try:
+            self.http_client.get(f"{self.base_url}/models",
+                                 headers={"Authorization": f"Bearer {self.api_key}"})
+        except httpx.HTTPError as e:
+            print(f"LLM connection warm-up failed: {e}")
+            return None
+        latency = time.monotonic() - started
+        self.stats.warmups += 1
+        self.stats.warmup_latency = latency
+        return latency
+
+    def start(self, prewarm=LLM_PREWARM):
+        """后台预热并保持连接，不阻塞启动"""
+        if not prewarm or self._keepalive_thread is not None:
+            return self
+        self._keepalive_thread = threading.Thread(target=self._keepalive, name="llm-keepalive", daemon=True)
+        self._keepalive_thread.start()
+        return self
+
+    def _keepalive(self):
+        self.prewarm()
+        while self.keepalive_interval > 0 and not self._stop.wait(self.keepalive_interval / 3):
+            idle = time.monotonic() - self.stats.last_used
+            if self.stats.in_flight == 0 and idle >= self.keepalive_interval:
+                self.prewarm()
+
+    def stop(self):
+        self._stop.set()
+
+    def pool_state(self):
+        """连接池中的连接数与空闲连接数，读取不到时返回 None"""
+        connections = getattr(self.transport._pool, "connections", None)
+        if connections is None:
+            return None
+        return len(connections), sum(1 for connection in connections if connection.is_idle())
+
+    def summary(self):
+        stats = self.stats
+        versions = ", ".join(f"{version} {count}" for version, count in sorted(stats.http_versions.items()))
+        parts = [f"LLM http: {stats.requests} requests ({versions or 'none'})", f"in flight {stats.in_flight}"]
+        pool = self.pool_state()
+        if pool is not None:
+            parts.append(f"pool {pool[0]} conn ({pool[1]} idle)")
+        if stats.warmup_latency is not None:
+            parts.append(f"warm-up {stats.warmup_latency * 1000:.0f}ms x{stats.warmups}")
+        if stats.errors:
+            parts.append(f"errors {stats.errors}")
+        return ", ".join(parts)
+
+
+class _ReleasingStream:
+    """流式响应结束或关闭时归还会话的并发名额"""
+
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+
+    def __iter__(self):
+        try:
+            yield from self._stream
+        finally:
+            self.close()
+
+    def close(self):
+        release, self._release = self._release, None
+        if release is None:
+            return
+        try:
+            close = getattr(self._stream, "close", None)
+            if close:
+                close()
+        finally:
+            release()
+
+
+class LimitedClient:
+    """限制单个会话同时进行的模型请求数，接口与 OpenAI 客户端的 chat.completions.create 一致
+
+    名额在流式响应读完或关闭后归还；在请求的 timeout 内等不到名额时抛出 TurnTimeout。
+    """
+
+    def __init__(self, client, limit):
+        self.client = client
+        self.limit = limit
+        self._slots = threading.BoundedSemaphore(limit)
+        self.chat = _Chat(self)
+
+    def create(self, **kwargs):
+        if not self._slots.acquire(timeout=kwargs.get("timeout")):
+            raise TurnTimeout()
+        try:
+            response = self.client.chat.completions.create(**kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        if kwargs.get("stream"):
+            return _ReleasingStream(response, self._slots.release)
+        self._slots.release()
+        return response
+
+
+class ScheduledClient:
+    """经过共享的 LLMScheduler 发起模型请求，接口与 OpenAI 客户端的 chat.completions.create 一致
+
+    session 和 priority 决定排队时的公平分配；名额在流式响应读完或关闭后归还。
+    """
+
+    def __init__(self, client, scheduler, session, priority):
+        self.client = client
+        self.scheduler = scheduler
+        self.session = session
+        self.priority = priority
+        self.chat = _Chat(self)
+
+    def create(self, **kwargs):
+        ticket = self.scheduler.acquire(self.session, self.priority, kwargs.get("timeout"))
+        release = lambda: self.scheduler.release(ticket)
+        started = time.monotonic()
+        try:
+            response = self.client.chat.completions.create(**kwargs)
+        except BaseException:
+            release()
+            raise
+        if kwargs.get("stream"):
+            # 流式请求在收到响应头时返回
+            self.scheduler.first_byte_observed(time.monotonic() - started)
+            return _ReleasingStream(response, release)
+        release()
+        return response
+
+
+class _Chat:
+    def __init__(self, limited):
+        self.completions = _Completions(limited)
+
+
+class _Completions:
+    def __init__(self, limited):
+        self.create = limited.create
@@ -0,0 +1,246 @@
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+from cancellation import TurnTimeout, current_token
+
+# 所有会话合计同时进行的模型请求数上限，0 表示不限制（不启用调度器）
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "0"))
+# 优先级类别及其权重，名额按权重在有排队请求的类别之间分配
+LLM_PRIORITY_WEIGHTS = os.getenv("LLM_PRIORITY_WEIGHTS", "interactive:4,batch:1")
+
+INTERACTIVE, BATCH = "interactive", "batch"
+
+
+def parse_weights(text):
+    weights = {}
+    for item in text.split(","):
+        name, _, weight = item.strip().partition(":")
+        if name:
+            weights[name] = float(weight or 1)
+    return weights
+
+
+class _Ewma:
+    def __init__(self, initial, alpha=0.2):
+        self.value = initial
+        self.alpha = alpha
+
+    def add(self, sample):
+        self.value += self.alpha * (sample - self.value)
+
+
+class _Ticket:
+    __slots__ = ("session", "priority", "deadline", "enqueued", "granted_at", "event")
+
+    def __init__(self, session, priority, deadline):
+        self.session = session
+        self.priority = priority
+        self.deadline = deadline
+        self.enqueued = time.monotonic()
+        self.granted_at = None
+        self.event = threading.Event()
+
+
+class _PriorityClass:
+    """一个优先级类别：按会话分队列，类别内各会话轮流获得名额"""
+
+    def __init__(self, weight):
+        self.weight = weight
+        # 开始时间公平排队（SFQ）的虚拟完成标签
+        self.finish = 0.0
+        self.start = 0.0
+        self.sessions = OrderedDict()
+        self.queued = 0
+
+    def push(self, ticket):
+        self.sessions.setdefault(ticket.session, deque()).append(ticket)
+        self.queued += 1
+
+    def pop(self):
+        session, tickets = next(iter(self.sessions.items()))
+        ticket = tickets.popleft()
+        # 取走一个请求后该会话排到队尾
+        del self.sessions[session]
+        if tickets:
+            self.sessions[session] = tickets
+        self.queued -= 1
+        return ticket
+
+    def remove(self, ticket):
+        tickets = self.sessions.get(ticket.session)
+        if tickets is None or ticket not in tickets:
+            return False
+        tickets.remove(ticket)
+        if not tickets:
+            del self.sessions[ticket.session]
+        self.queued -= 1
+        return True
+
+
+class ClassStats:
+    def __init__(self):
+        self.requests = 0
+        self.granted = 0
+        self.shed = 0
+        self.cancelled = 0
+        self.max_queue = 0
+        self.waits = deque(maxlen=1000)
+
+    def wait_percentile(self, q):
+        if not self.waits:
+            return 0.0
+        ordered = sorted(self.waits)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class LLMScheduler:
+    """所有会话共享的模型请求调度器
+
+    - 同时进行的请求数不超过 max_in_flight，超出的请求排队
+    - 名额空出时先按权重在优先级类别之间分配（加权公平排队），类别内各会话轮流，
+      单个会话的大量请求不会挤占其他会话
+    - 请求的截止时间取本轮取消令牌的截止时间和请求的 timeout 中较早的一个；按当前排队情况估计的
+      等待时间加上首字节耗时已经超过截止时间时直接拒绝（抛出 TurnTimeout），不再占用队列
+    - stats 按类别记录请求数、排队时间分布、拒绝数
+    """
+
+    def __init__(self, max_in_flight, weights=None):
+        self.max_in_flight = max_in_flight
+        self.weights = weights or parse_weights(LLM_PRIORITY_WEIGHTS)
+        self.in_flight = 0
+        self.max_seen = 0
+        self._classes = {name: _PriorityClass(weight) for name, weight in self.weights.items()}
+        self._virtual = 0.0
+        self._lock = threading.Lock()
+        # 名额占用时长与首字节耗时的滑动平均，用于估计排队时间
+        self.service_time = _Ewma(2.0)
+        self.first_byte = _Ewma(0.5)
+        self.stats = {name: ClassStats() for name in self.weights}
+
+    def _class(self, priority):
+        if priority not in self._classes:
+            self.weights[priority] = 1.0
+            self._classes[priority] = _PriorityClass(1.0)
+            self.stats[priority] = ClassStats()
+        return self._classes[priority]
+
+    def _queued(self):
+        return sum(cls.queued for cls in self._classes.values())
+
+    def _expected_wait(self, priority):
+        """按该类别在活跃类别中的权重占比估计排队时间"""
+        cls = self._classes[priority]
+        active = sum(c.weight for c in self._classes.values() if c.queued) + (0 if cls.queued else cls.weight)
+        share = cls.weight / active
+        ahead = cls.queued + 1
+        return ahead * self.service_time.value / (self.max_in_flight * share)
+
+    def acquire(self, session, priority=INTERACTIVE, timeout=None):
+        """获取一个名额，返回的票据需要交给 release()"""
+        token = current_token()
+        now = time.monotonic()
+        deadlines = [d for d in (token.deadline if token else None,
+                                 now + timeout if timeout is not None else None) if d is not None]
+        ticket = _Ticket(session, priority, min(deadlines) if deadlines else None)
+        with self._lock:
+            cls = self._class(priority)
+            stats = self.stats[priority]
+            stats.requests += 1
+            if self.in_flight < self.max_in_flight and not self._queued():
+                self._grant(ticket, now)
+                return ticket
+            if ticket.deadline is not None and \
+                    now + self._expected_wait(priority) + self.first_byte.value > ticket.deadline:
+                stats.shed += 1
+                raise TurnTimeout()
+            if not cls.queued:
+                # 类别从空闲变为活跃：标签不早于当前虚拟时间，空闲期间不积累额度
+                cls.start = max(self._virtual, cls.finish)
+            cls.push(ticket)
+            stats.max_queue = max(stats.max_queue, cls.queued)
+
+        unregister = token.on_cancel(lambda: self._abandon(ticket)) if token else None
+        try:
+            while True:
+                wait = None
+                if ticket.deadline is not None:
+                    wait = max(ticket.deadline - self.first_byte.value - time.monotonic(), 0)
+                if ticket.event.wait(wait):
+                    break
+                # 剩余时间已不够等到首字节：移出队列
+                with self._lock:
+                    if ticket.granted_at is not None:
+                        break
+                    cls.remove(ticket)
+                    stats.shed += 1
+                raise TurnTimeout()
+        finally:
+            if unregister:
+                unregister()
+        if ticket.granted_at is None:
+            # 排队期间本轮被取消
+            stats.cancelled += 1
+            token.check()
+            raise TurnTimeout()
+        if token and token.cancelled:
+            self.release(ticket)
+            raise token.error()
+        return ticket
+
+    def _abandon(self, ticket):
+        with self._lock:
+            if ticket.granted_at is None and self._classes[ticket.priority].remove(ticket):
+                ticket.event.set()
+
+    def _grant(self, ticket, now):
+        ticket.granted_at = now
+        self.in_flight += 1
+        self.max_seen = max(self.max_seen, self.in_flight)
+        stats = self.stats[ticket.priority]
+        stats.granted += 1
+        stats.waits.append(now - ticket.enqueued)
+        ticket.event.set()
+
+    def _dispatch(self):
+        now = time.monotonic()
+        while self.in_flight < self.max_in_flight:
+            candidates = [cls for cls in self._classes.values() if cls.queued]
+            if not candidates:
+                return
+            cls = min(candidates, key=lambda c: c.start)
+            self._virtual = cls.start
+            cls.finish = cls.start + 1 / cls.weight
+            ticket = cls.pop()
+            cls.start = cls.finish
+            self._grant(ticket, now)
+
+    def first_byte_observed(self, seconds):
+        with self._lock:
+            self.first_byte.add(seconds)
+
+    def release(self, ticket):
+        with self._lock:
+            self.in_flight -= 1
+            self.service_time.add(time.monotonic() - ticket.granted_at)
+            self._dispatch()
+
+    def queue_lengths(self):
+        with self._lock:
+            return {name: cls.queued for name, cls in self._classes.items()}
+
+    def summary(self):
+        with self._lock:
+            parts = [f"llm scheduler: in flight {self.in_flight}/{self.max_in_flight} (peak {self.max_seen})"]
+            for name, stats in self.stats.items():
+                if not stats.requests:
+                    continue
+                text = (f"{name} {stats.requests} req, wait p50 {stats.wait_percentile(0.5) * 1000:.0f}ms "
+                        f"p95 {stats.wait_percentile(0.95) * 1000:.0f}ms, max queue {stats.max_queue}")
+                if stats.shed:
+                    text += f", shed {stats.shed}"
+                if stats.cancelled:
+                    text += f", cancelled {stats.cancelled}"
+                parts.append(text)
+            return " | ".join(parts)
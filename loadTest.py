@@ -0,0 +1,514 @@
+"""对话引擎的并发压测
+
+用脚本化的本地 LLM 替身和模拟工具（或 standinServers.py 替身服务）驱动 run.py 背后的
+ConversationEngine，或 run_langchain.py 背后的 LangGraph / AgentExecutor 引擎，
+逐级提高并发用户数，每一级输出吞吐、TTFT 与整轮耗时的 p50/p95/p99、
+错误率和进程 RSS，任一级违反 SLO 时以非零状态码退出。
+
+用法：
+    python loadTest.py --steps 1,4,16,64 --conversations 3 --slo-p95-turn-ms 3000
+    python loadTest.py --tools standin --amap-latency lognormal:80,0.5
+    python loadTest.py --mock-profile slow
+    python loadTest.py --entry langchain --langchain-engine executor
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+# 每段脚本是一个多轮对话：(用户输入, 期望模型发起的工具调用)
+SCRIPTS = [
+    [
+        ("现在几点了", []),
+        ("上海天气怎么样", [("get_weather", {"location": "上海"})]),
+        ("从复旦大学江湾校区到五角场怎么走", [("get_public_transportation_route_planning", {
+            "source_address": "复旦大学江湾校区", "destination_address": "五角场", "city": "上海"})]),
+        ("谢谢", []),
+    ],
+    [
+        ("北京今天天气如何", [("get_weather", {"location": "北京"})]),
+        ("那杭州呢", [("get_weather", {"location": "杭州"})]),
+        ("从外滩步行到东方明珠要多久", [("get_walking_route_planning", {
+            "source_address": "外滩", "destination_address": "东方明珠"})]),
+    ],
+    [
+        ("五角场天气怎么样，从复旦大学骑车过去要多久", [
+            ("get_weather", {"location": "五角场"}),
+            ("get_bicycling_route_planning", {"source_address": "复旦大学", "destination_address": "五角场"})]),
+        ("开车呢", [("get_drive_route_planning", {"source_address": "复旦大学", "destination_address": "五角场"})]),
+        ("你好", []),
+    ],
+]
+
+
+def _chunk(content=None, tool_calls=None, usage=None):
+    choices = [] if usage else [SimpleNamespace(delta=SimpleNamespace(content=content, tool_calls=tool_calls))]
+    return SimpleNamespace(choices=choices, usage=usage)
+
+
+class ScriptedStream:
+    """模拟 OpenAI 流式响应：首 token 延迟后逐个产出 chunk"""
+
+    def __init__(self, chunks, ttft, token_interval):
+        self.chunks = chunks
+        self.ttft = ttft
+        self.token_interval = token_interval
+        self.closed = False
+
+    def __iter__(self):
+        time.sleep(self.ttft)
+        for index, chunk in enumerate(self.chunks):
+            if self.closed:
+                return
+            if index:
+                time.sleep(self.token_interval)
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+
+class ScriptedLLM:
+    """本地 LLM 替身，接口与 OpenAI client.chat.completions.create 兼容
+
+    最后一条消息是用户输入且脚本中有对应工具调用时返回 tool_calls，否则流式返回一段回答。
+    """
+
+    def __init__(self, scripts, ttft=0.3, token_interval=0.02, answer_tokens=40):
+        self.tool_calls = {question: calls for script in scripts for question, calls in script}
+        self.ttft = ttft
+        self.token_interval = token_interval
+        self.answer_tokens = answer_tokens
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def _next_id(self):
+        with self._lock:
+            self._counter += 1
+            return f"call_{self._counter}"
+
+    def create(self, model, messages, stream=True, tools=None, tool_choice=None, **kwargs):
+        last = messages[-1]
+        prompt_tokens = sum(len(str(message.get("content") or "")) for message in messages)
+        usage = SimpleNamespace(prompt_tokens=prompt_tokens, prompt_tokens_details=None,
+                                prompt_cache_hit_tokens=0, completion_tokens=self.answer_tokens)
+        calls = self.tool_calls.get(last.get("content")) if last["role"] == "user" else None
+        if calls and tools and tool_choice != "none":
+            deltas = [SimpleNamespace(index=index, id=self._next_id(),
+                                      function=SimpleNamespace(name=name, arguments=json.dumps(arguments, ensure_ascii=False)))
+                      for index, (name, arguments) in enumerate(calls)]
+            chunks = [_chunk(tool_calls=deltas), _chunk(usage=usage)]
+        else:
+            chunks = [_chunk(content=f"回答{i} ") for i in range(self.answer_tokens)] + [_chunk(usage=usage)]
+        return ScriptedStream(chunks, self.ttft, self.token_interval)
+
+
+# LangChain 工具与 function_registry 中函数的对应关系（参数名相同）
+LANGCHAIN_TOOL_NAMES = {
+    "get_weather": "check_weather",
+    "get_walking_route_planning": "walking_route",
+    "get_public_transportation_route_planning": "public_transit_route",
+    "get_drive_route_planning": "driving_route",
+    "get_bicycling_route_planning": "bicycle_route",
+}
+
+
+def langchain_scripts(scripts):
+    """把脚本中的工具调用换成 run_langchain.py 中对应的 LangChain 工具名"""
+    return [[(question, [(LANGCHAIN_TOOL_NAMES[name], arguments) for name, arguments in calls])
+             for question, calls in script] for script in scripts]
+
+
+def _chunk_payload(chunk, model, finish_reason=None):
+    """ScriptedLLM 的 chunk 转换为 OpenAI 流式接口的 JSON"""
+    payload = {"id": "chatcmpl-scripted", "object": "chat.completion.chunk", "created": int(time.time()),
+               "model": model, "choices": []}
+    if chunk is None:
+        payload["choices"] = [{"index": 0, "delta": {}, "finish_reason": finish_reason}]
+    elif chunk.usage is not None:
+        usage = chunk.usage
+        payload["usage"] = {"prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens,
+                            "total_tokens": usage.prompt_tokens + usage.completion_tokens}
+    else:
+        delta = chunk.choices[0].delta
+        message = {"role": "assistant"}
+        if delta.content is not None:
+            message["content"] = delta.content
+        if delta.tool_calls:
+            message["tool_calls"] = [{"index": call.index, "id": call.id, "type": "function",
+                                      "function": {"name": call.function.name, "arguments": call.function.arguments}}
+                                     for call in delta.tool_calls]
+        payload["choices"] = [{"index": 0, "delta": message, "finish_reason": None}]
+    return payload
+
+
+def make_llm_handler(llm):
+    """以 OpenAI HTTP 协议（/chat/completions，SSE 流式）提供 ScriptedLLM，供 ChatOpenAI 调用"""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status, payload):
+            data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            # LLMClientManager 预热连接时请求 /models
+            self._send_json(200, {"object": "list", "data": []})
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            if not self.path.endswith("/chat/completions"):
+                self._send_json(404, {"error": {"message": "not found"}})
+                return
+            model = body.get("model", "scripted")
+            stream = llm.create(model, body["messages"], tools=body.get("tools"), tool_choice=body.get("tool_choice"))
+            if not body.get("stream"):
+                self._send_json(200, self._completion(list(stream), model))
+                return
+            include_usage = (body.get("stream_options") or {}).get("include_usage")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            finish_reason = "stop"
+            try:
+                for chunk in stream:
+                    if chunk.usage is not None:
+                        self._event(_chunk_payload(None, model, finish_reason))
+                        if include_usage:
+                            self._event(_chunk_payload(chunk, model))
+                        continue
+                    if chunk.choices[0].delta.tool_calls:
+                        finish_reason = "tool_calls"
+                    self._event(_chunk_payload(chunk, model))
+                self._write(b"data: [DONE]\n\n")
+                self._write(b"")
+            except (BrokenPipeError, ConnectionResetError):
+                stream.close()
+
+        def _event(self, payload):
+            self._write(b"data: " + json.dumps(payload, ensure_ascii=False).encode("utf-8") + b"\n\n")
+
+        def _write(self, data):
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        @staticmethod
+        def _completion(chunks, model):
+            content, calls, usage = "", [], None
+            for chunk in chunks:
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                    continue
+                delta = chunk.choices[0].delta
+                content += delta.content or ""
+                calls += [{"id": call.id, "type": "function",
+                           "function": {"name": call.function.name, "arguments": call.function.arguments}}
+                          for call in delta.tool_calls or ()]
+            message = {"role": "assistant", "content": content or None}
+            if calls:
+                message["tool_calls"] = calls
+            payload = {"id": "chatcmpl-scripted", "object": "chat.completion", "created": int(time.time()),
+                       "model": model, "choices": [{"index": 0, "message": message,
+                                                    "finish_reason": "tool_calls" if calls else "stop"}]}
+            if usage is not None:
+                payload["usage"] = {"prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens,
+                                    "total_tokens": usage.prompt_tokens + usage.completion_tokens}
+            return payload
+
+    return Handler
+
+
+def start_llm_standin(llm, host="127.0.0.1", port=0):
+    """在后台线程启动 OpenAI 协议的 LLM 替身服务，返回 (服务, BASE_URL)"""
+    server = ThreadingHTTPServer((host, port), make_llm_handler(llm))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="standin-llm", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+class _StreamView:
+    """替代 streamRenderer.RenderSession，只把文本交给 on_stream"""
+
+    def __init__(self, on_stream):
+        self.on_stream = on_stream
+        self.text = ""
+
+    def append(self, text):
+        self.text += text
+        self.on_stream(iter([text]))
+
+    def replace(self, text):
+        self.text = text
+        self.on_stream(iter([text]))
+
+
+class LangChainSession:
+    """与 ConversationSession 相同的 ask() / close()，每轮的处理方式与 run_langchain.py 一致"""
+
+    def __init__(self, engine, on_stream, turn_timeout):
+        self.engine = engine
+        self.on_stream = on_stream
+        self.turn_timeout = turn_timeout
+
+    def ask(self, question):
+        from cancellation import CANCELLED, TIMEOUT, CancelToken, TurnCancelled, TurnTimeout
+        from conversationEngine import TurnResult
+
+        token = CancelToken(self.turn_timeout)
+        view = _StreamView(self.on_stream)
+        try:
+            with token.bind():
+                return TurnResult(self.engine.stream(question, view))
+        except TurnCancelled as e:
+            self.engine.interrupt(question, view.text)
+            return TurnResult(view.text, interrupted=TIMEOUT if isinstance(e, TurnTimeout) else CANCELLED)
+        except Exception:
+            self.engine.interrupt(question, view.text)
+            raise
+        finally:
+            token.close()
+            # TOKEN_LOG 的说明压测时不展示，每轮丢弃
+            self.engine.budget.take_notices()
+
+    def close(self):
+        pass
+
+
+class LangChainLoadEngine:
+    """为每个模拟用户创建一个 run_langchain.py 使用的引擎（LangGraph 为独立的 thread）"""
+
+    scheduler = None
+    answer_cache = None
+
+    def __init__(self, model, tools, system_prompt, kind, turn_timeout):
+        self.model = model
+        self.tools = tools
+        self.system_prompt = system_prompt
+        self.kind = kind
+        self.turn_timeout = turn_timeout
+
+    def new_session(self, on_stream=None, priority=None):
+        from langchainEngines import ExecutorEngine, GraphEngine
+        if self.kind == "executor":
+            engine = ExecutorEngine(self.model, self.tools, self.system_prompt)
+        else:
+            engine = GraphEngine(self.model, self.tools, self.system_prompt, thread_id=f"load-{uuid.uuid4().hex[:8]}")
+        return LangChainSession(engine, on_stream or (lambda deltas: None), self.turn_timeout)
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def current_rss_mb():
+    """当前进程常驻内存（MB），读不到 /proc 时退回峰值 RSS"""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+
+def build_registry(tools_mode, args):
+    """返回 (function_registry, function_desc)，standin 模式会先启动本地替身服务"""
+    if tools_mode == "standin":
+        from standinServers import StandinConfig, start_standins
+        _, amap_url, weather_url = start_standins(
+            StandinConfig(args.amap_latency, args.amap_error_rate),
+            StandinConfig(args.weather_latency, args.weather_error_rate))
+        os.environ["AMAP_BASE_URL"] = amap_url
+        os.environ["WEATHER_BASE_URL"] = weather_url
+        import functionCallList as tools
+    else:
+        os.environ["MOCK_PROFILE"] = args.mock_profile
+        import functionCallListMock as tools
+    from functionCallRegistry import function_desc
+    from routePipeline import build_function_registry
+    registry = build_function_registry({name: getattr(tools, name) for name in (
+        "get_time", "get_weather", "get_weather_batch", "get_coordinates_from_address", "get_walking_route_planning",
+        "get_public_transportation_route_planning", "get_drive_route_planning", "get_bicycling_route_planning")})
+    return registry, function_desc
+
+
+class TurnSample:
+    __slots__ = ("ttft", "latency", "error", "interrupted")
+
+    def __init__(self, ttft, latency, error, interrupted=None):
+        self.ttft = ttft
+        self.latency = latency
+        # 超时或被调度器丢弃的轮次不抛异常，而是返回 interrupted 的 TurnResult，同样计为错误
+        self.error = error or interrupted is not None
+        self.interrupted = interrupted
+
+
+def simulate_user(engine, user_index, conversations, samples, lock, priority="interactive"):
+    for conversation_index in range(conversations):
+        script = SCRIPTS[(user_index + conversation_index) % len(SCRIPTS)]
+        first_token = {}
+
+        def on_stream(deltas):
+            for _ in deltas:
+                first_token.setdefault("at", time.monotonic())
+
+        session = engine.new_session(on_stream=on_stream, priority=priority)
+        for question, _ in script:
+            first_token.clear()
+            started = time.monotonic()
+            error = False
+            interrupted = None
+            try:
+                interrupted = session.ask(question).interrupted
+            except Exception:
+                error = True
+            finished = time.monotonic()
+            sample = TurnSample(first_token.get("at", finished) - started, finished - started, error, interrupted)
+            with lock:
+                samples.append(sample)
+        session.close()
+
+
+def run_step(engine, users, conversations, batch_users=0):
+    samples = []
+    lock = threading.Lock()
+    started = time.monotonic()
+    threads = [threading.Thread(target=simulate_user, args=(engine, i, conversations, samples, lock,
+                                                            "batch" if i < batch_users else "interactive"))
+               for i in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    ttfts = [s.ttft * 1000 for s in samples if not s.error]
+    latencies = [s.latency * 1000 for s in samples if not s.error]
+    return {
+        "users": users,
+        "turns": len(samples),
+        "throughput": len(samples) / elapsed if elapsed else 0.0,
+        "ttft_p50": percentile(ttfts, 0.5), "ttft_p95": percentile(ttfts, 0.95), "ttft_p99": percentile(ttfts, 0.99),
+        "turn_p50": percentile(latencies, 0.5), "turn_p95": percentile(latencies, 0.95),
+        "turn_p99": percentile(latencies, 0.99),
+        "error_rate": sum(1 for s in samples if s.error) / len(samples) if samples else 0.0,
+        "interrupted": sum(1 for s in samples if s.interrupted is not None),
+        "rss_mb": current_rss_mb(),
+    }
+
+
+def slo_violations(report, args):
+    violations = []
+    if args.slo_p95_ttft_ms and report["ttft_p95"] > args.slo_p95_ttft_ms:
+        violations.append(f"p95 TTFT {report['ttft_p95']:.0f}ms > {args.slo_p95_ttft_ms:.0f}ms")
+    if args.slo_p95_turn_ms and report["turn_p95"] > args.slo_p95_turn_ms:
+        violations.append(f"p95 turn {report['turn_p95']:.0f}ms > {args.slo_p95_turn_ms:.0f}ms")
+    if report["error_rate"] > args.slo_error_rate:
+        violations.append(f"error rate {report['error_rate']:.1%} > {args.slo_error_rate:.1%}")
+    return violations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="对话引擎并发压测")
+    parser.add_argument("--entry", choices=["run", "langchain"], default="run",
+                        help="run：run.py 的 ConversationEngine；langchain：run_langchain.py 的引擎，经 HTTP 调用 LLM 替身")
+    parser.add_argument("--langchain-engine", choices=["graph", "executor"], default="graph")
+    parser.add_argument("--turn-timeout", type=float, default=90, help="langchain 入口每轮的截止时间（秒）")
+    parser.add_argument("--steps", default="1,2,4,8,16", help="逐级的并发用户数，逗号分隔")
+    parser.add_argument("--conversations", type=int, default=2, help="每个用户在每一级进行的对话数")
+    parser.add_argument("--tools", choices=["mock", "standin"], default="mock")
+    parser.add_argument("--mock-profile", choices=["instant", "realistic", "slow"], default="realistic",
+                        help="mock 模式下工具的延迟与数据规模")
+    parser.add_argument("--llm-ttft-ms", type=float, default=300)
+    parser.add_argument("--llm-token-ms", type=float, default=20)
+    parser.add_argument("--llm-answer-tokens", type=int, default=40)
+    parser.add_argument("--no-answer-cache", action="store_true")
+    parser.add_argument("--no-history-blobs", action="store_true", help="历史中保存工具结果原文，用于对比内存")
+    parser.add_argument("--llm-max-inflight", type=int, default=0, help="全局模型并发上限，0 表示不启用调度器")
+    parser.add_argument("--batch-users", type=int, default=0, help="每一级中以 batch 优先级运行的用户数")
+    parser.add_argument("--amap-latency", default="lognormal:80,0.5")
+    parser.add_argument("--weather-latency", default="lognormal:120,0.5")
+    parser.add_argument("--amap-error-rate", type=float, default=0.0)
+    parser.add_argument("--weather-error-rate", type=float, default=0.0)
+    parser.add_argument("--slo-p95-ttft-ms", type=float, default=0)
+    parser.add_argument("--slo-p95-turn-ms", type=float, default=0)
+    parser.add_argument("--slo-error-rate", type=float, default=0.01)
+    parser.add_argument("--metrics-snapshot", default="", help="结束时把全部指标写入该 JSON 文件")
+    args = parser.parse_args()
+
+    from blobStore import BlobStore
+    from llmScheduler import LLMScheduler
+    from conversationEngine import ConversationEngine, make_answer_cache
+    from metrics import instrument_tools, register_runtime_metrics, write_snapshot
+
+    function_registry, function_desc = build_registry(args.tools, args)
+    function_registry = instrument_tools(function_registry)
+    system_prompt = "你是一个用于对话场景的智能助手"
+    llm_clients = None
+    if args.entry == "langchain":
+        from langchainTools import make_langchain_tools
+        from llmClient import LLMClientManager
+        llm = ScriptedLLM(langchain_scripts(SCRIPTS), ttft=args.llm_ttft_ms / 1000,
+                          token_interval=args.llm_token_ms / 1000, answer_tokens=args.llm_answer_tokens)
+        _, base_url = start_llm_standin(llm)
+        # 与 run_langchain.py 相同：共享连接池的 ChatOpenAI，请求经本地 HTTP 到达替身
+        llm_clients = LLMClientManager("standin", base_url)
+        model = llm_clients.chat_model(model="scripted", streaming=True, temperature=0.7)
+        engine = LangChainLoadEngine(model, make_langchain_tools(function_registry), system_prompt,
+                                     args.langchain_engine, args.turn_timeout)
+    else:
+        llm = ScriptedLLM(SCRIPTS, ttft=args.llm_ttft_ms / 1000, token_interval=args.llm_token_ms / 1000,
+                          answer_tokens=args.llm_answer_tokens)
+        engine = ConversationEngine(
+            llm, "scripted", function_registry, function_desc, system_prompt,
+            answer_cache=make_answer_cache(not args.no_answer_cache, 2, 0),
+            blob_store=None if args.no_history_blobs else BlobStore(),
+            scheduler=LLMScheduler(args.llm_max_inflight) if args.llm_max_inflight else None)
+
+    header = (f"{'users':>6} {'turns':>6} {'turn/s':>7} {'ttft p50':>9} {'p95':>7} {'p99':>7} "
+              f"{'turn p50':>9} {'p95':>7} {'p99':>7} {'errors':>7} {'intr':>5} {'rss MB':>7}")
+    print(header)
+    failed = False
+    for users in (int(step) for step in args.steps.split(",")):
+        report = run_step(engine, users, args.conversations, args.batch_users)
+        print(f"{report['users']:>6} {report['turns']:>6} {report['throughput']:>7.1f} "
+              f"{report['ttft_p50']:>9.0f} {report['ttft_p95']:>7.0f} {report['ttft_p99']:>7.0f} "
+              f"{report['turn_p50']:>9.0f} {report['turn_p95']:>7.0f} {report['turn_p99']:>7.0f} "
+              f"{report['error_rate']:>7.1%} {report['interrupted']:>5} {report['rss_mb']:>7.1f}")
+        violations = slo_violations(report, args)
+        if violations:
+            print(f"SLO breached at {users} users: " + "; ".join(violations))
+            failed = True
+            break
+    if engine.scheduler is not None:
+        print(engine.scheduler.summary())
+    if args.metrics_snapshot:
+        register_runtime_metrics(llm_clients, scheduler=engine.scheduler, answer_cache=engine.answer_cache)
+        write_snapshot(args.metrics_snapshot)
+        print(f"metrics snapshot: {args.metrics_snapshot}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
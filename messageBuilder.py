@@ -0,0 +1,220 @@
+import copy
+import json
+import os
+
+from blobStore import BLOB_MIN_CHARS, BlobRef, HistoryMemory
+from tokenBudget import SUMMARY_PREFIX, TRUNCATED_MARK, TokenLedger, get_tokenizer
+from toolResult import ToolResult, to_content
+
+
+def stabilize_tools(tools):
+    """规范化工具描述，保证每次请求序列化出的字节完全一致
+
+    - 所有工具都带上 parameters（缺省为空 object），避免不同服务端补全方式不同
+    - 按固定的 key 顺序重建字典，不受注册表中书写顺序的影响
+    """
+    stable = []
+    for tool in tools:
+        function = copy.deepcopy(tool["function"])
+        function.setdefault("parameters", {"type": "object", "properties": {}})
+        canonical = json.loads(json.dumps(function, ensure_ascii=False, sort_keys=True))
+        stable.append({"type": "function", "function": canonical})
+    return stable
+
+
+class PromptCacheStats:
+    """根据返回的 usage 统计服务端前缀缓存命中情况"""
+
+    def __init__(self):
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.last_prompt_tokens = 0
+        self.last_cached_tokens = 0
+        self.last_ttft = None
+
+    @staticmethod
+    def cached_tokens_from_usage(usage):
+        # OpenAI 风格：usage.prompt_tokens_details.cached_tokens
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = getattr(details, "cached_tokens", None) if details else None
+        if cached is None:
+            # DeepSeek 风格：usage.prompt_cache_hit_tokens
+            cached = getattr(usage, "prompt_cache_hit_tokens", None)
+        return cached or 0
+
+    def record(self, usage, ttft=None):
+        if usage is None:
+            return
+        self.requests += 1
+        self.last_prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        self.last_cached_tokens = self.cached_tokens_from_usage(usage)
+        self.prompt_tokens += self.last_prompt_tokens
+        self.cached_tokens += self.last_cached_tokens
+        self.last_ttft = ttft
+
+    @property
+    def hit_rate(self):
+        if not self.prompt_tokens:
+            return 0.0
+        return self.cached_tokens / self.prompt_tokens
+
+    def summary(self):
+        text = (f"prompt tokens {self.last_prompt_tokens}, cached {self.last_cached_tokens} "
+                f"(session hit rate {self.hit_rate:.0%})")
+        if self.last_ttft is not None:
+            text += f", TTFT {self.last_ttft * 1000:.0f}ms"
+        return text
+
+
+class MessageBuilder:
+    """对前缀缓存友好的消息构建器
+
+    system 提示和工具描述在会话内固定不变，历史消息只追加、不修改，
+    这样每次请求的前缀都与上一次逐字节相同，可以命中服务端的 KV 缓存。
+
+    传入 blob_store 时，较长的工具结果存入按内容寻址的 BlobStore，历史中只保存引用，
+    在 build() 时才展开；重复的工具结果在内存和持久化文件中都只存一份。
+
+    tokens（TokenLedger）在追加时为每条消息计数，超出上下文窗口时由 tokenBudget.ContextGuard
+    调用 compact() / truncate_tool_results()，这是历史唯一会被修改的情况。
+    """
+
+    def __init__(self, system_prompt, tools, blob_store=None, blob_min_chars=BLOB_MIN_CHARS):
+        self.system_message = {"role": "system", "content": system_prompt}
+        self.tools = stabilize_tools(tools)
+        self._history = []
+        self.cache_stats = PromptCacheStats()
+        self.blob_store = blob_store
+        self.blob_min_chars = blob_min_chars
+        self.tokens = TokenLedger(get_tokenizer(), self.system_message)
+
+    def append(self, message):
+        # 保存副本，调用方之后对原字典的修改不会影响已发送过的前缀
+        message = dict(message)
+        if message.get("role") == "tool":
+            content = to_content(message.get("content"))
+            self.tokens.add({**message, "content": content})
+            if self.blob_store is not None and len(content) >= self.blob_min_chars:
+                message["content"] = self.blob_store.put(content)
+        else:
+            self.tokens.add(message)
+        self._history.append(message)
+
+    def build(self):
+        """返回本次请求要发送的消息列表，工具结果在这里才序列化（每个结果只序列化一次）"""
+        return [self.system_message] + [self._render(message) for message in self._history]
+
+    def _render(self, message):
+        content = message.get("content")
+        if isinstance(content, BlobRef):
+            return {**message, "content": self.blob_store.get(content.digest)}
+        if isinstance(content, ToolResult):
+            return {**message, "content": content.content}
+        return message
+
+    def memory(self):
+        """本会话历史的内存占用（HistoryMemory）"""
+        inline = refs = referenced = 0
+        unique = {}
+        for message in self._history:
+            content = message.get("content")
+            if isinstance(content, BlobRef):
+                refs += 1
+                referenced += content.size
+                unique[content.digest] = content.size
+            elif content:
+                inline += len(to_content(content).encode("utf-8"))
+            for call in message.get("tool_calls") or ():
+                inline += len(call["function"]["arguments"].encode("utf-8"))
+        return HistoryMemory(len(self._history), inline, refs, referenced, len(unique), sum(unique.values()))
+
+    def save(self, path):
+        """持久化历史：工具结果写入 blob_store 的目录，文件中只保存引用"""
+        messages = []
+        for message in self._history:
+            content = message.get("content")
+            if isinstance(content, BlobRef):
+                self.blob_store.persist(content.digest)
+                content = content.to_json()
+            elif isinstance(content, ToolResult):
+                content = content.content
+            messages.append({**message, "content": content})
+        temporary = path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump({"messages": messages}, f, ensure_ascii=False)
+        os.replace(temporary, path)
+
+    def load(self, path):
+        """加载 save() 写出的历史，追加在当前历史之后"""
+        with open(path, encoding="utf-8") as f:
+            messages = json.load(f)["messages"]
+        for message in messages:
+            content = message.get("content")
+            if isinstance(content, dict) and "$blob" in content:
+                if self.blob_store is None:
+                    raise ValueError("history references blobs but no blob store is configured")
+                message["content"] = self.blob_store.acquire(content["$blob"])
+            self._history.append(message)
+            self.tokens.add(self._render(message))
+
+    def turn_start(self):
+        """当前这一轮（最后一条用户消息）在历史中的位置，之前的消息可以压缩；之前只有摘要时返回 0"""
+        for index in range(len(self._history) - 1, -1, -1):
+            if self._history[index].get("role") == "user":
+                if all(message.get("role") == "system" for message in self._history[:index]):
+                    return 0
+                return index
+        return 0
+
+    def compact(self, count, summary):
+        """把历史前 count 条消息替换为一条摘要（summary 为空时直接丢弃）"""
+        self._release(self._history[:count])
+        replacement = [{"role": "system", "content": SUMMARY_PREFIX + summary}] if summary else []
+        self._history[:count] = replacement
+        self.tokens.replace_prefix(count, replacement)
+
+    def truncate_tool_results(self, excess, min_tokens):
+        """从最长的工具结果开始截断，直到省出 excess 个 token，返回截断的条数"""
+        costs = self.tokens.costs
+        candidates = sorted((index for index, message in enumerate(self._history) if message.get("role") == "tool"),
+                            key=lambda index: costs[index][1], reverse=True)
+        truncated = 0
+        for index in candidates:
+            if excess <= 0:
+                break
+            cost = costs[index][1]
+            keep = max(cost - excess, min_tokens)
+            if keep >= cost:
+                continue
+            message = self._history[index]
+            text = to_content(self._render(message)["content"])
+            self._release([message])
+            # 按字符比例截断，token 密度不均匀导致仍然偏长时再缩短
+            tokens = cost
+            while tokens > keep and text:
+                text = text[:int(len(text) * keep / tokens)]
+                message = {**message, "content": text + TRUNCATED_MARK}
+                self._history[index] = message
+                tokens = self.tokens.set(index, message)
+            excess -= cost - tokens
+            truncated += 1
+        return truncated
+
+    def _release(self, messages):
+        for message in messages:
+            if isinstance(message.get("content"), BlobRef):
+                self.blob_store.release(message["content"])
+
+    def close(self):
+        """释放本会话对内容块的引用"""
+        self._release(self._history)
+        self._history = []
+        self.tokens.reset()
+
+    @property
+    def history(self):
+        return tuple(self._history)
+
+    def __len__(self):
+        return len(self._history)
@@ -0,0 +1,390 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 本地指标接口：METRICS_PORT 不为 0 时在 METRICS_HOST:METRICS_PORT 提供 /metrics（Prometheus 文本格式）与 /metrics.json
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# 每隔 METRICS_SNAPSHOT_INTERVAL 秒把全部指标写入 METRICS_SNAPSHOT（JSON），为空时不写
+METRICS_SNAPSHOT = os.getenv("METRICS_SNAPSHOT", "")
+METRICS_SNAPSHOT_INTERVAL = float(os.getenv("METRICS_SNAPSHOT_INTERVAL", "60"))
+
+# 延迟直方图的桶上界（秒），覆盖缓存命中（毫秒级）到模型长回答（数十秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels_text(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """按标签值累加的计数器，inc() 只做一次加锁的字典更新"""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, labels, (), value) for labels, value in self._values.items()]
+
+    def snapshot(self):
+        with self._lock:
+            return [{"labels": dict(zip(self.labelnames, labels)), "value": value}
+                    for labels, value in self._values.items()]
+
+
+class Gauge(Counter):
+    """可增可减的当前值（如活跃会话数）"""
+
+    kind = "gauge"
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram:
+    """按标签值分桶的延迟直方图，桶计数不累加，导出时才转换为 Prometheus 的累积形式"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # 标签值 -> [各桶计数（最后一个为 +Inf）, 总和, 次数]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def _copy(self):
+        with self._lock:
+            return [(labels, list(counts), total, count) for labels, (counts, total, count) in self._series.items()]
+
+    def samples(self):
+        samples = []
+        for labels, counts, total, count in self._copy():
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket
+                samples.append((self.name + "_bucket", labels, (("le", _number(bound)),), cumulative))
+            samples.append((self.name + "_sum", labels, (), total))
+            samples.append((self.name + "_count", labels, (), count))
+        return samples
+
+    def snapshot(self):
+        series = []
+        for labels, counts, total, count in self._copy():
+            series.append({"labels": dict(zip(self.labelnames, labels)), "count": count, "sum": round(total, 6),
+                           "p50": self._quantile(counts, count, 0.5), "p95": self._quantile(counts, count, 0.95)})
+        return series
+
+    def _quantile(self, counts, count, q):
+        """分位数所在桶的上界（落在 +Inf 桶时返回最大的有限上界）"""
+        if not count:
+            return None
+        target, seen = q * count, 0
+        for bound, bucket in zip(self.buckets, counts):
+            seen += bucket
+            if seen >= target:
+                return bound
+        return self.buckets[-1]
+
+
+class CallbackMetric:
+    """导出时才调用 fn 读取的指标（缓存大小、连接池、在途请求等），热路径上没有任何开销
+
+    fn 返回 {标签值元组: 数值}，没有标签时返回单个数值。
+    """
+
+    def __init__(self, name, help_text, fn, labelnames=(), kind="gauge"):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+        self.kind = kind
+
+    def _values(self):
+        try:
+            values = self.fn()
+        except Exception:
+            return {}
+        if values is None:
+            return {}
+        return values if isinstance(values, dict) else {(): values}
+
+    def samples(self):
+        return [(self.name, labels, (), value) for labels, value in self._values().items()]
+
+    def snapshot(self):
+        return [{"labels": dict(zip(self.labelnames, labels)), "value": value}
+                for labels, value in self._values().items()]
+
+
+class MetricsRegistry:
+    """进程内的指标注册表，同名指标只注册一次（重复注册返回已有的指标）"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self.started = time.time()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self._register(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def callback(self, name, help_text, fn, labelnames=(), kind="gauge"):
+        """注册（或替换）导出时读取的指标"""
+        metric = CallbackMetric(name, help_text, fn, labelnames, kind)
+        with self._lock:
+            self._metrics[name] = metric
+        return metric
+
+    def metrics(self):
+        with self._lock:
+            return sorted(self._metrics.values(), key=lambda metric: metric.name)
+
+    def render_prometheus(self):
+        lines = []
+        for metric in self.metrics():
+            samples = metric.samples()
+            if not samples:
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, extra, value in samples:
+                lines.append(f"{name}{_labels_text(metric.labelnames, labels, extra)} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        return {
+            "timestamp": time.time(),
+            "uptime": round(time.time() - self.started, 3),
+            "metrics": {metric.name: {"type": metric.kind, "help": metric.help, "series": metric.snapshot()}
+                        for metric in self.metrics()},
+        }
+
+
+registry = MetricsRegistry()
+
+# 工具调用：每个 function_registry 中的工具，outcome 为 ok / error（返回错误结果）/ exception
+tool_calls = registry.counter("tool_calls_total", "Tool calls by tool and outcome", ("tool", "outcome"))
+tool_latency = registry.histogram("tool_latency_seconds", "Tool call latency", ("tool",))
+# 工具函数内部捕获的异常，按工具和异常类型统计（tool_calls 中只能看到 error）
+tool_errors = registry.counter("tool_errors_total", "Exceptions caught inside tools by tool and type",
+                               ("tool", "error"))
+# 上游接口：按 host 统计，outcome 为 ok / http_<状态码> / error / cancelled；fallback 为熔断或失败时退回的旧结果
+upstream_requests = registry.counter("upstream_requests_total", "Upstream HTTP requests by host and outcome",
+                                     ("host", "outcome"))
+upstream_latency = registry.histogram("upstream_latency_seconds", "Upstream HTTP request latency", ("host",))
+upstream_fallbacks = registry.counter("upstream_fallbacks_total", "Stale results served by host and reason",
+                                      ("host", "reason"))
+# 模型调用：按阶段（plan / answer / summary）统计
+llm_requests = registry.counter("llm_requests_total", "Model calls by stage, model and outcome",
+                                ("stage", "model", "outcome"))
+llm_latency = registry.histogram("llm_latency_seconds", "Model call latency", ("stage",))
+llm_ttft = registry.histogram("llm_ttft_seconds", "Model time to first token", ("stage",))
+llm_tokens = registry.counter("llm_tokens_total", "Model tokens by stage and kind", ("stage", "kind"))
+# 规划阶段交给 answer 模型重做的次数：answered 为不需要工具，invalid 为工具调用不合法
+llm_plan_fallbacks = registry.counter("llm_plan_fallbacks_total", "Planner steps redone by the answer model",
+                                      ("reason",))
+# 模型服务的 HTTP 请求（run.py 与 run_langchain.py 共用的连接池），耗时为收到响应头的时间
+llm_http_requests = registry.counter("llm_http_requests_total", "Model HTTP requests by outcome", ("outcome",))
+llm_http_latency = registry.histogram("llm_http_latency_seconds", "Model HTTP time to response headers")
+sessions_total = registry.counter("sessions_total", "Conversation sessions started")
+sessions_active = registry.gauge("sessions_active", "Conversation sessions not yet closed")
+turns_total = registry.counter("turns_total", "Conversation turns by outcome", ("outcome",))
+
+
+def _tool_outcome(result):
+    return "ok" if getattr(result, "ok", True) else "error"
+
+
+def instrument_tools(function_registry):
+    """给每个工具加上调用次数与耗时统计，返回新的 registry（工具名、文档不变）"""
+    instrumented = {}
+    for name, fn in function_registry.items():
+        instrumented[name] = _instrumented(name, fn)
+    return instrumented
+
+
+def _instrumented(name, fn):
+    def tool(parameters):
+        started = time.perf_counter()
+        try:
+            result = fn(parameters)
+        except Exception:
+            tool_calls.inc(name, "exception")
+            tool_latency.observe(time.perf_counter() - started, name)
+            raise
+        tool_calls.inc(name, _tool_outcome(result))
+        tool_latency.observe(time.perf_counter() - started, name)
+        return result
+
+    tool.__name__ = getattr(fn, "__name__", name)
+    tool.__doc__ = fn.__doc__
+    return tool
+
+
+def write_snapshot(path, target=registry):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary = f"{path}.tmp"
+    with open(temporary, "w", encoding="utf-8") as f:
+        json.dump(target.snapshot(), f, ensure_ascii=False, indent=1)
+    os.replace(temporary, path)
+
+
+class MetricsExporter:
+    """后台导出：HTTP 接口与定时 JSON 快照，都在独立线程中进行"""
+
+    def __init__(self, target=registry, host=METRICS_HOST, port=METRICS_PORT,
+                 snapshot_path=METRICS_SNAPSHOT, snapshot_interval=METRICS_SNAPSHOT_INTERVAL):
+        self.registry = target
+        self.host = host
+        self.port = port
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.server = None
+        self._stop = threading.Event()
+        self._snapshot_thread = None
+
+    @property
+    def url(self):
+        if self.server is None:
+            return None
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/metrics"
+
+    def start(self):
+        if self.port:
+            self.server = ThreadingHTTPServer((self.host, self.port), _make_handler(self.registry))
+            self.server.daemon_threads = True
+            threading.Thread(target=self.server.serve_forever, name="metrics-http", daemon=True).start()
+        if self.snapshot_path:
+            self._snapshot_thread = threading.Thread(target=self._snapshots, name="metrics-snapshot", daemon=True)
+            self._snapshot_thread.start()
+        return self
+
+    def _snapshots(self):
+        while not self._stop.wait(self.snapshot_interval):
+            self._write()
+
+    def _write(self):
+        try:
+            write_snapshot(self.snapshot_path, self.registry)
+        except OSError as e:
+            print(f"metrics snapshot failed: {e}")
+
+    def stop(self):
+        """停止导出，退出前写一次最终快照"""
+        self._stop.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.snapshot_path:
+            self._write()
+
+
+def _make_handler(target):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split("?")[0]
+            if path == "/metrics":
+                body, content_type = target.render_prometheus(), "text/plain; version=0.0.4; charset=utf-8"
+            elif path == "/metrics.json":
+                body, content_type = json.dumps(target.snapshot(), ensure_ascii=False), "application/json"
+            else:
+                self.send_error(404)
+                return
+            data = body.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def register_runtime_metrics(llm_clients=None, scheduler=None, answer_cache=None):
+    """注册导出时读取的运行状态：各缓存的条目数与命中次数、模型连接池、调度器队列"""
+    from toolCache import geocode_cache, tool_result_cache
+
+    caches = {"tool_result": tool_result_cache, "geocode": geocode_cache}
+    if answer_cache is not None:
+        caches["answer"] = answer_cache
+    registry.callback("cache_entries", "Cache entries",
+                      lambda: {(name,): len(cache) for name, cache in caches.items()}, ("cache",))
+    registry.callback("cache_hits_total", "Cache hits",
+                      lambda: {(name,): cache.hits for name, cache in caches.items()}, ("cache",), kind="counter")
+    registry.callback("cache_misses_total", "Cache misses",
+                      lambda: {(name,): cache.misses for name, cache in caches.items()}, ("cache",), kind="counter")
+    if llm_clients is not None:
+        registry.callback("llm_http_in_flight", "Model HTTP requests waiting for response headers",
+                          lambda: llm_clients.stats.in_flight)
+
+        def pool():
+            state = llm_clients.pool_state()
+            return None if state is None else {("total",): state[0], ("idle",): state[1]}
+
+        registry.callback("llm_pool_connections", "Model connection pool connections", pool, ("state",))
+    if scheduler is not None:
+        registry.callback("llm_scheduler_in_flight", "Model calls holding a scheduler slot",
+                          lambda: scheduler.in_flight)
+        registry.callback("llm_scheduler_queued", "Model calls queued by priority class",
+                          lambda: {(name,): queued for name, queued in scheduler.queue_lengths().items()},
+                          ("priority",))
+
+
+def start_metrics():
+    """按 METRICS_PORT / METRICS_SNAPSHOT 启动导出，两者都未配置时返回 None"""
+    if not METRICS_PORT and not METRICS_SNAPSHOT:
+        return None
+    return MetricsExporter().start()
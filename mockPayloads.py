@@ -0,0 +1,229 @@
+import math
+import random
+import zlib
+from datetime import datetime
+
+from gazetteer import load_gazetteer
+
+ROADS = ["国权路", "政通路", "邯郸路", "淞沪路", "黄兴路", "翔殷路", "四平路", "中山北二路",
+         "国定路", "大学路", "锦嘉路", "殷行路", "民星路", "武川路"]
+ORIENTATIONS = ["东", "南", "西", "北", "东北", "东南", "西北", "西南"]
+ACTIONS = ["左转", "右转", "直行", "向左前方行走", "向右前方行走", ""]
+LINES = ["地铁10号线(新江湾城--虹桥火车站)", "地铁8号线(市光路--沈杜公路)", "地铁3号线(江杨北路--上海南站)",
+         "145路(翔殷路政府路--上海火车站)", "139路(五角场--鞍山新村)", "819路(新江湾城--五角场)"]
+
+
+# weatherapi 的天气状况：(代码, 描述, 典型降水 mm, 图标编号)
+CONDITIONS = [
+    (1000, "晴天", 0, 113), (1003, "局部多云", 0, 116), (1006, "多云", 0, 119), (1009, "阴天", 0, 122),
+    (1030, "薄雾", 0, 143), (1063, "局部地区有零星小雨", 0.3, 176), (1183, "小雨", 1.5, 296),
+    (1189, "中雨", 6, 302), (1195, "大雨", 18, 308), (1087, "雷暴", 4, 200),
+]
+WIND_DIRS = ["N", "NNE", "NE", "ENE", "E", "ESE", "SE", "SSE", "S", "SSW", "SW", "WSW", "W", "WNW", "NW", "NNW"]
+
+
+class LatencyModel:
+    """延迟分布：fixed:毫秒 | uniform:最小毫秒,最大毫秒 | lognormal:中位数毫秒,sigma"""
+
+    def __init__(self, spec="fixed:0"):
+        kind, _, args = spec.partition(":")
+        self.kind = kind
+        self.args = [float(a) for a in args.split(",") if a]
+
+    def sample(self, rng):
+        if self.kind == "uniform":
+            return rng.uniform(self.args[0], self.args[1]) / 1000
+        if self.kind == "lognormal":
+            return rng.lognormvariate(math.log(self.args[0]), self.args[1]) / 1000
+        return (self.args[0] if self.args else 0) / 1000
+
+
+def _rng_for(*parts):
+    return random.Random(zlib.crc32("|".join(parts).encode("utf-8")))
+
+
+def _parse_location(location):
+    lon, lat = location.split(",")
+    return float(lon), float(lat)
+
+
+def _distance(origin, destination):
+    (lon1, lat1), (lon2, lat2) = _parse_location(origin), _parse_location(destination)
+    dx = (lon1 - lon2) * 111320 * math.cos(math.radians((lat1 + lat2) / 2))
+    dy = (lat1 - lat2) * 110540
+    return max(int(math.hypot(dx, dy) * 1.3), 50)
+
+
+def polyline(rng, start, end, points):
+    """生成起终点之间带随机抖动的折线，格式与高德一致：'经度,纬度;经度,纬度'"""
+    (lon1, lat1), (lon2, lat2) = _parse_location(start), _parse_location(end)
+    coords = []
+    for i in range(points):
+        t = i / max(points - 1, 1)
+        jitter = 0 if i in (0, points - 1) else 0.0004
+        coords.append(f"{lon1 + (lon2 - lon1) * t + rng.uniform(-jitter, jitter):.6f},"
+                      f"{lat1 + (lat2 - lat1) * t + rng.uniform(-jitter, jitter):.6f}")
+    return ";".join(coords)
+
+
+def _waypoints(rng, origin, destination, count):
+    (lon1, lat1), (lon2, lat2) = _parse_location(origin), _parse_location(destination)
+    points = [origin]
+    for i in range(1, count):
+        t = i / count
+        points.append(f"{lon1 + (lon2 - lon1) * t + rng.uniform(-0.002, 0.002):.6f},"
+                      f"{lat1 + (lat2 - lat1) * t + rng.uniform(-0.002, 0.002):.6f}")
+    points.append(destination)
+    return points
+
+
+def route_steps(rng, origin, destination, speed, count=None, driving=False):
+    """生成多段路线步骤，距离之和等于总距离"""
+    total = _distance(origin, destination)
+    count = count or max(3, min(18, total // 300 + rng.randint(2, 5)))
+    points = _waypoints(rng, origin, destination, count)
+    weights = [rng.uniform(0.5, 1.5) for _ in range(count)]
+    steps = []
+    for i in range(count):
+        road = rng.choice(ROADS)
+        distance = int(total * weights[i] / sum(weights))
+        action = rng.choice(ACTIONS)
+        step = {
+            "instruction": f"沿{road}向{rng.choice(ORIENTATIONS)}{'行驶' if driving else '步行'}{distance}米{action}",
+            "orientation": rng.choice(ORIENTATIONS),
+            "road": road,
+            "distance": str(distance),
+            "duration": str(int(distance / speed)),
+            "polyline": polyline(rng, points[i], points[i + 1], rng.randint(8, 40)),
+            "action": action,
+            "assistant_action": "到达目的地" if i == count - 1 else "",
+        }
+        if driving:
+            step.update({
+                "tolls": "0", "toll_distance": "0", "toll_road": [],
+                "tmcs": [{"lcode": [], "distance": str(distance), "status": rng.choice(["畅通", "缓行", "拥堵"]),
+                          "polyline": step["polyline"]}],
+                "cities": [{"name": "上海城区", "citycode": "021", "adcode": "310100", "districts": []}],
+            })
+        else:
+            step["walk_type"] = "0"
+        steps.append(step)
+    return total, steps
+
+
+def amap_route_payload(kind, origin, destination):
+    rng = _rng_for(kind, origin, destination)
+    speed = {"walking": 1.2, "driving": 8.3, "bicycling": 3.5}[kind]
+    paths = []
+    for _ in range(1 if kind == "walking" else rng.randint(1, 3)):
+        total, steps = route_steps(rng, origin, destination, speed, driving=kind == "driving")
+        path = {"distance": str(total), "duration": str(int(total / speed)), "steps": steps}
+        if kind == "driving":
+            path.update({"strategy": "速度最快", "tolls": "0", "toll_distance": "0",
+                         "restriction": "0", "traffic_lights": str(rng.randint(2, 15))})
+        paths.append(path)
+
+    if kind == "bicycling":
+        return {"data": {"origin": origin, "destination": destination,
+                         "paths": [{"distance": int(p["distance"]), "duration": int(p["duration"]),
+                                    "steps": p["steps"]} for p in paths]},
+                "errcode": 0, "errdetail": None, "errmsg": "OK"}
+    route = {"origin": origin, "destination": destination, "paths": paths}
+    if kind == "driving":
+        route["taxi_cost"] = str(int(_distance(origin, destination) / 1000 * 3 + 14))
+    return {"status": "1", "info": "OK", "infocode": "10000", "count": str(len(paths)), "route": route}
+
+
+def amap_transit_payload(origin, destination, city):
+    rng = _rng_for("transit", origin, destination, city)
+    total = _distance(origin, destination)
+    transits = []
+    for _ in range(rng.randint(3, 6)):
+        segments = []
+        points = _waypoints(rng, origin, destination, rng.randint(2, 4))
+        for i in range(len(points) - 1):
+            walk_distance, walk_steps = route_steps(rng, points[i], points[i + 1], 1.2, count=rng.randint(2, 4))
+            stops = [{"name": f"{rng.choice(ROADS)}站", "id": f"BV{rng.randint(10000, 99999)}",
+                      "location": points[i]} for _ in range(rng.randint(2, 9))]
+            line_distance = total // (len(points) - 1)
+            segments.append({
+                "walking": {"origin": points[i], "destination": points[i + 1],
+                            "distance": str(walk_distance // 4), "duration": str(int(walk_distance / 4.8)),
+                            "steps": walk_steps},
+                "bus": {"buslines": [{
+                    "departure_stop": stops[0], "arrival_stop": stops[-1],
+                    "name": rng.choice(LINES), "id": f"0{rng.randint(21000000000, 21999999999)}",
+                    "type": rng.choice(["地铁线路", "普通公交线路"]),
+                    "distance": str(line_distance), "duration": str(int(line_distance / 8)),
+                    "polyline": polyline(rng, points[i], points[i + 1], rng.randint(20, 80)),
+                    "start_time": "0530", "end_time": "2300",
+                    "via_num": str(len(stops) - 2), "via_stops": stops[1:-1],
+                }]},
+                "entrance": {"name": f"{rng.randint(1, 6)}号口", "location": points[i]},
+                "exit": {"name": f"{rng.randint(1, 6)}号口", "location": points[i + 1]},
+                "railway": [],
+            })
+        transits.append({
+            "cost": str(rng.choice([2, 3, 4, 5])), "duration": str(int(total / 5) + rng.randint(120, 900)),
+            "nightflag": "0", "walking_distance": str(rng.randint(200, 1500)),
+            "distance": str(total), "missed": "0", "segments": segments,
+        })
+    return {"status": "1", "info": "OK", "infocode": "10000", "count": str(len(transits)),
+            "route": {"origin": origin, "destination": destination, "distance": str(total),
+                      "taxi_cost": str(int(total / 1000 * 3 + 14)), "transits": transits}}
+
+
+def _place_coordinates(location):
+    """地名库中有该地点时返回 (经度, 纬度)"""
+    gazetteer = load_gazetteer()
+    index = gazetteer.geocode(location) if gazetteer else None
+    return gazetteer.location(index) if index is not None else None
+
+
+def weather_data(location, seed=0, now=None):
+    """按地点（和 seed）确定性生成的 weatherapi /v1/current.json 返回结构
+
+    地名库中有的地点使用真实经纬度，气温随纬度和月份变化；同一地点、同一 seed 每次结果相同，
+    不同地点之间的天气、气温、湿度和风力各不相同。
+    """
+    rng = _rng_for("weather", str(seed), location)
+    now = now or datetime.now()
+    coordinates = _place_coordinates(location)
+    lon, lat = coordinates if coordinates else (rng.uniform(100, 122), rng.uniform(22, 42))
+    # 一月最冷、七月最热，纬度越高越冷、年较差越大
+    season = -math.cos((now.month - 1) / 12 * 2 * math.pi)
+    temp_c = round(26 - (lat - 22) * 0.9 + season * (5 + (lat - 22) * 0.6) + rng.uniform(-3, 3), 1)
+    humidity = rng.randint(30, 95)
+    # 湿度越高越可能是阴雨天气
+    wet = humidity > 75
+    code, text, precip, icon = rng.choice(CONDITIONS[3:] if wet else CONDITIONS[:6])
+    precip_mm = round(precip * rng.uniform(0.5, 1.5), 1)
+    wind_kph = round(rng.uniform(2, 32), 1)
+    wind_degree = rng.randint(0, 359)
+    feelslike_c = round(temp_c + (humidity - 60) / 20 - wind_kph / 15, 1)
+    epoch = int(now.timestamp())
+    is_day = int(6 <= now.hour < 18)
+    return {
+        "location": {
+            "name": location, "region": "", "country": "China",
+            "lat": round(lat, 2), "lon": round(lon, 2), "tz_id": "Asia/Shanghai",
+            "localtime_epoch": epoch, "localtime": now.strftime("%Y-%m-%d %H:%M"),
+        },
+        "current": {
+            "last_updated_epoch": epoch - epoch % 900,
+            "last_updated": now.strftime("%Y-%m-%d %H:%M"),
+            "temp_c": temp_c, "temp_f": round(temp_c * 9 / 5 + 32, 1),
+            "is_day": is_day,
+            "condition": {"text": text, "icon": f"//cdn.weatherapi.com/weather/64x64/{'day' if is_day else 'night'}/{icon}.png",
+                          "code": code},
+            "wind_mph": round(wind_kph / 1.609, 1), "wind_kph": wind_kph,
+            "wind_degree": wind_degree, "wind_dir": WIND_DIRS[int((wind_degree + 11.25) // 22.5) % 16],
+            "pressure_mb": rng.randint(995, 1030), "pressure_in": round(rng.uniform(29.4, 30.4), 2),
+            "precip_mm": precip_mm, "precip_in": round(precip_mm / 25.4, 2),
+            "humidity": humidity, "cloud": rng.randint(60, 100) if wet else rng.randint(0, 50),
+            "feelslike_c": feelslike_c, "feelslike_f": round(feelslike_c * 9 / 5 + 32, 1),
+            "vis_km": rng.choice([4, 6, 8, 10]) if wet else 10, "vis_miles": 6,
+            "uv": 0 if not is_day else rng.randint(1, 9),
+            "gust_mph": round(wind_kph / 1.609 * 1.5, 1), "gust_kph": round(wind_kph * 1.5, 1),
+        },
+    }
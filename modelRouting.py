@@ -0,0 +1,105 @@
+import json
+import threading
+
+from metrics import llm_latency, llm_plan_fallbacks, llm_requests, llm_tokens, llm_ttft
+
+PLAN, ANSWER, SUMMARY = "plan", "answer", "summary"
+
+
+class StageModels:
+    """各阶段使用的模型
+
+    - plan：每轮第一次调用模型，主要是选择工具、抽取参数，可以用更小更快的模型
+    - answer：根据工具结果生成最终回答，以及规划模型没能给出合法工具调用时的兜底
+    - summary：压缩对话历史
+    未配置的阶段使用 answer 模型。
+    """
+
+    def __init__(self, answer, plan=None, summary=None):
+        self.answer = answer
+        self.plan = plan or answer
+        self.summary = summary or answer
+
+    @property
+    def routes_planning(self):
+        return self.plan != self.answer
+
+    def model_for(self, stage):
+        return {PLAN: self.plan, ANSWER: self.answer, SUMMARY: self.summary}[stage]
+
+
+def validate_tool_calls(tool_calls, tools):
+    """检查规划模型给出的工具调用，合法时返回 None，否则返回原因"""
+    schemas = {tool["function"]["name"]: tool["function"].get("parameters") or {} for tool in tools}
+    for call in tool_calls:
+        name = call["function"]["name"]
+        if name not in schemas:
+            return f"unknown tool {name}"
+        if not call["id"]:
+            return f"missing id for {name}"
+        try:
+            arguments = json.loads(call["function"]["arguments"] or "{}")
+        except ValueError:
+            return f"invalid arguments for {name}"
+        if not isinstance(arguments, dict):
+            return f"invalid arguments for {name}"
+        missing = [field for field in schemas[name].get("required", ()) if field not in arguments]
+        if missing:
+            return f"missing {', '.join(missing)} for {name}"
+    return None
+
+
+class StageStats:
+    """按阶段统计模型调用次数、耗时、首 token 延迟和 token 用量，以及规划阶段的兜底次数"""
+
+    def __init__(self):
+        self.stages = {}
+        self.fallbacks = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, model, latency, ttft=None, usage=None):
+        with self._lock:
+            stats = self.stages.setdefault(stage, {
+                "model": model, "calls": 0, "latency": 0.0, "ttft": 0.0,
+                "prompt_tokens": 0, "completion_tokens": 0,
+            })
+            stats["model"] = model
+            stats["calls"] += 1
+            stats["latency"] += latency
+            stats["ttft"] += ttft or 0.0
+            if usage is not None:
+                stats["prompt_tokens"] += getattr(usage, "prompt_tokens", 0) or 0
+                stats["completion_tokens"] += getattr(usage, "completion_tokens", 0) or 0
+        llm_requests.inc(stage, model, "ok")
+        llm_latency.observe(latency, stage)
+        if ttft is not None:
+            llm_ttft.observe(ttft, stage)
+        if usage is not None:
+            llm_tokens.inc(stage, "prompt", amount=getattr(usage, "prompt_tokens", 0) or 0)
+            llm_tokens.inc(stage, "completion", amount=getattr(usage, "completion_tokens", 0) or 0)
+
+    def failed(self, stage, model, outcome):
+        """模型调用失败或被中断（outcome 如 error、cancelled、timeout），只计入指标"""
+        llm_requests.inc(stage, model, outcome)
+
+    def fallback(self, reason):
+        with self._lock:
+            self.fallbacks[reason] = self.fallbacks.get(reason, 0) + 1
+        llm_plan_fallbacks.inc(reason)
+
+    def summary(self):
+        with self._lock:
+            parts = []
+            for stage in (PLAN, ANSWER, SUMMARY):
+                stats = self.stages.get(stage)
+                if not stats:
+                    continue
+                calls = stats["calls"]
+                parts.append(
+                    f"{stage} ({stats['model']}): {calls} calls, "
+                    f"avg {stats['latency'] / calls * 1000:.0f}ms, ttft {stats['ttft'] / calls * 1000:.0f}ms, "
+                    f"tokens {stats['prompt_tokens']}+{stats['completion_tokens']}")
+            if self.fallbacks:
+                reasons = ", ".join(f"{reason} {count}" for reason, count in sorted(self.fallbacks.items()))
+                parts.append(f"plan fallbacks: {sum(self.fallbacks.values())} ({reasons})")
+            return " | ".join(parts) or "no model calls"
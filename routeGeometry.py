@@ -0,0 +1,161 @@
+import os
+
+# 路线结果中的折线：packed（默认）压缩后保留在 ToolResult.geometry 中，需要时再解码；drop 直接丢弃
+# 两种方式下折线都不会出现在发送给模型的内容里
+ROUTE_GEOMETRY = os.getenv("ROUTE_GEOMETRY", "packed")
+
+# 高德坐标保留 6 位小数
+SCALE = 1000000
+
+
+def _zigzag_varint(value, out):
+    value = (value << 1) ^ (value >> 63)
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+class PackedPolyline:
+    """压缩存储的折线：坐标转为整数（1e-6 度）后按差值做 zigzag varint 编码
+
+    相邻点的差值通常只有几十到几千，每个点约 4~6 字节，原始字符串约 21 字节。
+    解析失败的折线按原文保存。
+    """
+
+    __slots__ = ("_packed", "count", "_raw")
+
+    def __init__(self, text):
+        self._raw = None
+        self.count = 0
+        out = bytearray()
+        try:
+            previous_lon = previous_lat = 0
+            for point in text.split(";"):
+                lon_text, lat_text = point.split(",")
+                lon, lat = round(float(lon_text) * SCALE), round(float(lat_text) * SCALE)
+                _zigzag_varint(lon - previous_lon, out)
+                _zigzag_varint(lat - previous_lat, out)
+                previous_lon, previous_lat = lon, lat
+                self.count += 1
+        except ValueError:
+            self._raw = text.encode("utf-8")
+            self.count = 0
+            out = b""
+        self._packed = bytes(out)
+
+    @property
+    def size(self):
+        return len(self._raw if self._raw is not None else self._packed)
+
+    def points(self):
+        """解码为 [(经度, 纬度)]，每次调用都重新解码，不缓存"""
+        if self._raw is not None:
+            return []
+        values = []
+        value = shift = 0
+        for byte in self._packed:
+            value |= (byte & 0x7F) << shift
+            shift += 7
+            if byte < 0x80:
+                values.append((value >> 1) ^ -(value & 1))
+                value = shift = 0
+        points = []
+        lon = lat = 0
+        for i in range(0, len(values), 2):
+            lon += values[i]
+            lat += values[i + 1]
+            points.append((lon / SCALE, lat / SCALE))
+        return points
+
+    def text(self):
+        """还原为高德格式 '经度,纬度;经度,纬度'"""
+        if self._raw is not None:
+            return self._raw.decode("utf-8")
+        return ";".join(f"{lon:.6f},{lat:.6f}" for lon, lat in self.points())
+
+    def __repr__(self):
+        return f"PackedPolyline({self.count} points, {self.size}B)"
+
+
+def _path_label(path):
+    label = ""
+    for part in path:
+        label += f"[{part}]" if isinstance(part, int) else (f".{part}" if label else part)
+    return label
+
+
+class RouteGeometry:
+    """一次路线结果中的全部折线，按在原始结果中的位置（如 route.paths[0].steps[3]）保存
+
+    同一结果中重复的折线（驾车步骤与其路况段）只保存一份。
+    """
+
+    def __init__(self):
+        self.lines = []
+        self.raw_size = 0
+
+    def add(self, path, line):
+        self.lines.append((path, line))
+
+    def __len__(self):
+        return len(self.lines)
+
+    @property
+    def size(self):
+        return sum(line.size for line in {id(line): line for _, line in self.lines}.values())
+
+    def decode(self):
+        """[(位置, [(经度, 纬度)])]，调用时才解码"""
+        return [(_path_label(path), line.points()) for path, line in self.lines]
+
+    def to_geojson(self):
+        """导出为 GeoJSON FeatureCollection，每条折线一个 LineString，properties.path 为其位置"""
+        features = []
+        for path, points in self.decode():
+            features.append({
+                "type": "Feature",
+                "geometry": {"type": "LineString", "coordinates": [list(point) for point in points]},
+                "properties": {"path": path},
+            })
+        return {"type": "FeatureCollection", "features": features}
+
+    def summary(self):
+        return f"{len(self.lines)} polylines, {self.raw_size / 1024:.1f}KB -> {self.size / 1024:.1f}KB"
+
+
+def extract_geometry(data, keep=True):
+    """返回 (去掉所有 polyline 字段的副本, RouteGeometry)，keep 为 False 时 RouteGeometry 为 None
+
+    不修改 data：它可能同时保存在 upstream.last_good 中，作为之后熔断时的兜底结果。
+    只复制 dict / list 容器，其余值与原结果共用。
+    """
+    geometry = RouteGeometry()
+    packed = {}
+
+    def walk(node, path):
+        if isinstance(node, dict):
+            copied = {}
+            for key, value in node.items():
+                if key == "polyline" and isinstance(value, str):
+                    if value:
+                        geometry.raw_size += len(value)
+                        if keep:
+                            if value not in packed:
+                                packed[value] = PackedPolyline(value)
+                            geometry.add(path, packed[value])
+                    continue
+                copied[key] = walk(value, path + (key,)) if isinstance(value, (dict, list)) else value
+            return copied
+        return [walk(value, path + (i,)) if isinstance(value, (dict, list)) else value
+                for i, value in enumerate(node)]
+
+    stripped = walk(data, ())
+    return stripped, (geometry if keep else None)
+
+
+def compact_route_result(result, mode=ROUTE_GEOMETRY):
+    """路线工具的返回值：data 换成不含折线的副本，折线压缩后放到 result.geometry"""
+    if result.ok and isinstance(result.data, dict):
+        result.data, result.geometry = extract_geometry(result.data, keep=mode == "packed")
+    return result
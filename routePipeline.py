@@ -0,0 +1,81 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from cancellation import submit
+from gazetteer import make_nearby_tool, with_gazetteer
+from routeGeometry import compact_route_result
+from toolCache import geocode_cache
+from toolResult import ToolResult
+from weatherBulk import make_weather_bulk_tool
+
+# 需要先做地址解析的路线规划工具
+ROUTE_TOOLS = (
+    "get_walking_route_planning",
+    "get_public_transportation_route_planning",
+    "get_drive_route_planning",
+    "get_bicycling_route_planning",
+)
+
+_geocode_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="geocode")
+
+
+def resolve_address(address, geocode_fn):
+    """将地址解析为 '经度,纬度'，优先使用缓存，失败时返回 None"""
+    key = address.strip()
+    location = geocode_cache.get(key)
+    if location is not None:
+        return location
+
+    result = geocode_fn({"address": key})
+    data = result.data
+    if result.ok and data and data.get("status") == "1" and data.get("geocodes"):
+        location = data["geocodes"][0]["location"]
+        geocode_cache.set(key, location)
+        return location
+    return None
+
+
+def resolve_endpoints(parameters, geocode_fn):
+    """补全路线规划参数中的 source / destination，两端地址并发解析"""
+    resolved = dict(parameters)
+    pending = {}
+    for coord_key, address_key in (("source", "source_address"),
+                                   ("destination", "destination_address")):
+        if not resolved.get(coord_key) and resolved.get(address_key):
+            pending[coord_key] = submit(
+                _geocode_pool, resolve_address, resolved[address_key], geocode_fn)
+
+    for coord_key, future in pending.items():
+        location = future.result()
+        if location is None:
+            return None
+        resolved[coord_key] = location
+    return resolved
+
+
+def make_route_tool(route_fn, geocode_fn):
+    """把 地址解析 -> 路线规划 合并为一次工具调用，结果中的折线移到 result.geometry"""
+    def route_tool(parameters):
+        resolved = resolve_endpoints(parameters, geocode_fn)
+        if resolved is None or not resolved.get("source") or not resolved.get("destination"):
+            return ToolResult.error("无法获取地址坐标，请检查地址是否正确")
+        return compact_route_result(route_fn(resolved))
+
+    route_tool.__name__ = route_fn.__name__
+    route_tool.__doc__ = route_fn.__doc__
+    return route_tool
+
+
+def build_function_registry(tools):
+    """根据工具函数字典构建 function_registry
+
+    地理编码优先查离线地名库，路线工具自动带上地址解析，并加入基于地名库的附近地点查询；
+    tools 中的 get_weather_batch（可选）为批量天气接口，用于构建多城市天气工具 get_weather_bulk
+    """
+    geocode_fn = with_gazetteer(tools["get_coordinates_from_address"])
+    registry = dict(tools)
+    registry["get_weather_bulk"] = make_weather_bulk_tool(tools["get_weather"], registry.pop("get_weather_batch", None))
+    registry["get_coordinates_from_address"] = geocode_fn
+    for name in ROUTE_TOOLS:
+        registry[name] = make_route_tool(tools[name], geocode_fn)
+    registry["get_nearby_places"] = make_nearby_tool(lambda address: resolve_address(address, geocode_fn))
+    return registry
@@ -1,7 +1,6 @@
 import json
 import os
 import sys
-from openai import OpenAI
 from dotenv import load_dotenv
 from rich.console import Console
 from rich.panel import Panel
@@ -24,16 +23,39 @@ else:
     from functionCallList import *
     import functionCallRegistry  # Import without direct assignment
 
+from routePipeline import build_function_registry
+from blobStore import HISTORY_BLOBS, BlobStore
+from cacheWarmer import CACHE_WARMER, install_result_cache
+from cancellation import CancelToken, TurnCancelled, sigint_cancels
+from conversationEngine import ConversationEngine, make_answer_cache
+from llmClient import LLM_SESSION_CONCURRENCY, LLMClientManager
+from llmScheduler import LLM_MAX_IN_FLIGHT, LLMScheduler
+from metrics import instrument_tools, register_runtime_metrics, start_metrics
+from streamRenderer import render_stream
+from traceReplay import make_tracer
+from turnProfiler import PROFILE_COMMAND, TurnProfiler, display_profile
+from toolResult import codec
+
 # 在这里重新绑定function_registry和function_desc
-function_registry = {
+# 路线规划工具在一次调用内完成 地址解析 -> 路线规划，无需大模型单独调用地址解析
+function_registry = build_function_registry({
     "get_time": get_time,
     "get_weather": get_weather,
+    "get_weather_batch": get_weather_batch,
     "get_coordinates_from_address": get_coordinates_from_address,
     "get_walking_route_planning": get_walking_route_planning,
     "get_public_transportation_route_planning": get_public_transportation_route_planning,
     "get_drive_route_planning": get_drive_route_planning,
     "get_bicycling_route_planning": get_bicycling_route_planning
-}
+})
+# 天气与路线结果缓存，热门查询在过期前由后台预热
+function_registry, cache_warmer = install_result_cache(function_registry)
+# TRACE_RECORD 时录制每轮的模型响应与工具结果，TRACE_REPLAY 时按录制回放
+tracer = make_tracer("run")
+if tracer is not None:
+    function_registry = tracer.wrap_tools(function_registry)
+# 每个工具的调用次数、结果与耗时（包括缓存命中）
+function_registry = instrument_tools(function_registry)
 
 function_desc = functionCallRegistry.function_desc
 
@@ -47,14 +69,31 @@ load_dotenv()
 API_KEY = os.getenv("API_KEY", "")  # No default key for security
 BASE_URL = os.getenv("BASE_URL", "https://api.siliconflow.cn/v1")
 MODEL_NAME = os.getenv("MODEL_NAME", "deepseek-ai/DeepSeek-V3")
+# 分阶段模型：选择工具的规划模型与压缩历史的摘要模型，留空时使用 MODEL_NAME
+PLANNER_MODEL_NAME = os.getenv("PLANNER_MODEL_NAME", "")
+SUMMARY_MODEL_NAME = os.getenv("SUMMARY_MODEL_NAME", "")
+
+# 多步工具调用配置：单轮最多调用模型的次数、单步超时与整轮截止时间（秒）
+AGENT_MAX_STEPS = int(os.getenv("AGENT_MAX_STEPS", "4"))
+AGENT_STEP_TIMEOUT = float(os.getenv("AGENT_STEP_TIMEOUT", "30"))
+AGENT_TURN_TIMEOUT = float(os.getenv("AGENT_TURN_TIMEOUT", "90"))
+
+# 本地意图预分类，只发送相关的工具描述
+TOOL_ROUTING = os.getenv("TOOL_ROUTING", "true").lower() == "true"
+
+# 重复问题的答案缓存：内存预算（MB）与可选的相似问题匹配阈值（0 表示只做精确匹配）
+ANSWER_CACHE = os.getenv("ANSWER_CACHE", "true").lower() == "true"
+ANSWER_CACHE_BUDGET_MB = float(os.getenv("ANSWER_CACHE_BUDGET_MB", "2"))
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0"))
 
 # Check if API keys are set
 missing_keys = []
-if not API_KEY:
+replaying = tracer is not None and tracer.replaying
+if not API_KEY and not replaying:
     missing_keys.append("API_KEY")
 
 # 如果使用模拟数据模式，不需要检查Weather和Amap API keys
-if not USE_MOCK_DATA:
+if not USE_MOCK_DATA and not replaying:
     if not os.getenv("WEATHER_API_KEY"):
         missing_keys.append("WEATHER_API_KEY")
     if not os.getenv("AMAP_API_KEY"):
@@ -76,12 +115,35 @@ if missing_keys:
     ))
     sys.exit(1)
 
-client = OpenAI(api_key=API_KEY, base_url=BASE_URL)
-
-# Initialize messages with system message
-messages = [
-    {"role": "system", "content": "你是一个用于对话场景的智能助手，请正确、简洁、比较口语化地回答问题。你能够使用提供的tools（函数）来回答问题，有必要时需要从用户提问中抽取函数所需要的参数"}
-]
+# 共享的模型客户端：连接池调优、可用时启用 HTTP/2，启动后在后台预热连接
+llm_clients = LLMClientManager(API_KEY, BASE_URL,
+                               transport_wrapper=tracer.wrap_transport if tracer is not None else None)
+client = llm_clients.openai_client()
+
+SYSTEM_PROMPT = "你是一个用于对话场景的智能助手，请正确、简洁、比较口语化地回答问题。你能够使用提供的tools（函数）来回答问题，有必要时需要从用户提问中抽取函数所需要的参数"
+
+# 工具结果在历史中只保存引用；设置 HISTORY_PATH 时每轮结束后持久化对话历史，启动时恢复
+# 回放时不读写历史文件，每次回放都从相同的状态开始
+HISTORY_PATH = "" if replaying else os.getenv("HISTORY_PATH", "")
+blob_store = BlobStore() if HISTORY_BLOBS else None
+
+engine = ConversationEngine(
+    client,
+    MODEL_NAME,
+    function_registry,
+    function_desc,
+    SYSTEM_PROMPT,
+    tool_routing=TOOL_ROUTING,
+    answer_cache=make_answer_cache(ANSWER_CACHE, ANSWER_CACHE_BUDGET_MB, ANSWER_CACHE_SIMILARITY),
+    max_steps=AGENT_MAX_STEPS,
+    step_timeout=AGENT_STEP_TIMEOUT,
+    turn_timeout=AGENT_TURN_TIMEOUT,
+    plan_model=PLANNER_MODEL_NAME or None,
+    summary_model=SUMMARY_MODEL_NAME or None,
+    session_concurrency=LLM_SESSION_CONCURRENCY,
+    blob_store=blob_store,
+    scheduler=LLMScheduler(LLM_MAX_IN_FLIGHT) if LLM_MAX_IN_FLIGHT else None
+)
 
 
 def display_welcome():
@@ -100,94 +162,70 @@ def display_welcome():
     ))
 
 
-def process_function_call(message):
-    """Process a function call in the message."""
-    if not message.tool_calls:
-        return False
-    
-    # Display function call information
-    for tool in message.tool_calls:
-        function_name = tool.function.name
-        function_arguments = json.loads(tool.function.arguments)
-        
-        console.print(Panel(
-            f"[bold]Function:[/bold] [cyan]{function_name}[/cyan]\n"
-            f"[bold]Arguments:[/bold] [yellow]{json.dumps(function_arguments, ensure_ascii=False, indent=2)}[/yellow]",
-            title="🔧 Function Call",
-            border_style="blue",
-            expand=False
-        ))
-        
-        # Special handling for route planning
-        if "route_planning" in function_name and "address" in str(function_arguments):
-            # We need to first get coordinates for addresses
-            source_address = function_arguments.get("source_address")
-            destination_address = function_arguments.get("destination_address")
-            
-            # Get coordinates for source
-            if source_address:
-                console.print(f"[bold green]Getting coordinates for [cyan]{source_address}[/cyan]...[/bold green]")
-                source_result = function_registry.get(
-                    "get_coordinates_from_address")({"address": source_address})
-                source_data = json.loads(source_result)
-                if source_data.get("status") == "1" and source_data.get("geocodes"):
-                    source_location = source_data["geocodes"][0]["location"]
-                    function_arguments["source"] = source_location
-                    console.print(f"[green]Found coordinates: [cyan]{source_location}[/cyan][/green]")
-            
-            # Get coordinates for destination
-            if destination_address:
-                console.print(f"[bold green]Getting coordinates for [cyan]{destination_address}[/cyan]...[/bold green]")
-                dest_result = function_registry.get("get_coordinates_from_address")({
-                    "address": destination_address})
-                dest_data = json.loads(dest_result)
-                if dest_data.get("status") == "1" and dest_data.get("geocodes"):
-                    dest_location = dest_data["geocodes"][0]["location"]
-                    function_arguments["destination"] = dest_location
-                    console.print(f"[green]Found coordinates: [cyan]{dest_location}[/cyan][/green]")
-        
-        # Execute function and get result
-        console.print(f"[bold green]Executing function [cyan]{function_name}[/cyan]...[/bold green]")
-        function_result = function_registry.get(
-            function_name)(function_arguments)
-        console.print("[green]Function executed successfully[/green]")
-        
-        # Add tool response to messages
-        messages.append(
-            {"role": "tool", "tool_call_id": tool.id, "content": function_result})
-    
-    return True
-
-
-def stream_output(response_stream):
-    """Stream the response with a nice animation."""
-    full_response = ""
-    
-    # Create a panel for the response that will be updated
-    response_panel = Panel("", title="[bold yellow]A[/bold yellow]: 🤖 Response", border_style="green")
-    
-    # Use Live display to update the panel in real-time
-    with Live(response_panel, refresh_per_second=10, console=console) as live:
-        for chunk in response_stream:
-            if chunk.choices[0].delta.content:
-                content_chunk = chunk.choices[0].delta.content
-                full_response += content_chunk
-                
-                # Update the panel with the current response
-                response_panel = Panel(
-                    full_response, 
-                    title="[bold yellow]A[/bold yellow]: 🤖 Response", 
-                    border_style="green"
-                )
-                live.update(response_panel)
-    
-    return full_response
+def display_function_call(function_name, function_arguments, cached):
+    """Display information about a function call requested by the model."""
+    console.print(Panel(
+        f"[bold]Function:[/bold] [cyan]{function_name}[/cyan]\n"
+        f"[bold]Arguments:[/bold] [yellow]{json.dumps(function_arguments, ensure_ascii=False, indent=2)}[/yellow]"
+        + ("\n[dim](reusing result from this turn)[/dim]" if cached else ""),
+        title="🔧 Function Call",
+        border_style="blue",
+        expand=False
+    ))
+
+
+def stream_output(deltas):
+    """Stream the response; network reading and terminal rendering run on separate threads."""
+    return render_stream(console, deltas)
+
+
+session = engine.new_session(on_tool_call=display_function_call, on_stream=stream_output)
+profiler = TurnProfiler()
+
+
+def save_history():
+    if HISTORY_PATH:
+        session.conversation.save(HISTORY_PATH)
+
+
+def end_trace_turn(answer):
+    """Close the turn in the trace; when replaying, print replay vs recorded timing."""
+    if tracer is None:
+        return
+    comparison = tracer.end_turn(answer)
+    if comparison:
+        console.print(f"[dim]{comparison}[/dim]")
+
+
+# 指标导出器在 main() 中启动；退出时（包括 Ctrl-C 和异常）由 shutdown() 停止并写出最后一次快照，同时关闭 trace 文件
+exporter = None
+
+
+def shutdown():
+    """Stop background exporters and close the trace; runs however main() exits."""
+    if exporter is not None:
+        exporter.stop()
+    if tracer is not None:
+        console.print(f"[dim]{tracer.close()}[/dim]")
 
 
 def main():
     """Main function to run the assistant."""
+    global exporter
     display_welcome()
 
+    llm_clients.start()
+    if CACHE_WARMER and not replaying:
+        cache_warmer.start()
+    # METRICS_PORT / METRICS_SNAPSHOT 配置后在后台导出指标
+    register_runtime_metrics(llm_clients, engine.scheduler, engine.answer_cache)
+    exporter = start_metrics()
+    if exporter is not None and exporter.url:
+        console.print(f"[dim]metrics at {exporter.url}[/dim]")
+    if HISTORY_PATH and os.path.exists(HISTORY_PATH):
+        session.conversation.load(HISTORY_PATH)
+        console.print(f"[dim]restored {len(session.conversation)} messages from {HISTORY_PATH}[/dim]")
+
     # Show available capabilities
     capabilities = Table(title="Available Capabilities", box=box.ROUNDED)
     capabilities.add_column("Category", style="cyan")
@@ -208,8 +246,12 @@ def main():
         if conversation_count > 0:
             console.rule("[bold blue]New Query[/bold blue]")
 
-        # Get user input with a stylish prompt
-        user_input = Prompt.ask("\n[bold yellow]Q[/bold yellow]")
+        # Get user input with a stylish prompt; replay uses the recorded inputs
+        if replaying:
+            user_input = tracer.next_input()
+            console.print(f"\n[bold yellow]Q[/bold yellow]: {user_input}")
+        else:
+            user_input = Prompt.ask("\n[bold yellow]Q[/bold yellow]")
 
         # Exit condition
         if user_input.lower() in ["exit", "quit", "bye"]:
@@ -217,44 +259,49 @@ def main():
                 "[bold cyan]Thank you for using the AI Assistant. Goodbye![/bold cyan]")
             break
 
-        # Add user message to conversation history
-        messages.append({"role": "user", "content": user_input})
-        
-        # Get initial response from model
+        # /profile 开关每轮的性能分析
+        if user_input.strip() == PROFILE_COMMAND:
+            enabled = profiler.toggle()
+            console.print(f"[dim]per-turn profiling {'on' if enabled else 'off'} ({profiler.mode}, {profiler.directory})[/dim]")
+            continue
+
         console.print("[bold green]Analyzing your query...[/bold green]")
-        response = client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=messages,
-            tools=function_desc
-        )
-        
-        message = response.choices[0].message
-
-        # Add assistant message to conversation history
-        messages.append(
-            {"role": "assistant", "content": message.content, "tool_calls": message.tool_calls})
-
-        # Check if we need to call a function
-        if process_function_call(message):
-            # If a function was called, generate a new response with the function result
-            
-            # Get response with function results
-            response = client.chat.completions.create(
-                model=MODEL_NAME,
-                messages=messages,
-                tools=function_desc,
-                stream=True
-            )
-            
-            # Process streaming response - no nested status context here
-            full_response = stream_output(response)
-            
-            # Update the last assistant message with the new content
-            messages[-2]["content"] = full_response
+        codec_snapshot = codec.stats.snapshot()
+        # 回答过程中按 Ctrl-C 只取消本轮，正在进行的模型请求和工具请求会被关闭
+        token = CancelToken()
+        if tracer is not None:
+            tracer.begin_turn(user_input)
+        try:
+            with profiler.turn() as profiled, sigint_cancels(token):
+                result = session.ask(user_input, cancel_token=token)
+        except TurnCancelled:
+            console.print("[dim]turn cancelled[/dim]")
+            end_trace_turn("")
+            display_profile(console, profiled.report)
+            save_history()
+            conversation_count += 1
+            continue
+
+        for notice in result.notices:
+            console.print(f"[dim]{notice}[/dim]")
+        if result.interrupted:
+            console.print(f"[dim]turn interrupted ({result.interrupted}), partial answer kept in history[/dim]")
+        elif result.from_cache:
+            console.print("[dim]answered from cache[/dim]")
         else:
-            # If no function call was needed, just print the response
-            console.print(
-                f"[bold yellow]A[/bold yellow]: [green]{message.content}[/green]")
+            if TOOL_ROUTING:
+                console.print(f"[dim]{session.router.stats.summary()}[/dim]")
+            console.print(f"[dim]{session.conversation.cache_stats.summary()}[/dim]")
+            console.print(f"[dim]{session.agent.stage_stats.summary()}[/dim]")
+            console.print(f"[dim]{llm_clients.summary()}[/dim]")
+            if engine.scheduler is not None:
+                console.print(f"[dim]{engine.scheduler.summary()}[/dim]")
+            console.print(f"[dim]{codec.stats.summary_since(codec_snapshot)} ({codec.backend})[/dim]")
+            console.print(f"[dim]{session.conversation.memory().summary()}[/dim]")
+            console.print(f"[dim]{session.conversation.tokens.summary()}[/dim]")
+        end_trace_turn(result.answer)
+        display_profile(console, profiled.report)
+        save_history()
 
         conversation_count += 1
 
@@ -267,3 +314,5 @@ if __name__ == "__main__":
             "[bold red]\nProgram interrupted by user. Exiting...[/bold red]")
     except Exception as e:
         console.print(f"[bold red]Error: {str(e)}[/bold red]")
+    finally:
+        shutdown()
@@ -1,6 +1,5 @@
 import os
 import sys
-import json
 from datetime import datetime
 from dotenv import load_dotenv
 from typing import Dict, Any, List, Optional
@@ -11,23 +10,15 @@ from rich.panel import Panel
 from rich.prompt import Prompt
 from rich.table import Table
 from rich import box
-from rich.live import Live
 from rich.spinner import Spinner
 from rich.layout import Layout
 
 # LangChain components - 使用更新的导入路径
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
-from langchain_core.tools import tool, Tool
-from langchain_core.output_parsers import StrOutputParser
-from langchain.agents import AgentExecutor, create_openai_tools_agent
-from langchain_core.runnables import RunnablePassthrough
-from langchain_core.utils.function_calling import convert_to_openai_tool
 
-# LangGraph for memory persistence
-from langgraph.graph import END, StateGraph
-from langgraph.checkpoint.memory import MemorySaver
+# LangGraph 引擎（并行工具节点 + 检查点）与原来的 AgentExecutor
+from langchainEngines import LANGCHAIN_ENGINE, LANGGRAPH_THREAD, make_engine
+from langchainTools import make_langchain_tools
 
 # Initialize Rich console
 console = Console()
@@ -64,22 +55,52 @@ else:
     )
 
 # 天气和时间函数总是使用真实API
-from functionCallList import get_weather, get_time
+from functionCallList import get_weather, get_weather_batch, get_time
+from routePipeline import build_function_registry
+from cacheWarmer import CACHE_WARMER, install_result_cache
+from cancellation import CancelToken, TurnCancelled, TurnTimeout, sigint_cancels
+from llmClient import LLMClientManager
+from metrics import instrument_tools, register_runtime_metrics, start_metrics
+from streamRenderer import RenderSession
+from traceReplay import make_tracer
+from turnProfiler import PROFILE_COMMAND, TurnProfiler, display_profile
+
+# 路线工具在一次调用内完成地址解析；天气与路线结果缓存，热门查询由后台预热
+tool_registry, cache_warmer = install_result_cache(build_function_registry({
+    "get_time": get_time,
+    "get_weather": get_weather,
+    "get_weather_batch": get_weather_batch,
+    "get_coordinates_from_address": get_coordinates_from_address,
+    "get_walking_route_planning": get_walking_route_planning,
+    "get_public_transportation_route_planning": get_public_transportation_route_planning,
+    "get_drive_route_planning": get_drive_route_planning,
+    "get_bicycling_route_planning": get_bicycling_route_planning
+}))
+# TRACE_RECORD 时录制每轮的模型响应与工具结果，TRACE_REPLAY 时按录制回放
+tracer = make_tracer("langchain")
+if tracer is not None:
+    tool_registry = tracer.wrap_tools(tool_registry)
+# 每个工具的调用次数、结果与耗时
+tool_registry = instrument_tools(tool_registry)
 
 # Get API credentials
 API_KEY = os.getenv("API_KEY", "")  # LLM API key
 BASE_URL = os.getenv("BASE_URL", "https://api.siliconflow.cn/v1")
 MODEL_NAME = os.getenv("MODEL_NAME", "deepseek-ai/DeepSeek-V3")
+# 整轮对话的截止时间（秒），与 run.py 共用配置
+AGENT_TURN_TIMEOUT = float(os.getenv("AGENT_TURN_TIMEOUT", "90"))
 
 # Check if essential API keys are missing
 missing_keys = []
-if not API_KEY:
+# 回放时模型和工具结果都来自录制，不需要任何 key
+replaying = tracer is not None and tracer.replaying
+if not API_KEY and not replaying:
     missing_keys.append("API_KEY")
 
-if not os.getenv("WEATHER_API_KEY"):
+if not os.getenv("WEATHER_API_KEY") and not replaying:
     missing_keys.append("WEATHER_API_KEY")
 
-if not USE_MOCK_MAP and not os.getenv("AMAP_API_KEY"):
+if not USE_MOCK_MAP and not os.getenv("AMAP_API_KEY") and not replaying:
     missing_keys.append("AMAP_API_KEY")
 
 if missing_keys:
@@ -97,153 +118,9 @@ if missing_keys:
     ))
     sys.exit(1)
 
-
-# Define tool functions using LangChain's tool decorator
-@tool
-def current_time() -> str:
-    """获取当前时间"""
-    result = get_time({})
-    return result
-
-
-@tool
-def check_weather(location: str) -> str:
-    """
-    获取指定地点的天气信息
-    Args:
-        location: 需要查询天气的地点，如杭州、上海、北京等
-    """
-    result = get_weather({"location": location})
-    return result
-
-
-@tool
-def get_coordinates(address: str) -> str:
-    """
-    将地址转换为经纬度坐标
-    Args:
-        address: 详细地址，如复旦大学江湾校区、北京天安门等
-    """
-    result = get_coordinates_from_address({"address": address})
-    return result
-
-
-@tool
-def walking_route(source_address: str, destination_address: str) -> str:
-    """
-    获取步行路线规划
-    Args:
-        source_address: 起点地址，如复旦大学江湾校区
-        destination_address: 终点地址，如五角场
-    """
-    # 先获取坐标
-    source_data = json.loads(get_coordinates_from_address({"address": source_address}))
-    destination_data = json.loads(get_coordinates_from_address({"address": destination_address}))
-    
-    # 检查坐标获取是否成功
-    if source_data.get("status") == "1" and source_data.get("geocodes") and \
-       destination_data.get("status") == "1" and destination_data.get("geocodes"):
-        source = source_data["geocodes"][0]["location"]
-        destination = destination_data["geocodes"][0]["location"]
-        
-        # 获取路线规划
-        result = get_walking_route_planning({
-            "source": source,
-            "destination": destination
-        })
-        
-        return f"步行从{source_address}到{destination_address}的路线：\n{result}"
-    else:
-        return "无法获取地址坐标，请检查地址是否正确"
-
-
-@tool
-def public_transit_route(source_address: str, destination_address: str, city: str = "上海") -> str:
-    """
-    获取公共交通路线规划
-    Args:
-        source_address: 起点地址，如复旦大学江湾校区
-        destination_address: 终点地址，如五角场
-        city: 城市名称，如上海、北京等，默认为上海
-    """
-    # 先获取坐标
-    source_data = json.loads(get_coordinates_from_address({"address": source_address}))
-    destination_data = json.loads(get_coordinates_from_address({"address": destination_address}))
-    
-    # 检查坐标获取是否成功
-    if source_data.get("status") == "1" and source_data.get("geocodes") and \
-       destination_data.get("status") == "1" and destination_data.get("geocodes"):
-        source = source_data["geocodes"][0]["location"]
-        destination = destination_data["geocodes"][0]["location"]
-        
-        # 获取路线规划
-        result = get_public_transportation_route_planning({
-            "source": source,
-            "destination": destination,
-            "city": city
-        })
-        
-        return f"公共交通从{source_address}到{destination_address}的路线：\n{result}"
-    else:
-        return "无法获取地址坐标，请检查地址是否正确"
-
-
-@tool
-def driving_route(source_address: str, destination_address: str) -> str:
-    """
-    获取驾车路线规划
-    Args:
-        source_address: 起点地址，如复旦大学江湾校区
-        destination_address: 终点地址，如五角场
-    """
-    # 先获取坐标
-    source_data = json.loads(get_coordinates_from_address({"address": source_address}))
-    destination_data = json.loads(get_coordinates_from_address({"address": destination_address}))
-    
-    # 检查坐标获取是否成功
-    if source_data.get("status") == "1" and source_data.get("geocodes") and \
-       destination_data.get("status") == "1" and destination_data.get("geocodes"):
-        source = source_data["geocodes"][0]["location"]
-        destination = destination_data["geocodes"][0]["location"]
-        
-        # 获取路线规划
-        result = get_drive_route_planning({
-            "source": source,
-            "destination": destination
-        })
-        
-        return f"驾车从{source_address}到{destination_address}的路线：\n{result}"
-    else:
-        return "无法获取地址坐标，请检查地址是否正确"
-
-
-@tool
-def bicycle_route(source_address: str, destination_address: str) -> str:
-    """
-    获取骑行路线规划
-    Args:
-        source_address: 起点地址，如复旦大学江湾校区
-        destination_address: 终点地址，如五角场
-    """
-    # 先获取坐标
-    source_data = json.loads(get_coordinates_from_address({"address": source_address}))
-    destination_data = json.loads(get_coordinates_from_address({"address": destination_address}))
-    
-    # 检查坐标获取是否成功
-    if source_data.get("status") == "1" and source_data.get("geocodes") and \
-       destination_data.get("status") == "1" and destination_data.get("geocodes"):
-        source = source_data["geocodes"][0]["location"]
-        destination = destination_data["geocodes"][0]["location"]
-        
-        # 获取路线规划
-        result = get_bicycling_route_planning({
-            "source": source,
-            "destination": destination
-        })
-        
-        return f"骑行从{source_address}到{destination_address}的路线：\n{result}"
-    else:
-        return "无法获取地址坐标，请检查地址是否正确"
+# 共享的模型连接池，启动后在后台预热
+llm_clients = LLMClientManager(API_KEY, BASE_URL,
+                               transport_wrapper=tracer.wrap_transport if tracer is not None else None)
 
 
 def display_welcome():
@@ -267,9 +144,31 @@ def process_stream_with_ui(content: str):
     console.print(Panel(content, title="[bold yellow]A[/bold yellow]: 🤖 Response", border_style="green"))
 
 
+# 指标导出器在 main() 中启动；退出时（包括 Ctrl-C 和异常）由 shutdown() 停止并写出最后一次快照，同时关闭 trace 文件
+exporter = None
+
+
+def shutdown():
+    """停止后台导出并关闭 trace 文件，无论 main() 如何退出（包括 Ctrl-C 和异常）都会执行"""
+    if exporter is not None:
+        exporter.stop()
+    if tracer is not None:
+        console.print(f"[dim]{tracer.close()}[/dim]")
+
+
 def main():
+    global exporter
     # Display welcome message
     display_welcome()
+
+    llm_clients.start()
+    if CACHE_WARMER and not replaying:
+        cache_warmer.start()
+    # METRICS_PORT / METRICS_SNAPSHOT 配置后在后台导出指标
+    register_runtime_metrics(llm_clients)
+    exporter = start_metrics()
+    if exporter is not None and exporter.url:
+        console.print(f"[dim]metrics at {exporter.url}[/dim]")
     
     # Show available capabilities
     capabilities = Table(title="Available Capabilities", box=box.ROUNDED)
@@ -283,18 +182,7 @@ def main():
     console.print(capabilities)
     
     # Define the tools
-    tools = [
-        current_time,
-        check_weather,
-        get_coordinates,
-        walking_route,
-        public_transit_route,
-        driving_route,
-        bicycle_route
-    ]
-    
-    # 转换工具格式为OpenAI工具格式
-    openai_tools = [convert_to_openai_tool(t) for t in tools]
+    tools = make_langchain_tools(tool_registry)
     
     # 创建系统提示
     system_prompt = """你是一个用于对话场景的智能助手，请正确、简洁、比较口语化地回答问题。
@@ -302,27 +190,20 @@ def main():
 确保你的回答清晰和有用。
 """
     
-    # 创建LLM
-    model = ChatOpenAI(
-        api_key=API_KEY,
-        base_url=BASE_URL,
+    # 创建LLM，共用预热过的连接池
+    model = llm_clients.chat_model(
         model=MODEL_NAME,
         streaming=True,
         temperature=0.7
     )
     
-    # 直接使用AgentExecutor并处理每次请求，而不使用LangGraph
-    # 创建代理
-    system_message = SystemMessage(content=system_prompt)
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", system_prompt),
-        MessagesPlaceholder(variable_name="chat_history"),
-        ("human", "{input}"),
-        MessagesPlaceholder(variable_name="agent_scratchpad")
-    ])
-    
-    # 对话历史记录
-    chat_history = []
+    # 默认使用 LangGraph 引擎（工具并行执行，历史保存在检查点中），LANGCHAIN_ENGINE=executor 时使用 AgentExecutor
+    engine = make_engine(LANGCHAIN_ENGINE, model, tools, system_prompt)
+    if engine.history_length():
+        console.print(f"[dim]resumed {engine.history_length()} messages from thread {LANGGRAPH_THREAD}[/dim]")
+
+    # 每轮的性能分析，PROFILE_TURNS=true 或输入 /profile 开启
+    profiler = TurnProfiler()
     
     # 对话计数
     conversation_count = 0
@@ -332,87 +213,56 @@ def main():
         if conversation_count > 0:
             console.rule("[bold blue]New Query[/bold blue]")
         
-        # 获取用户输入
-        user_input = Prompt.ask("\n[bold yellow]Q[/bold yellow]")
+        # 获取用户输入，回放时使用录制的输入
+        if replaying:
+            user_input = tracer.next_input()
+            console.print(f"\n[bold yellow]Q[/bold yellow]: {user_input}")
+        else:
+            user_input = Prompt.ask("\n[bold yellow]Q[/bold yellow]")
         
         # 退出条件
         if user_input.lower() in ["exit", "quit", "bye"]:
             console.print("[bold cyan]Thank you for using the AI Assistant. Goodbye![/bold cyan]")
             break
+
+        # /profile 开关每轮的性能分析
+        if user_input.strip() == PROFILE_COMMAND:
+            enabled = profiler.toggle()
+            console.print(f"[dim]per-turn profiling {'on' if enabled else 'off'} ({profiler.mode}, {profiler.directory})[/dim]")
+            continue
         
+        # 回答过程中按 Ctrl-C 只取消本轮；工具的上游请求通过取消令牌一并中止
+        token = CancelToken(AGENT_TURN_TIMEOUT)
+        view = None
+        if tracer is not None:
+            tracer.begin_turn(user_input)
         try:
-            # 创建空的响应面板
-            response_text = ""
-            response_panel = Panel(
-                response_text, 
-                title="[bold yellow]A[/bold yellow]: 🤖 Response", 
-                border_style="green"
-            )
-            
-            # 创建布局，包含旋转动画
+            # 首先显示spinner；当前线程只读取代理输出，终端由渲染线程按固定帧率刷新
             spinner = Spinner("dots", text="[bold green]Processing your request...[/bold green]")
-            
-            # 首先显示spinner
-            with Live(spinner, refresh_per_second=10, console=console) as live:
-                # 创建代理 - 准备工作
-                agent = create_openai_tools_agent(model, tools, prompt)
-                agent_executor = AgentExecutor.from_agent_and_tools(
-                    agent=agent,
-                    tools=tools,
-                    verbose=False,
-                    return_intermediate_steps=True,
-                    handle_parsing_errors=True
-                )
-                
-                # 切换到响应面板 - 处理请求
-                live.update(response_panel)
-                
-                # 流式执行代理，使用不同的流式模式尝试获取更细粒度的更新
-                for chunk in agent_executor.stream(
-                    {"input": user_input, "chat_history": chat_history}
-                ):
-                    # 尝试从不同格式的chunk中提取输出
-                    if isinstance(chunk, dict) and "output" in chunk:
-                        new_content = chunk["output"]
-                        # 只有当内容变化时才更新
-                        if new_content and new_content != response_text:
-                            response_text = new_content
-                            response_panel = Panel(
-                                response_text,
-                                title="[bold yellow]A[/bold yellow]: 🤖 Response",
-                                border_style="green"
-                            )
-                            live.update(response_panel)
-                    # 尝试处理其他类型的流式输出格式
-                    elif hasattr(chunk, "content") and chunk.content:
-                        # 这可能是一个消息对象
-                        new_content = chunk.content
-                        if new_content and new_content != response_text:
-                            response_text = new_content
-                            response_panel = Panel(
-                                response_text,
-                                title="[bold yellow]A[/bold yellow]: 🤖 Response",
-                                border_style="green"
-                            )
-                            live.update(response_panel)
-                    elif isinstance(chunk, str) and chunk:
-                        # 直接字符串输出
-                        response_text += chunk
-                        response_panel = Panel(
-                            response_text,
-                            title="[bold yellow]A[/bold yellow]: 🤖 Response",
-                            border_style="green"
-                        )
-                        live.update(response_panel)
-            
-            # 更新对话历史
-            chat_history.append(HumanMessage(content=user_input))
-            chat_history.append(AIMessage(content=response_text))
-            
+            with profiler.turn() as profiled, token.bind(), sigint_cancels(token), \
+                    RenderSession(console, placeholder=spinner) as view:
+                engine.stream(user_input, view)
+
+        except TurnCancelled as e:
+            # 保留已生成的部分回答，会话继续
+            reason = "timed out" if isinstance(e, TurnTimeout) else "cancelled"
+            console.print(f"[dim]turn {reason}[/dim]")
+            engine.interrupt(user_input, view.text if view else "")
         except Exception as e:
             console.print(f"[bold red]Error: {str(e)}[/bold red]")
+            # 补齐检查点中未完成的工具调用，否则之后每一轮都会因为历史不合法而失败
+            engine.interrupt(user_input, view.text if view else "")
             error_message = f"I encountered an error while processing your request. Please try again or rephrase your question."
             process_stream_with_ui(error_message)
+        finally:
+            token.close()
+        for notice in engine.budget.take_notices():
+            console.print(f"[dim]{notice}[/dim]")
+        if tracer is not None:
+            comparison = tracer.end_turn(view.text if view else "")
+            if comparison:
+                console.print(f"[dim]{comparison}[/dim]")
+        display_profile(console, profiled.report)
         
         conversation_count += 1
 
@@ -423,4 +273,6 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         console.print("[bold red]\nProgram interrupted by user. Exiting...[/bold red]")
     except Exception as e:
-        console.print(f"[bold red]Error: {str(e)}[/bold red]") 
\ No newline at end of file
+        console.print(f"[bold red]Error: {str(e)}[/bold red]")
+    finally:
+        shutdown()
@@ -0,0 +1,197 @@
+"""高德地图与 weatherapi 的本地替身服务
+
+实现 /v3/geocode/geo、/v3/direction/*、/v4/direction/bicycling 与 /v1/current.json（含批量查询），
+返回与真实接口结构和大小相近的数据，并可注入延迟、错误和限流，
+用于在离线环境下对 functionCallList.py 的真实 HTTP 调用路径做压测。
+
+用法：
+    python standinServers.py --amap-latency lognormal:80,0.5 --weather-error-rate 0.05
+然后在 .env 中设置：
+    USE_MOCK_DATA=false
+    AMAP_BASE_URL=http://127.0.0.1:8801
+    WEATHER_BASE_URL=http://127.0.0.1:8802
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from functionCallListMock import MockData
+from mockPayloads import LatencyModel, amap_route_payload, amap_transit_payload, weather_data
+
+
+class StandinConfig:
+    """单个替身服务的故障注入配置"""
+
+    def __init__(self, latency="fixed:0", error_rate=0.0, rate_limit=0.0, seed=None):
+        self.latency = LatencyModel(latency)
+        self.error_rate = error_rate
+        # 每秒允许的请求数，0 表示不限流
+        self.rate_limit = rate_limit
+        self.rng = random.Random(seed)
+        self._tokens = rate_limit
+        self._refilled_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def admit(self):
+        """令牌桶限流，返回本次请求是否放行"""
+        if self.rate_limit <= 0:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate_limit, self._tokens + (now - self._refilled_at) * self.rate_limit)
+            self._refilled_at = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def draw(self):
+        with self._lock:
+            return self.latency.sample(self.rng), self.rng.random() < self.error_rate
+
+
+def amap_geocode_payload(address):
+    return MockData.get_coordinates_data(address)
+
+
+def weather_payload(location):
+    return weather_data(location)
+
+
+def weather_bulk_payload(locations):
+    """weatherapi 批量查询的返回结构：每个城市一项，custom_id 原样带回"""
+    return {"bulk": [{"query": {"custom_id": item.get("custom_id"), "q": item["q"], **weather_payload(item["q"])}}
+                     for item in locations]}
+
+
+def _first(query, name, default=""):
+    return query.get(name, [default])[0]
+
+
+def make_handler(service, config):
+    """service 为 'amap' 或 'weather'"""
+
+    class StandinHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json;charset=UTF-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self._handle()
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            try:
+                body = json.loads(self.rfile.read(length) or b"{}")
+            except ValueError:
+                self._send(400, {"error": {"code": 1005, "message": "Invalid request body"}})
+                return
+            self._handle(body)
+
+        def _handle(self, body=None):
+            parts = urlsplit(self.path)
+            query = parse_qs(parts.query)
+            delay, fail = config.draw()
+            time.sleep(delay)
+
+            if not config.admit():
+                if service == "amap":
+                    # 高德限流时 HTTP 状态码仍为 200，通过 infocode 区分
+                    self._send(200, {"status": "0", "info": "CUQPS_HAS_EXCEEDED_THE_LIMIT", "infocode": "10021"})
+                else:
+                    self._send(429, {"error": {"code": 2007, "message": "API key has exceeded calls per month quota."}})
+                return
+            if fail:
+                self._send(503, {"error": "injected failure"})
+                return
+
+            try:
+                payload = self._payload(parts.path, query, body)
+            except (KeyError, ValueError, IndexError):
+                self._send(400, {"status": "0", "info": "INVALID_PARAMS", "infocode": "20000"})
+                return
+            if payload is None:
+                self._send(404, {"error": "not found"})
+            else:
+                self._send(200, payload)
+
+        def _payload(self, path, query, body=None):
+            if service == "weather":
+                if path == "/v1/current.json" and body is not None and _first(query, "q") == "bulk":
+                    return weather_bulk_payload(body["locations"])
+                if path == "/v1/current.json":
+                    return weather_payload(_first(query, "q"))
+                return None
+            if body is not None:
+                return None
+            if path == "/v3/geocode/geo":
+                return amap_geocode_payload(_first(query, "address"))
+            origin, destination = _first(query, "origin"), _first(query, "destination")
+            if path == "/v3/direction/walking":
+                return amap_route_payload("walking", origin, destination)
+            if path == "/v3/direction/driving":
+                return amap_route_payload("driving", origin, destination)
+            if path == "/v4/direction/bicycling":
+                return amap_route_payload("bicycling", origin, destination)
+            if path == "/v3/direction/transit/integrated":
+                return amap_transit_payload(origin, destination, _first(query, "city"))
+            return None
+
+    return StandinHandler
+
+
+def start_standins(amap_config=None, weather_config=None, host="127.0.0.1", amap_port=0, weather_port=0):
+    """在后台线程启动两个替身服务，返回 (服务列表, AMAP_BASE_URL, WEATHER_BASE_URL)"""
+    servers = []
+    urls = []
+    for service, config, port in (("amap", amap_config or StandinConfig(), amap_port),
+                                  ("weather", weather_config or StandinConfig(), weather_port)):
+        server = ThreadingHTTPServer((host, port), make_handler(service, config))
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name=f"standin-{service}", daemon=True).start()
+        servers.append(server)
+        urls.append(f"http://{host}:{server.server_address[1]}")
+    return servers, urls[0], urls[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="高德地图与 weatherapi 的本地替身服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--amap-port", type=int, default=8801)
+    parser.add_argument("--weather-port", type=int, default=8802)
+    for service in ("amap", "weather"):
+        parser.add_argument(f"--{service}-latency", default="fixed:0",
+                            help="fixed:毫秒 | uniform:最小,最大 | lognormal:中位数,sigma")
+        parser.add_argument(f"--{service}-error-rate", type=float, default=0.0)
+        parser.add_argument(f"--{service}-rate-limit", type=float, default=0.0, help="每秒请求数，0 表示不限流")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    servers, amap_url, weather_url = start_standins(
+        StandinConfig(args.amap_latency, args.amap_error_rate, args.amap_rate_limit, args.seed),
+        StandinConfig(args.weather_latency, args.weather_error_rate, args.weather_rate_limit, args.seed),
+        host=args.host, amap_port=args.amap_port, weather_port=args.weather_port)
+    print(f"AMAP_BASE_URL={amap_url}")
+    print(f"WEATHER_BASE_URL={weather_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        for server in servers:
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+import os
+import sys
+import threading
+import time
+
+from rich.live import Live
+from rich.panel import Panel
+
+# 终端刷新帧率；PLAIN_OUTPUT=true 时总是直接输出纯文本
+RENDER_FPS = float(os.getenv("RENDER_FPS", "15"))
+PLAIN_OUTPUT = os.getenv("PLAIN_OUTPUT", "false").lower() == "true"
+
+RESPONSE_TITLE = "[bold yellow]A[/bold yellow]: 🤖 Response"
+
+
+class TextBuffer:
+    """读取线程与渲染线程之间的缓冲区
+
+    写入从不阻塞：待渲染的片段超过 max_chunks 时合并到最后一段，缓冲区的段数有上限，
+    渲染跟不上时每一帧一次取走全部积压的文本。
+    """
+
+    def __init__(self, max_chunks=256):
+        self.max_chunks = max_chunks
+        self.chunks = 0
+        self._pending = []
+        self._replacement = None
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def append(self, text):
+        with self._condition:
+            self.chunks += 1
+            if len(self._pending) >= self.max_chunks:
+                self._pending[-1] += text
+            else:
+                self._pending.append(text)
+            self._condition.notify()
+
+    def replace(self, text):
+        """用完整文本替换已有内容（LangChain 每次给出的是完整输出）"""
+        with self._condition:
+            self.chunks += 1
+            self._replacement = text
+            self._pending = []
+            self._condition.notify()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+    def take(self, timeout):
+        """等待新内容，返回 (替换文本或 None, 追加文本, 是否已关闭)"""
+        with self._condition:
+            if not self._pending and self._replacement is None and not self._closed:
+                self._condition.wait(timeout)
+            replacement, self._replacement = self._replacement, None
+            pending, self._pending = "".join(self._pending), []
+            return replacement, pending, self._closed
+
+
+class RenderSession:
+    """一次回答的显示：调用方只往缓冲区写入，渲染线程按自己的帧率刷新终端
+
+    - 终端下用 Rich Live 面板显示，每帧最多刷新一次
+    - 输出被重定向（非 TTY）或 plain=True 时直接写纯文本，不做任何排版
+    """
+
+    def __init__(self, console, title=RESPONSE_TITLE, fps=RENDER_FPS, plain=None, placeholder=None):
+        self.console = console
+        self.title = title
+        self.frame_interval = 1 / fps if fps > 0 else 0.05
+        self.plain = (PLAIN_OUTPUT or not console.is_terminal) if plain is None else plain
+        self.placeholder = placeholder
+        self.buffer = TextBuffer()
+        self.text = ""
+        self.frames = 0
+        self._printed = ""
+        self._thread = threading.Thread(target=self._run, name="renderer", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self, text):
+        self.buffer.append(text)
+
+    def replace(self, text):
+        self.buffer.replace(text)
+
+    def close(self):
+        """结束输入并等待渲染线程画完最后一帧，返回完整文本"""
+        self.buffer.close()
+        if self._thread.is_alive():
+            self._thread.join()
+        return self.text
+
+    def _panel(self):
+        return Panel(self.text, title=self.title, border_style="green")
+
+    def _run(self):
+        if self.plain:
+            self._run_plain()
+            return
+        initial = self.placeholder if self.placeholder is not None else self._panel()
+        with Live(initial, console=self.console, auto_refresh=False) as live:
+            closed = False
+            while not closed:
+                started = time.monotonic()
+                changed, closed = self._collect()
+                if changed or closed:
+                    live.update(self._panel(), refresh=True)
+                    self.frames += 1
+                elif not self.text and self.placeholder is not None:
+                    # 占位内容（如 Spinner）在第一段文本到达前保持动画
+                    live.refresh()
+                # 两帧之间至少间隔 frame_interval，期间到达的片段合并到下一帧
+                remaining = self.frame_interval - (time.monotonic() - started)
+                if remaining > 0 and not closed:
+                    time.sleep(remaining)
+
+    def _run_plain(self):
+        stream = self.console.file or sys.stdout
+        closed = False
+        while not closed:
+            changed, closed = self._collect()
+            if not changed:
+                continue
+            if self.text.startswith(self._printed):
+                stream.write(self.text[len(self._printed):])
+            else:
+                stream.write("\n" + self.text)
+            stream.flush()
+            self._printed = self.text
+            self.frames += 1
+        if self._printed:
+            stream.write("\n")
+            stream.flush()
+
+    def _collect(self):
+        replacement, pending, closed = self.buffer.take(self.frame_interval)
+        if replacement is not None:
+            self.text = replacement
+        self.text += pending
+        return replacement is not None or bool(pending), closed
+
+
+def render_stream(console, deltas, **options):
+    """在调用线程读取文本增量并写入缓冲区，由渲染线程显示，返回完整文本
+
+    只有出现文本时才打开面板，纯工具调用的步骤不显示空面板。
+    """
+    for first in deltas:
+        break
+    else:
+        return ""
+    with RenderSession(console, **options) as session:
+        session.append(first)
+        for chunk in deltas:
+            session.append(chunk)
+    return session.text
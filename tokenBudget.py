@@ -0,0 +1,259 @@
+import json
+import os
+import threading
+
+from intentRouter import estimate_tokens
+
+# 模型的上下文窗口（token）与为回答预留的 token 数，请求超过 CONTEXT_WINDOW - CONTEXT_RESERVE 时压缩历史
+CONTEXT_WINDOW = int(os.getenv("CONTEXT_WINDOW", "65536"))
+CONTEXT_RESERVE = int(os.getenv("CONTEXT_RESERVE", "4096"))
+# 本地计数使用的 tiktoken 编码；没有安装 tiktoken 时按字符粗略估算
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "cl100k_base")
+# 每次调用模型前输出请求的 token 构成和新增消息的 token 数，便于调整窗口和截断参数
+TOKEN_LOG = os.getenv("TOKEN_LOG", "false").lower() == "true"
+
+# 每条消息的格式开销（角色与分隔符）和回答起始标记，按 OpenAI 的计算方式
+MESSAGE_OVERHEAD = 4
+REPLY_PRIMER = 3
+# 压缩时交给摘要模型的单个工具结果最多保留的字符数
+SUMMARY_TOOL_CHARS = 1000
+# 截断工具结果时每条至少保留的 token 数
+MIN_TOOL_TOKENS = 200
+
+SUMMARY_PREFIX = "之前对话的摘要："
+TRUNCATED_MARK = "……（结果过长，已截断）"
+
+
+class ContextOverflow(Exception):
+    """压缩历史、截断工具结果后请求仍然超过上下文窗口"""
+
+    def __init__(self, tokens, budget):
+        super().__init__(f"本轮对话内容过长（约 {tokens} tokens，上限 {budget}），请换个更具体的问题")
+        self.tokens = tokens
+        self.budget = budget
+
+
+class Tokenizer:
+    """本地 tokenizer：安装了 tiktoken 时按 encoding 精确计数，否则按字符估算"""
+
+    def __init__(self, encoding=TOKENIZER_ENCODING):
+        self._encoding = None
+        self.backend = "estimate"
+        try:
+            import tiktoken
+            self._encoding = tiktoken.get_encoding(encoding)
+            self.backend = f"tiktoken/{encoding}"
+        except Exception:  # 未安装或编码文件无法下载时退回估算
+            pass
+
+    def count(self, text):
+        if not text:
+            return 0
+        if self._encoding is None:
+            return estimate_tokens(text)
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+
+def get_tokenizer():
+    """所有会话共享的 Tokenizer，第一次使用时才加载编码"""
+    global _tokenizer
+    with _tokenizer_lock:
+        if _tokenizer is None:
+            _tokenizer = Tokenizer()
+        return _tokenizer
+
+
+def message_tokens(message, tokenizer):
+    """单条消息（content 已是字符串）的 token 数"""
+    tokens = MESSAGE_OVERHEAD + tokenizer.count(message.get("content") or "")
+    for call in message.get("tool_calls") or ():
+        tokens += tokenizer.count(call["function"]["name"]) + tokenizer.count(call["function"]["arguments"])
+    if message.get("tool_call_id"):
+        tokens += tokenizer.count(message["tool_call_id"])
+    return tokens
+
+
+class TokenLedger:
+    """会话历史的 token 账本
+
+    每条消息在追加时计数一次，costs 与历史一一对应；工具描述按名称缓存，
+    每次请求的 token 数只是几个数相加，不需要重新对整个历史做 tokenize。
+    本地 tokenizer 与服务端不完全一致，用返回的 usage.prompt_tokens 校准（ratio）。
+    """
+
+    def __init__(self, tokenizer, system_message):
+        self.tokenizer = tokenizer
+        self.system_tokens = message_tokens(system_message, tokenizer)
+        # [(标签, token 数)]，标签如 user、assistant、tool get_weather
+        self.costs = []
+        self.history_tokens = 0
+        self._tool_tokens = {}
+        self._call_names = {}
+        self.ratio = 1.0
+        self.last_estimate = 0
+        self.compactions = 0
+        self.truncations = 0
+        # 已经在日志中输出过的消息数
+        self.logged = 0
+
+    def _label(self, message):
+        role = message.get("role", "")
+        for call in message.get("tool_calls") or ():
+            self._call_names[call["id"]] = call["function"]["name"]
+        if role == "tool":
+            return f"tool {self._call_names.get(message.get('tool_call_id'), '')}".rstrip()
+        if message.get("tool_calls"):
+            return "assistant tool_calls " + ",".join(call["function"]["name"] for call in message["tool_calls"])
+        return role
+
+    def add(self, message):
+        tokens = message_tokens(message, self.tokenizer)
+        self.costs.append((self._label(message), tokens))
+        self.history_tokens += tokens
+        return tokens
+
+    def set(self, index, message):
+        """历史中第 index 条消息被替换（截断工具结果）"""
+        label, old = self.costs[index]
+        tokens = message_tokens(message, self.tokenizer)
+        self.costs[index] = (label, tokens)
+        self.history_tokens += tokens - old
+        return tokens
+
+    def replace_prefix(self, count, messages):
+        """历史前 count 条消息被替换为 messages（压缩历史）"""
+        self.history_tokens -= sum(tokens for _, tokens in self.costs[:count])
+        replaced = [(self._label(message), message_tokens(message, self.tokenizer)) for message in messages]
+        self.costs[:count] = replaced
+        self.history_tokens += sum(tokens for _, tokens in replaced)
+        self.logged = max(self.logged - count, 0) + len(replaced)
+
+    def reset(self):
+        self.costs = []
+        self.history_tokens = 0
+        self._call_names = {}
+        self.logged = 0
+
+    def tools_tokens(self, tools):
+        total = 0
+        for tool in tools or ():
+            name = tool["function"]["name"]
+            if name not in self._tool_tokens:
+                self._tool_tokens[name] = self.tokenizer.count(json.dumps(tool["function"], ensure_ascii=False))
+            total += self._tool_tokens[name]
+        return total
+
+    def estimate(self, tools):
+        """本次请求的 prompt token 数（已按服务端计数校准）"""
+        self.last_estimate = self.system_tokens + self.history_tokens + self.tools_tokens(tools) + REPLY_PRIMER
+        return int(self.last_estimate * self.ratio)
+
+    def calibrate(self, prompt_tokens):
+        """用服务端返回的 prompt_tokens 更新本地计数的校准系数"""
+        if prompt_tokens and self.last_estimate:
+            self.ratio += 0.3 * (prompt_tokens / self.last_estimate - self.ratio)
+
+    def new_costs(self):
+        """上次输出日志之后新增的消息"""
+        costs = self.costs[self.logged:]
+        self.logged = len(self.costs)
+        return costs
+
+    def summary(self):
+        text = (f"context {int((self.system_tokens + self.history_tokens) * self.ratio)} tokens "
+                f"({self.tokenizer.backend}, ratio {self.ratio:.2f})")
+        if self.compactions:
+            text += f", compacted {self.compactions}x"
+        if self.truncations:
+            text += f", truncated {self.truncations} tool results"
+        return text
+
+
+def transcript(messages):
+    """把要压缩的历史转换成纯文本，工具结果只保留开头部分"""
+    lines = []
+    for message in messages:
+        role = message.get("role")
+        content = message.get("content") or ""
+        if role == "tool":
+            if len(content) > SUMMARY_TOOL_CHARS:
+                content = content[:SUMMARY_TOOL_CHARS] + TRUNCATED_MARK
+            lines.append(f"工具结果：{content}")
+        elif role == "assistant":
+            for call in message.get("tool_calls") or ():
+                lines.append(f"助手调用工具 {call['function']['name']}({call['function']['arguments']})")
+            if content:
+                lines.append(f"助手：{content}")
+        elif role == "system":
+            lines.append(content)
+        else:
+            lines.append(f"用户：{content}")
+    return "\n".join(lines)
+
+
+class ContextGuard:
+    """每次调用模型前检查请求是否放得进上下文窗口
+
+    超出 window - reserve 时依次：
+    1. 用 summary 模型把本轮之前的历史压缩成一条摘要（摘要失败时直接丢弃这部分历史）
+    2. 截断本轮中最长的工具结果
+    3. 仍然超出时抛出 ContextOverflow
+    压缩会改变请求前缀，只在超出时发生，之后的请求重新以新前缀命中缓存。
+    """
+
+    def __init__(self, window=CONTEXT_WINDOW, reserve=CONTEXT_RESERVE, log=TOKEN_LOG):
+        self.window = window
+        self.reserve = reserve
+        self.log = log
+
+    @property
+    def budget(self):
+        return self.window - self.reserve
+
+    def enforce(self, conversation, tools, summarize=None):
+        """conversation 为 MessageBuilder，summarize(messages) 返回摘要文本
+
+        返回需要展示给用户的说明（摘要失败、压缩与截断，log 开启时还有请求的 token 构成），由调用方输出。
+        """
+        ledger = conversation.tokens
+        notices = []
+        tokens = ledger.estimate(tools)
+        if self.log:
+            notices.extend(self._breakdown(ledger, tools, tokens))
+        if tokens <= self.budget:
+            return notices
+
+        boundary = conversation.turn_start()
+        if boundary > 0:
+            old = conversation.build()[1:boundary + 1]
+            try:
+                summary = summarize([{"role": "user", "content": transcript(old)}]) if summarize else ""
+            except Exception as e:
+                notices.append(f"context summary failed: {e}")
+                summary = ""
+            conversation.compact(boundary, summary)
+            ledger.compactions += 1
+            tokens = ledger.estimate(tools)
+            if self.log:
+                notices.append(f"context compacted {boundary} messages -> {tokens} tokens")
+
+        if tokens > self.budget:
+            excess = int((tokens - self.budget) / ledger.ratio) + 1
+            ledger.truncations += conversation.truncate_tool_results(excess, MIN_TOOL_TOKENS)
+            tokens = ledger.estimate(tools)
+            if self.log:
+                notices.append(f"context truncated tool results -> {tokens} tokens")
+        if tokens > self.budget:
+            raise ContextOverflow(tokens, self.budget)
+        return notices
+
+    def _breakdown(self, ledger, tools, tokens):
+        lines = [f"context {tokens}/{self.budget} tokens: system {ledger.system_tokens}, "
+                 f"tools {ledger.tools_tokens(tools)}, history {ledger.history_tokens}"]
+        for label, cost in ledger.new_costs():
+            lines.append(f"  +{cost:>6}  {label}")
+        return lines
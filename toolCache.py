@@ -0,0 +1,81 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """带过期时间的 LRU 缓存，线程安全"""
+
+    def __init__(self, ttl, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """命中且未过期时返回缓存值，否则返回 None"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def remaining_ttl(self, key):
+        """条目剩余的有效时间（秒），不存在时返回 None，不影响命中统计"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            return entry[1] - time.monotonic()
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# 各工具结果的新鲜期（秒），为 0 表示结果随时变化，不能缓存
+TOOL_FRESHNESS = {
+    "get_time": 0,
+    "get_weather": 10 * 60,
+    "get_weather_bulk": 10 * 60,
+    "get_coordinates_from_address": 24 * 3600,
+    "get_walking_route_planning": 6 * 3600,
+    "get_bicycling_route_planning": 6 * 3600,
+    "get_public_transportation_route_planning": 3600,
+    "get_drive_route_planning": 15 * 60,
+    "get_nearby_places": 24 * 3600,
+}
+
+
+def query_key(name, arguments):
+    """工具调用的缓存 key：函数名 + 参数的规范化 JSON"""
+    return name + ":" + json.dumps(arguments, ensure_ascii=False, sort_keys=True)
+
+
+# 地址 -> 经纬度 的缓存，地理编码结果基本不会变化，缓存一天
+geocode_cache = TTLCache(ttl=TOOL_FRESHNESS["get_coordinates_from_address"], max_entries=4096)
+
+# 天气与路线规划工具结果的缓存，条目 TTL 取 TOOL_FRESHNESS 中对应工具的新鲜期
+tool_result_cache = TTLCache(ttl=10 * 60, max_entries=2048)
@@ -0,0 +1,113 @@
+import json
+import os
+import threading
+import time
+
+try:
+    import orjson
+except ImportError:  # orjson 为可选依赖，没有安装时退回标准库 json
+    orjson = None
+
+
+class CodecStats:
+    """累计 JSON 解析 / 序列化的次数和耗时"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.parse_count = 0
+        self.parse_seconds = 0.0
+        self.serialize_count = 0
+        self.serialize_seconds = 0.0
+
+    def add_parse(self, seconds):
+        with self._lock:
+            self.parse_count += 1
+            self.parse_seconds += seconds
+
+    def add_serialize(self, seconds):
+        with self._lock:
+            self.serialize_count += 1
+            self.serialize_seconds += seconds
+
+    def snapshot(self):
+        return (self.parse_count, self.parse_seconds, self.serialize_count, self.serialize_seconds)
+
+    def summary_since(self, snapshot):
+        parse_count, parse_seconds, serialize_count, serialize_seconds = snapshot
+        return (f"json parse {self.parse_count - parse_count}x "
+                f"{(self.parse_seconds - parse_seconds) * 1000:.2f}ms, "
+                f"serialize {self.serialize_count - serialize_count}x "
+                f"{(self.serialize_seconds - serialize_seconds) * 1000:.2f}ms")
+
+
+class JsonCodec:
+    """JSON 编解码入口，JSON_CODEC=orjson|json 选择后端，默认有 orjson 就用 orjson"""
+
+    def __init__(self, backend=None):
+        backend = backend or os.getenv("JSON_CODEC", "orjson" if orjson else "json")
+        self.backend = "orjson" if backend == "orjson" and orjson else "json"
+        self.stats = CodecStats()
+
+    def loads(self, raw):
+        started = time.perf_counter()
+        if self.backend == "orjson":
+            data = orjson.loads(raw)
+        else:
+            data = json.loads(raw)
+        self.stats.add_parse(time.perf_counter() - started)
+        return data
+
+    def dumps(self, data):
+        """序列化为字符串，中文不转义，比 json.dumps 默认输出更省 token"""
+        started = time.perf_counter()
+        if self.backend == "orjson":
+            text = orjson.dumps(data).decode("utf-8")
+        else:
+            text = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+        self.stats.add_serialize(time.perf_counter() - started)
+        return text
+
+
+codec = JsonCodec()
+
+
+class ToolResult:
+    """工具函数的返回值
+
+    data 为解析好的结构化结果（dict），text 为纯文本结果（如时间、错误提示）。
+    content 在第一次访问时才序列化并缓存，只在发送给模型时发生一次。
+    """
+
+    __slots__ = ("data", "text", "ok", "geometry", "_content")
+
+    def __init__(self, data=None, text=None, ok=True):
+        self.data = data
+        self.text = text
+        self.ok = ok
+        # 路线结果的折线（routeGeometry.RouteGeometry），不在 data 中，不发送给模型
+        self.geometry = None
+        self._content = text
+
+    @classmethod
+    def error(cls, text):
+        return cls(text=text, ok=False)
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = codec.dumps(self.data) if self.data is not None else ""
+        return self._content
+
+    def __str__(self):
+        return self.content
+
+    def __repr__(self):
+        kind = "data" if self.data is not None else "text"
+        return f"ToolResult({kind}, ok={self.ok})"
+
+
+def to_content(result):
+    """把工具结果转换成发送给模型的字符串"""
+    if isinstance(result, ToolResult):
+        return result.content
+    return result
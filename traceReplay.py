@@ -0,0 +1,364 @@
+"""对话的录制与回放，用于在排除上游波动的情况下测量我们自己代码的性能
+
+录制：TRACE_RECORD=data/trace.jsonl.gz python run.py
+    每轮的用户输入、模型服务的 HTTP 响应（响应头耗时与每个数据块的到达时间）、
+    工具调用的参数、结果和耗时写入 trace 文件（.gz 结尾时按 gzip 压缩的 JSON Lines）。
+回放：TRACE_REPLAY=data/trace.jsonl.gz TRACE_SPEED=1 python run.py
+    依次使用录制的用户输入，模型请求与工具调用直接返回录制的结果，按录制的耗时（除以 TRACE_SPEED）等待；
+    TRACE_SPEED=0 时不等待，此时每轮耗时就是我们自己的代码（路由、构建请求、解析流、渲染等）的开销。
+    每轮结束后输出回放耗时与录制耗时的对比，以及回答是否与录制时一致。
+run_langchain.py 同样支持，录制与回放需使用同一个入口和相同的配置。
+"""
+import base64
+import gzip
+import json
+import os
+import threading
+import time
+
+import httpx
+
+from cancellation import current_token
+from toolResult import ToolResult, to_content
+
+TRACE_RECORD = os.getenv("TRACE_RECORD", "")
+TRACE_REPLAY = os.getenv("TRACE_REPLAY", "")
+# 回放速度：1 为按录制时的耗时等待，10 为快 10 倍，0 为不等待
+TRACE_SPEED = float(os.getenv("TRACE_SPEED", "1"))
+
+TRACE_VERSION = 1
+
+
+def _open(path, mode):
+    directory = os.path.dirname(path)
+    if "w" in mode and directory:
+        os.makedirs(directory, exist_ok=True)
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def _tool_key(name, arguments):
+    return name + ":" + json.dumps(arguments, ensure_ascii=False, sort_keys=True)
+
+
+def _wait(seconds, stop=None):
+    """等待 seconds 秒；本轮被取消或 stop 被设置时提前结束"""
+    if seconds <= 0:
+        return
+    if stop is not None:
+        stop.wait(seconds)
+        return
+    token = current_token()
+    if token:
+        token.wait([], timeout=seconds)
+    else:
+        time.sleep(seconds)
+
+
+def _request_summary(request):
+    """请求体中的模型名与消息数，回放时用于发现与录制时不一致的请求"""
+    try:
+        body = json.loads(request.read() or b"{}")
+    except ValueError:
+        return None, None
+    return body.get("model"), len(body.get("messages") or ())
+
+
+def _encode_body(data):
+    try:
+        return {"body": data.decode("utf-8")}
+    except UnicodeDecodeError:
+        return {"body64": base64.b64encode(data).decode("ascii")}
+
+
+def _decode_body(event):
+    if "body64" in event:
+        return base64.b64decode(event["body64"])
+    return event.get("body", "").encode("utf-8")
+
+
+class TraceRecorder:
+    """录制一个会话：事件按发生顺序追加写入 trace 文件"""
+
+    replaying = False
+
+    def __init__(self, path, entry):
+        self.path = path
+        self._file = _open(path, "w")
+        self._lock = threading.Lock()
+        self.turn = 0
+        self._seq = 0
+        self._turn_started = None
+        self._write({"t": "header", "version": TRACE_VERSION, "entry": entry, "created": time.time()})
+
+    def _write(self, event):
+        line = json.dumps(event, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            # 关闭后仍在结束的流式响应（如退出时被中断的请求）不再写入
+            if not self._file.closed:
+                self._file.write(line + "\n")
+
+    def _next_seq(self):
+        with self._lock:
+            self._seq += 1
+            return self._seq
+
+    def wrap_transport(self, transport):
+        return _RecordingTransport(transport, self)
+
+    def wrap_tools(self, function_registry):
+        return {name: self._recorded_tool(name, fn) for name, fn in function_registry.items()}
+
+    def _recorded_tool(self, name, fn):
+        def tool(parameters):
+            turn = self.turn
+            started = time.perf_counter()
+            result = fn(parameters)
+            self._write({"t": "tool", "n": turn, "name": name, "args": parameters,
+                         "content": to_content(result), "ok": getattr(result, "ok", True),
+                         "ms": round((time.perf_counter() - started) * 1000, 3)})
+            return result
+
+        tool.__name__ = getattr(fn, "__name__", name)
+        tool.__doc__ = fn.__doc__
+        return tool
+
+    def next_input(self):
+        return None
+
+    def begin_turn(self, user_input):
+        self.turn += 1
+        self._turn_started = time.perf_counter()
+        self._write({"t": "turn", "n": self.turn, "input": user_input})
+
+    def end_turn(self, answer):
+        ms = (time.perf_counter() - self._turn_started) * 1000
+        self._write({"t": "end", "n": self.turn, "answer": answer, "ms": round(ms, 3)})
+        with self._lock:
+            self._file.flush()
+        return None
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+        return f"trace recorded: {self.turn} turns -> {self.path}"
+
+
+class _RecordingTransport(httpx.BaseTransport):
+    """录制模型服务的 POST 请求：响应头耗时、完整响应体和每个数据块的到达时间"""
+
+    def __init__(self, transport, recorder):
+        self._transport = transport
+        self._pool = getattr(transport, "_pool", None)
+        self.recorder = recorder
+
+    def handle_request(self, request):
+        if request.method != "POST":
+            return self._transport.handle_request(request)
+        recorder = self.recorder
+        event = {"t": "llm", "n": recorder.turn, "seq": recorder._next_seq(), "path": request.url.path}
+        event["model"], event["messages"] = _request_summary(request)
+        started = time.perf_counter()
+        response = self._transport.handle_request(request)
+        headers_at = time.perf_counter()
+        event["status"] = response.status_code
+        event["headers"] = [[key.decode("latin-1"), value.decode("latin-1")] for key, value in response.headers.raw]
+        event["ttfb"] = round((headers_at - started) * 1000, 3)
+        stream = _RecordingStream(response.stream, event, headers_at, recorder)
+        return httpx.Response(response.status_code, headers=response.headers, stream=stream,
+                              extensions=response.extensions)
+
+    def close(self):
+        self._transport.close()
+
+
+class _RecordingStream(httpx.SyncByteStream):
+    def __init__(self, stream, event, headers_at, recorder):
+        self._stream = stream
+        self.event = event
+        self.headers_at = headers_at
+        self.recorder = recorder
+        self._data = bytearray()
+        self._chunks = []
+        self._done = False
+
+    def __iter__(self):
+        for chunk in self._stream:
+            self._data += chunk
+            self._chunks.append([len(self._data), round((time.perf_counter() - self.headers_at) * 1000, 3)])
+            yield chunk
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            if not self._done:
+                self._done = True
+                # 提前关闭（取消）的响应只录下已经收到的部分
+                self.event.update(_encode_body(bytes(self._data)))
+                self.event["chunks"] = self._chunks
+                self.recorder._write(self.event)
+
+
+class TraceReplayer:
+    """按 trace 文件回放：用户输入、模型响应和工具结果都来自录制"""
+
+    replaying = True
+
+    def __init__(self, path, entry, speed=TRACE_SPEED):
+        self.path = path
+        self.speed = speed
+        self.turns = []
+        self._llm = {}
+        self._tools = {}
+        self.header = {}
+        self.truncated = False
+        with _open(path, "r") as f:
+            try:
+                for line in f:
+                    self._load(json.loads(line))
+            except (EOFError, ValueError):
+                # 录制进程被强制结束时，文件可能缺少 gzip 结束标记或最后一行不完整，保留之前完整的部分
+                self.truncated = True
+        for calls in self._llm.values():
+            calls.sort(key=lambda event: event["seq"])
+        if self.header.get("entry") not in (None, entry):
+            print(f"trace was recorded with {self.header['entry']}, replaying with {entry}")
+        self.turn = 0
+        self._lock = threading.Lock()
+        self._turn_started = None
+        # [(回放耗时 ms, 录制耗时 ms, 回答是否一致)]
+        self.results = []
+        self.divergences = 0
+        self.unmatched_tools = 0
+
+    def _load(self, event):
+        kind = event["t"]
+        if kind == "header":
+            self.header = event
+        elif kind == "turn":
+            self.turns.append({"input": event["input"], "answer": None, "ms": None})
+        elif kind == "end" and 0 < event["n"] <= len(self.turns):
+            self.turns[event["n"] - 1].update(answer=event["answer"], ms=event["ms"])
+        elif kind == "llm":
+            self._llm.setdefault(event["n"], []).append(event)
+        elif kind == "tool":
+            self._tools.setdefault((event["n"], _tool_key(event["name"], event["args"])), []).append(event)
+
+    def _scaled(self, ms):
+        return ms / 1000 / self.speed if self.speed > 0 else 0
+
+    def wrap_transport(self, transport):
+        return _ReplayTransport(self)
+
+    def wrap_tools(self, function_registry):
+        return {name: self._replayed_tool(name, fn) for name, fn in function_registry.items()}
+
+    def _replayed_tool(self, name, fn):
+        def tool(parameters):
+            with self._lock:
+                events = self._tools.get((self.turn, _tool_key(name, parameters)))
+                event = events.pop(0) if events else None
+                if event is None:
+                    self.unmatched_tools += 1
+            if event is None:
+                return ToolResult.error(f"回放中没有 {name} 的录制结果")
+            _wait(self._scaled(event["ms"]))
+            return ToolResult(text=event["content"], ok=event["ok"])
+
+        tool.__name__ = getattr(fn, "__name__", name)
+        tool.__doc__ = fn.__doc__
+        return tool
+
+    def next_llm(self, model, messages):
+        with self._lock:
+            calls = self._llm.get(self.turn)
+            event = calls.pop(0) if calls else None
+            if event is None or event.get("model") != model or event.get("messages") != messages:
+                self.divergences += 1
+        return event
+
+    def next_input(self):
+        """下一轮录制的用户输入，全部回放完后返回 exit"""
+        if self.turn >= len(self.turns):
+            return "exit"
+        return self.turns[self.turn]["input"]
+
+    def begin_turn(self, user_input):
+        self.turn += 1
+        self._turn_started = time.perf_counter()
+
+    def end_turn(self, answer):
+        """返回本轮回放耗时与录制耗时的对比"""
+        ms = (time.perf_counter() - self._turn_started) * 1000
+        recorded = self.turns[self.turn - 1]
+        same = answer == recorded["answer"]
+        self.results.append((ms, recorded["ms"], same))
+        expected = recorded["ms"] / self.speed if self.speed > 0 and recorded["ms"] is not None else 0
+        text = f"replay turn {self.turn}: {ms:.0f}ms (recorded {recorded['ms'] or 0:.0f}ms"
+        if self.speed != 1:
+            text += f", {expected:.0f}ms at {self.speed:g}x" if self.speed > 0 else ", no waits"
+        return text + f"), answer {'identical' if same else 'differs'}"
+
+    def close(self):
+        if not self.results:
+            return "trace replay: no turns replayed"
+        replayed = sum(ms for ms, _, _ in self.results)
+        recorded = sum(ms or 0 for _, ms, _ in self.results)
+        identical = sum(1 for _, _, same in self.results if same)
+        text = (f"trace replay: {len(self.results)} turns at {self.speed:g}x, {replayed:.0f}ms "
+                f"(recorded {recorded:.0f}ms), answers identical {identical}/{len(self.results)}")
+        if self.divergences or self.unmatched_tools:
+            text += f", llm divergences {self.divergences}, unmatched tool calls {self.unmatched_tools}"
+        if self.truncated:
+            text += ", trace file truncated"
+        return text
+
+
+class _ReplayTransport(httpx.BaseTransport):
+    """不访问网络，按顺序返回本轮录制的模型响应；GET（连接预热）直接返回空结果"""
+
+    def __init__(self, replayer):
+        self.replayer = replayer
+
+    def handle_request(self, request):
+        if request.method != "POST":
+            return httpx.Response(200, json={"object": "list", "data": []})
+        model, messages = _request_summary(request)
+        event = self.replayer.next_llm(model, messages)
+        if event is None:
+            return httpx.Response(500, json={"error": {"message": "no recorded response for this request"}})
+        _wait(self.replayer._scaled(event["ttfb"]))
+        return httpx.Response(event["status"], headers=event["headers"],
+                              stream=_ReplayStream(event, self.replayer))
+
+
+class _ReplayStream(httpx.SyncByteStream):
+    def __init__(self, event, replayer):
+        self.data = _decode_body(event)
+        self.chunks = event.get("chunks") or [[len(self.data), 0]]
+        self.replayer = replayer
+        self._closed = threading.Event()
+
+    def __iter__(self):
+        started = time.perf_counter()
+        offset = 0
+        for end, ms in self.chunks:
+            if self._closed.is_set():
+                return
+            _wait(self.replayer._scaled(ms) - (time.perf_counter() - started), self._closed)
+            yield self.data[offset:end]
+            offset = end
+
+    def close(self):
+        self._closed.set()
+
+
+def make_tracer(entry, record=TRACE_RECORD, replay=TRACE_REPLAY):
+    """按 TRACE_RECORD / TRACE_REPLAY 返回录制器或回放器，都未设置时返回 None"""
+    if replay:
+        return TraceReplayer(replay, entry)
+    if record:
+        return TraceRecorder(record, entry)
+    return None
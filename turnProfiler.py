@@ -0,0 +1,294 @@
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from html import escape
+
+from rich import box
+from rich.table import Table
+
+# 按轮次采集性能数据：PROFILE_TURNS=true 时默认开启，运行中也可以输入 /profile 切换
+PROFILE_TURNS = os.getenv("PROFILE_TURNS", "false").lower() == "true"
+# sample：定时采样所有线程的调用栈，输出折叠栈和火焰图；cprofile：主线程的确定性统计
+PROFILE_MODE = os.getenv("PROFILE_MODE", "sample")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_TOP = int(os.getenv("PROFILE_TOP", "15"))
+
+PROFILE_COMMAND = "/profile"
+
+# 这些函数在栈顶时表示线程在等待（锁、队列、事件）
+_WAIT_FRAMES = {("threading.py", "wait"), ("queue.py", "get"), ("threading.py", "_wait_for_tstate_lock")}
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _stack(frame):
+    """从栈底到栈顶的帧列表"""
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    frames.reverse()
+    return frames
+
+
+def _thread_cpu_clock(ident):
+    """线程的 CPU 时钟，平台不支持时返回 None"""
+    try:
+        return time.pthread_getcpuclockid(ident)
+    except (AttributeError, OSError):
+        return None
+
+
+class StackSampler:
+    """后台线程定时采样所有线程的调用栈
+
+    每个样本同时记录该线程在这段间隔内是否消耗了 CPU（Linux 下读取线程 CPU 时钟），
+    据此把墙钟时间拆成 on-CPU 与 off-CPU（等待网络、锁、渲染线程等）。
+    后台线程停在锁或队列上且没有消耗 CPU 的样本不计入，避免空闲的线程池淹没结果。
+    """
+
+    def __init__(self, interval_ms=PROFILE_INTERVAL_MS):
+        self.interval = interval_ms / 1000
+        self.wall = {}
+        self.cpu = {}
+        # 能读到线程 CPU 时钟的样本数，读不到时无法区分 on-CPU 与 off-CPU
+        self.cpu_known = {}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._cpu_clocks = {}
+        self._cpu_seen = {}
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _on_cpu(self, ident):
+        clock = self._cpu_clocks.get(ident)
+        if clock is None:
+            clock = self._cpu_clocks[ident] = _thread_cpu_clock(ident)
+        if clock is None:
+            return None
+        try:
+            used = time.clock_gettime(clock)
+        except OSError:
+            return None
+        previous = self._cpu_seen.get(ident, used)
+        self._cpu_seen[ident] = used
+        # 间隔内有四分之一以上的时间在运行即视为 on-CPU
+        return used - previous >= self.interval / 4
+
+    def _run(self):
+        own = threading.get_ident()
+        main = threading.main_thread().ident
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                on_cpu = self._on_cpu(ident)
+                frames = _stack(frame)
+                leaf = frames[-1].f_code
+                waiting = (os.path.basename(leaf.co_filename), leaf.co_name) in _WAIT_FRAMES
+                if ident != main and waiting and not on_cpu:
+                    continue
+                key = ";".join([names.get(ident, str(ident))] + [_frame_label(f) for f in frames])
+                self.wall[key] = self.wall.get(key, 0) + 1
+                if on_cpu is not None:
+                    self.cpu_known[key] = self.cpu_known.get(key, 0) + 1
+                if on_cpu:
+                    self.cpu[key] = self.cpu.get(key, 0) + 1
+            self.samples += 1
+
+    def hot_functions(self, limit=PROFILE_TOP):
+        """按自身样本数（栈顶）排序的函数，附带包含子调用的总样本数"""
+        own, total = {}, {}
+        for key, count in self.wall.items():
+            frames = key.split(";")[1:]
+            if not frames:
+                continue
+            own[frames[-1]] = own.get(frames[-1], 0) + count
+            for label in set(frames):
+                total[label] = total.get(label, 0) + count
+        ranked = sorted(own.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [(label, count, total[label], self.cpu_share(label)) for label, count in ranked]
+
+    def cpu_share(self, label):
+        """函数在栈顶时 on-CPU 样本的比例，平台不支持线程 CPU 时钟时返回 None"""
+        known = sum(count for key, count in self.cpu_known.items() if key.endswith(";" + label))
+        cpu = sum(count for key, count in self.cpu.items() if key.endswith(";" + label))
+        return cpu / known if known else None
+
+
+def write_collapsed(stacks, path):
+    """折叠栈格式（每行 "帧;帧;帧 样本数"），可直接交给 flamegraph.pl / speedscope"""
+    with open(path, "w", encoding="utf-8") as f:
+        for key, count in sorted(stacks.items()):
+            f.write(f"{key} {count}\n")
+
+
+def write_flamegraph(stacks, path, title, width=1200, row_height=16):
+    """把折叠栈画成 SVG 火焰图，不依赖外部工具"""
+    root = {"children": {}, "count": 0}
+    for key, count in stacks.items():
+        node = root
+        node["count"] += count
+        for label in key.split(";"):
+            node = node["children"].setdefault(label, {"children": {}, "count": 0})
+            node["count"] += count
+
+    def depth(node):
+        return 1 + max((depth(child) for child in node["children"].values()), default=0)
+
+    rows = depth(root)
+    height = (rows + 2) * row_height
+    total = root["count"] or 1
+    rects = []
+
+    def draw(node, x, level):
+        for label, child in sorted(node["children"].items()):
+            w = child["count"] / total * width
+            if w >= 0.5:
+                y = height - (level + 1) * row_height
+                # 按函数名取色，同一函数在不同位置颜色一致
+                hue = 20 + sum(label.encode()) % 40
+                # 按宽度截断函数名，每个字符约 7 像素
+                chars = int(w / 7)
+                text = escape(label if len(label) <= chars else label[:max(chars - 2, 0)] + "..")
+                rects.append(
+                    f'<g><title>{escape(label)} ({child["count"]} samples, {child["count"] / total:.1%})</title>'
+                    f'<rect x="{x:.1f}" y="{y}" width="{w:.1f}" height="{row_height - 1}" '
+                    f'fill="hsl({hue},90%,60%)"/>'
+                    f'<text x="{x + 3:.1f}" y="{y + row_height - 4}" font-size="11">{text if chars > 3 else ""}</text></g>')
+                draw(child, x, level + 1)
+            x += w
+
+    draw(root, 0, 0)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+                f'font-family="monospace">\n<text x="4" y="14" font-size="13">{escape(title)}</text>\n')
+        f.write("\n".join(rects))
+        f.write("\n</svg>\n")
+
+
+class TurnReport:
+    def __init__(self, label, wall, cpu, main_cpu, files, hot):
+        self.label = label
+        self.wall = wall
+        self.cpu = cpu
+        self.main_cpu = main_cpu
+        self.files = files
+        # [(函数, 自身样本数或耗时, 总样本数或耗时, on-CPU 比例或 None)]
+        self.hot = hot
+
+    def summary(self):
+        off_cpu = 1 - min(self.cpu / self.wall, 1) if self.wall else 0.0
+        return (f"profile {self.label}: wall {self.wall:.2f}s, cpu {self.cpu:.2f}s "
+                f"(main thread {self.main_cpu:.2f}s), off-cpu {off_cpu:.0%} -> {', '.join(self.files)}")
+
+
+def display_profile(console, report):
+    """在 console 上显示本轮的性能分析摘要和最耗时的函数，report 为 None（未开启）时不显示"""
+    if report is None:
+        return
+    console.print(f"[dim]{report.summary()}[/dim]")
+    hot = Table(title=f"Hot functions ({report.label})", box=box.SIMPLE)
+    hot.add_column("Self", justify="right", style="cyan")
+    hot.add_column("Total", justify="right")
+    hot.add_column("CPU", justify="right")
+    hot.add_column("Function", style="green")
+    for label, own, total, cpu_share in report.hot:
+        hot.add_row(str(own), str(total), "" if cpu_share is None else f"{cpu_share:.0%}", label)
+    console.print(hot)
+
+
+class TurnProfiler:
+    """run.py / run_langchain.py 每轮对话的性能分析
+
+    用法：with profiler.turn() as holder: ...；结束后 holder.report 为 TurnReport（未开启时为 None）。
+    每轮在 PROFILE_DIR 下写出 turn-N.folded（全部样本）、turn-N.cpu.folded（on-CPU 样本）、
+    turn-N.svg（火焰图）；cprofile 模式写出 turn-N.prof，可用 pstats / snakeviz 查看。
+    """
+
+    def __init__(self, enabled=PROFILE_TURNS, mode=PROFILE_MODE, directory=PROFILE_DIR,
+                 interval_ms=PROFILE_INTERVAL_MS, top=PROFILE_TOP):
+        self.enabled = enabled
+        self.mode = mode
+        self.directory = directory
+        self.interval_ms = interval_ms
+        self.top = top
+        self.turns = 0
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        return self.enabled
+
+    @contextmanager
+    def turn(self):
+        holder = _Holder()
+        if not self.enabled:
+            yield holder
+            return
+        self.turns += 1
+        label = f"turn-{self.turns}"
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, label)
+
+        sampler = profile = None
+        if self.mode == "cprofile":
+            profile = cProfile.Profile()
+        else:
+            sampler = StackSampler(self.interval_ms)
+        wall_start, cpu_start, main_start = time.perf_counter(), time.process_time(), time.thread_time()
+        if profile:
+            profile.enable()
+        else:
+            sampler.start()
+        try:
+            yield holder
+        finally:
+            if profile:
+                profile.disable()
+            else:
+                sampler.stop()
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            main_cpu = time.thread_time() - main_start
+            if profile:
+                files, hot = self._write_cprofile(profile, base)
+            else:
+                files, hot = self._write_samples(sampler, base, label, wall)
+            holder.report = TurnReport(label, wall, cpu, main_cpu, files, hot)
+
+    def _write_samples(self, sampler, base, label, wall):
+        files = [base + ".folded", base + ".cpu.folded", base + ".svg"]
+        write_collapsed(sampler.wall, files[0])
+        write_collapsed(sampler.cpu, files[1])
+        write_flamegraph(sampler.wall, files[2], f"{label}: {sampler.samples} samples, wall {wall:.2f}s")
+        return files, sampler.hot_functions(self.top)
+
+    def _write_cprofile(self, profile, base):
+        path = base + ".prof"
+        profile.dump_stats(path)
+        stats = pstats.Stats(profile)
+        ranked = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:self.top]
+        hot = [(f"{name} ({os.path.basename(filename)}:{line})", f"{own:.3f}s", f"{total:.3f}s", None)
+               for (filename, line, name), (_, _, own, total, _) in ranked]
+        return [path], hot
+
+
+class _Holder:
+    report = None
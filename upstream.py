@@ -0,0 +1,337 @@
+import json
+import os
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import urlsplit
+
+import requests
+
+from cancellation import current_token, submit
+from metrics import upstream_fallbacks, upstream_latency, upstream_requests
+from toolCache import TTLCache
+from toolResult import codec
+
+# 上游请求超时（秒）与对冲请求开关
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", "5"))
+UPSTREAM_HEDGE = os.getenv("UPSTREAM_HEDGE", "true").lower() == "true"
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+# 高德的限流与配额错误（HTTP 状态码仍为 200，status 为 "0"），计入熔断
+AMAP_THROTTLE_INFOCODES = {"10003", "10004", "10014", "10015", "10019", "10020", "10021", "10029", "10044", "10045"}
+
+
+def amap_error(data):
+    """高德风格的业务错误（status 为 "0"）返回 infocode，否则返回 None"""
+    if isinstance(data, dict) and data.get("status") == "0" and "infocode" in data:
+        return str(data["infocode"])
+    return None
+
+
+class UpstreamError(Exception):
+    """上游接口请求失败"""
+
+
+class CircuitOpen(UpstreamError):
+    """熔断器处于打开状态，请求被直接拒绝"""
+
+
+class CircuitBreaker:
+    """单个上游接口的熔断器
+
+    在滚动时间窗口内统计请求耗时与失败率：
+    - closed：正常放行；失败率超过阈值时打开
+    - open：直接拒绝，冷却 open_seconds 后进入 half_open
+    - half_open：只放行一个探测请求，成功则关闭，失败则重新打开
+    """
+
+    def __init__(self, name, window_seconds=60, min_requests=5, error_rate=0.5, open_seconds=30):
+        self.name = name
+        self.window_seconds = window_seconds
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self._samples = deque()
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self._opened_at < self.open_seconds:
+                    return False
+                self.state = HALF_OPEN
+                self._probing = False
+            if self.state == HALF_OPEN:
+                if self._probing:
+                    return False
+                self._probing = True
+            return True
+
+    def record(self, latency, ok):
+        now = time.monotonic()
+        with self._lock:
+            self._samples.append((now, latency, ok))
+            self._trim(now)
+            if self.state == HALF_OPEN:
+                self._probing = False
+                if ok:
+                    self.state = CLOSED
+                    self._samples.clear()
+                else:
+                    self._open(now)
+                return
+            failures = sum(1 for _, _, sample_ok in self._samples if not sample_ok)
+            if (len(self._samples) >= self.min_requests
+                    and failures / len(self._samples) >= self.error_rate):
+                self._open(now)
+
+    def abandon(self):
+        """请求被取消，不计入统计；若它是半开状态的探测请求，允许下一个请求继续探测"""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probing = False
+
+    def _open(self, now):
+        self.state = OPEN
+        self._opened_at = now
+
+    def _trim(self, now):
+        while self._samples and now - self._samples[0][0] > self.window_seconds:
+            self._samples.popleft()
+
+    def latency_quantile(self, q):
+        """窗口内成功请求耗时的分位数，样本不足时返回 None"""
+        with self._lock:
+            latencies = sorted(latency for _, latency, ok in self._samples if ok)
+        if len(latencies) < self.min_requests:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+
+def _close_response(response):
+    """关闭响应；另一个线程正在读取正文时 close() 要等读取返回，先 shutdown 底层 socket 让读取立即结束"""
+    connection = getattr(response.raw, "connection", None)
+    sock = getattr(connection, "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    response.close()
+
+
+class _Attempt:
+    """对冲中的一次请求：另一个请求先返回后 abandon() 关闭它的响应，不再占用连接池中的连接"""
+
+    def __init__(self):
+        self.abandoned = False
+        self._response = None
+        self._lock = threading.Lock()
+
+    def attach(self, response):
+        with self._lock:
+            self._response = response
+            abandoned = self.abandoned
+        if abandoned:
+            _close_response(response)
+
+    def abandon(self):
+        with self._lock:
+            self.abandoned = True
+            response = self._response
+        if response is not None:
+            _close_response(response)
+
+
+class UpstreamClient:
+    """带熔断、对冲请求和最近成功结果兜底的 HTTP GET 客户端
+
+    - 每个接口（host + path）一个熔断器
+    - 开启对冲时，主请求超过该接口 p95 耗时仍未返回，就再发一个相同的请求，取先成功的；
+      另一个请求随即被放弃：还没开始的直接取消，已收到响应头的关闭响应，还在等响应头的在响应头到达时关闭，
+      不读取正文，也不计入熔断统计
+    - 熔断打开或请求失败时，立即返回同一请求最近一次成功的结果
+    - 高德在 HTTP 200 中返回 status "0"：限流与配额错误按失败处理，其他业务错误原样返回，都不作为兜底结果
+    - 当前上下文中有取消令牌时，请求超时不超过本轮的截止时间；取消时关闭响应连接并抛出 TurnCancelled，
+      被取消的请求不计入熔断统计，也不会退回旧结果
+    """
+
+    def __init__(self, timeout=UPSTREAM_TIMEOUT, hedge=UPSTREAM_HEDGE,
+                 hedge_floor=0.05, default_hedge_delay=1.0, stale_ttl=24 * 3600):
+        self.timeout = timeout
+        self.hedge = hedge
+        self.hedge_floor = hedge_floor
+        self.default_hedge_delay = default_hedge_delay
+        self.breakers = {}
+        self.last_good = TTLCache(ttl=stale_ttl, max_entries=2048)
+        self._local = threading.local()
+        self._pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="upstream")
+        self._lock = threading.Lock()
+
+    def breaker(self, url):
+        parts = urlsplit(url)
+        endpoint = parts.netloc + parts.path
+        with self._lock:
+            if endpoint not in self.breakers:
+                self.breakers[endpoint] = CircuitBreaker(endpoint)
+            return self.breakers[endpoint]
+
+    def _session(self):
+        # requests.Session 复用连接，每个线程一个
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def get_json(self, url, params):
+        """请求并解析 JSON；失败或熔断时返回最近一次成功的结果，都没有时抛出 UpstreamError"""
+        return self.request_json("GET", url, params)
+
+    def post_json(self, url, params, body):
+        """以 JSON 请求体 POST（用于只读的批量查询接口），容错行为与 get_json 相同"""
+        return self.request_json("POST", url, params, body)
+
+    def request_json(self, method, url, params, body=None):
+        token = current_token()
+        if token is not None:
+            token.check()
+        breaker = self.breaker(url)
+        stale_key = method + " " + url + "?" + "&".join(
+            f"{k}={v}" for k, v in sorted(params.items()) if k != "key")
+        if body is not None:
+            stale_key += " " + json.dumps(body, ensure_ascii=False, sort_keys=True)
+
+        if not breaker.allow():
+            upstream_requests.inc(urlsplit(url).netloc, "circuit_open")
+            stale = self.last_good.get(stale_key)
+            if stale is not None:
+                upstream_fallbacks.inc(urlsplit(url).netloc, "circuit_open")
+                return stale
+            raise CircuitOpen(f"{breaker.name} 熔断中")
+
+        try:
+            data = self._hedged_request(breaker, method, url, params, body, token)
+        except UpstreamError:
+            stale = self.last_good.get(stale_key)
+            if stale is not None:
+                upstream_fallbacks.inc(urlsplit(url).netloc, "error")
+                return stale
+            raise
+        if amap_error(data) is None:
+            self.last_good.set(stale_key, data)
+        return data
+
+    def _wait(self, futures, token, timeout=None):
+        if token is None:
+            done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+            return done
+        return token.wait(futures, timeout=timeout)
+
+    def _hedged_request(self, breaker, method, url, params, body, token):
+        request = (breaker, method, url, params, body, token)
+        if not self.hedge:
+            primary = submit(self._pool, self._request_once, *request)
+            self._wait([primary], token)
+            return primary.result()
+
+        attempts = {}
+
+        def start():
+            attempt = _Attempt()
+            future = submit(self._pool, self._request_once, *request, attempt)
+            attempts[future] = attempt
+            return future
+
+        primary = start()
+        try:
+            delay = breaker.latency_quantile(0.95)
+            delay = self.default_hedge_delay if delay is None else max(delay, self.hedge_floor)
+            if self._wait([primary], token, timeout=delay):
+                return primary.result()
+
+            futures = [primary, start()]
+            error = None
+            while futures:
+                done = self._wait(futures, token)
+                pending = [future for future in futures if future not in done]
+                for future in done:
+                    try:
+                        return future.result()
+                    except UpstreamError as e:
+                        error = e
+                futures = list(pending)
+            raise error
+        finally:
+            # 已经有结果（或本轮被取消）时放弃仍在进行的请求，释放连接
+            for future, attempt in attempts.items():
+                if not future.done():
+                    future.cancel()
+                    attempt.abandon()
+
+    def _request_once(self, breaker, method, url, params, body=None, token=None, attempt=None):
+        started = time.monotonic()
+        host = urlsplit(url).netloc
+        unregister = lambda: None
+        try:
+            timeout = self.timeout if token is None else token.timeout(self.timeout)
+            # stream=True 先只读响应头，取消时关闭响应即可中断正文读取并释放连接
+            response = self._session().request(method, url, params=params, json=body,
+                                               timeout=timeout, stream=True)
+            if token is not None:
+                unregister = token.on_cancel(lambda: _close_response(response))
+            if attempt is not None:
+                attempt.attach(response)
+            content = response.content
+            if attempt is not None and attempt.abandoned:
+                raise UpstreamError(f"{breaker.name} 对冲请求已放弃")
+        except Exception as e:
+            if token is not None and token.cancelled:
+                breaker.abandon()
+                upstream_requests.inc(host, "cancelled")
+                raise token.error()
+            if attempt is not None and attempt.abandoned:
+                # 另一个对冲请求已经返回，这个请求的结果没人使用，不计入熔断
+                breaker.abandon()
+                upstream_requests.inc(host, "hedge_abandoned")
+                raise UpstreamError(f"{breaker.name} 对冲请求已放弃")
+            upstream_requests.inc(host, "error")
+            if not isinstance(e, requests.RequestException):
+                raise
+            breaker.record(time.monotonic() - started, False)
+            raise UpstreamError(str(e))
+        finally:
+            unregister()
+        latency = time.monotonic() - started
+        upstream_latency.observe(latency, host)
+        if response.status_code != 200:
+            upstream_requests.inc(host, f"http_{response.status_code}")
+            # 4xx（429 除外）有意记为成功：它们是请求参数或密钥的问题，说明上游本身正常响应，
+            # 计为失败会让模型传错参数就打开熔断、拖累其他请求；429 限流和 5xx 记为失败
+            breaker.record(latency, response.status_code < 500 and response.status_code != 429)
+            raise UpstreamError(f"{breaker.name} 返回 {response.status_code}")
+        try:
+            data = codec.loads(content)
+        except ValueError as e:
+            upstream_requests.inc(host, "invalid")
+            breaker.record(latency, False)
+            raise UpstreamError(f"{breaker.name} 返回的内容无法解析：{e}")
+        infocode = amap_error(data)
+        if infocode is not None:
+            upstream_requests.inc(host, f"amap_{infocode}")
+            # 与 4xx 相同，参数错误等业务错误不计入熔断
+            breaker.record(latency, infocode not in AMAP_THROTTLE_INFOCODES)
+            if infocode in AMAP_THROTTLE_INFOCODES:
+                raise UpstreamError(f"{breaker.name} 限流（infocode {infocode}）")
+            return data
+        upstream_requests.inc(host, "ok")
+        breaker.record(latency, True)
+        return data
+
+
+upstream = UpstreamClient()
@@ -0,0 +1,91 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from cancellation import submit
+from toolCache import TOOL_FRESHNESS, query_key, tool_result_cache
+from toolResult import ToolResult
+
+# 一次最多查询的城市数
+MAX_LOCATIONS = 10
+
+_weather_pool = ThreadPoolExecutor(max_workers=MAX_LOCATIONS, thread_name_prefix="weather")
+
+_COLUMNS = ("城市", "天气", "气温℃", "体感℃", "湿度%", "风", "降水mm")
+
+
+def unique_locations(locations):
+    """去掉空白和重复的城市，保持原有顺序"""
+    seen = set()
+    unique = []
+    for location in locations:
+        location = str(location).strip()
+        if location and location not in seen:
+            seen.add(location)
+            unique.append(location)
+    return unique
+
+
+def weather_row(location, result):
+    """把单个城市的天气结果压缩成表格的一行"""
+    current = (result.data or {}).get("current") if result.ok else None
+    if not current:
+        return f"{location} | 查询失败：{result.text or '无数据'}"
+    return " | ".join(str(value) for value in (
+        location,
+        current.get("condition", {}).get("text", ""),
+        current.get("temp_c", ""),
+        current.get("feelslike_c", ""),
+        current.get("humidity", ""),
+        f"{current.get('wind_dir', '')} {current.get('wind_kph', '')}km/h",
+        current.get("precip_mm", ""),
+    ))
+
+
+def weather_table(rows):
+    return "\n".join([" | ".join(_COLUMNS)] + rows)
+
+
+def _cacheable(result):
+    return result.ok and result.data is not None
+
+
+def make_weather_bulk_tool(fetch_one, fetch_many=None, cache=tool_result_cache):
+    """一次查询多个城市的天气，返回一张紧凑的表格
+
+    - 城市去重后逐个查缓存，缓存与单城市的 get_weather 共用（同一个 key）
+    - 未命中的城市优先用 fetch_many（服务商的批量接口）一次请求，fetch_many 不可用或返回 None
+      时用 fetch_one 并发请求
+    """
+    ttl = TOOL_FRESHNESS["get_weather"]
+
+    def get_weather_bulk(parameters):
+        locations = parameters.get("locations")
+        if isinstance(locations, str):
+            locations = locations.replace("，", ",").split(",")
+        if not locations:
+            return ToolResult.error("缺失函数参数，请提供所有要求参数后重试")
+        locations = unique_locations(locations)[:MAX_LOCATIONS]
+
+        results = {}
+        missing = []
+        for location in locations:
+            cached = cache.get(query_key("get_weather", {"location": location}))
+            if cached is not None:
+                results[location] = cached
+            else:
+                missing.append(location)
+
+        if missing:
+            fetched = fetch_many(missing) if fetch_many else None
+            if fetched is None:
+                futures = {location: submit(_weather_pool, fetch_one, {"location": location})
+                           for location in missing}
+                fetched = {location: future.result() for location, future in futures.items()}
+            for location in missing:
+                result = fetched.get(location) or ToolResult.error("无数据")
+                results[location] = result
+                if _cacheable(result):
+                    cache.set(query_key("get_weather", {"location": location}), result, ttl=ttl)
+
+        return ToolResult(text=weather_table([weather_row(location, results[location]) for location in locations]))
+
+    return get_weather_bulk